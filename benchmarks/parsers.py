@@ -0,0 +1,244 @@
+"""
+.. module:: parsers
+   :synopsis: Micro-benchmarks for source parsers and protocol decoders
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+
+Times the hot parsing and encoding paths in isolation against the fixture
+data in :mod:`duct.tests.globs`, and prints the results as JSON, or writes
+them to the file given by `--output`::
+
+    python benchmarks/parsers.py --output parsers.json
+    python benchmarks/parsers.py riemann sflow
+
+Each benchmark is calibrated so that one round takes at least `--min-time`
+seconds, then run for `--repeat` rounds with the garbage collector disabled.
+The fastest round is the most stable figure to compare between runs.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from duct.logs.parsers import ApacheLogParser
+from duct.objects import EventBatch
+from duct.protocol.riemann import RiemannProtobufMixin
+from duct.protocol.sflow.protocol import Sflow
+from duct.service import DuctService
+from duct.sources import haproxy, nginx
+from duct.sources.linux import basic
+from duct.tests import globs
+
+from twisted.internet import defer
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Register a benchmark. The decorated function does any setup and
+    returns a callable which is timed
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+def createSource(cls, **config):
+    """Create a source which isn't attached to a running service
+    """
+    config.setdefault('service', cls.__name__.lower())
+    config.setdefault('hostname', 'localhost')
+    return cls(config, lambda *_: None, DuctService({}))
+
+def alternate(first, second):
+    """Return a function which returns `first` and `second` in turn, so
+    parsers which keep the previous sample always see a change
+    """
+    state = [second, first]
+
+    def next_value():
+        state.reverse()
+        return state[0]
+
+    return next_value
+
+@benchmark('cpu.calculate_metrics')
+def cpuCalculateMetrics():
+    src = createSource(basic.CPU)
+    stats = alternate(
+        [l for l in globs.PROC_STAT.split('\n') if l.startswith('cpu')],
+        [l for l in globs.PROC_STAT_NEXT.split('\n') if l.startswith('cpu')])
+
+    def run():
+        for line in stats():
+            src._calculate_metrics(line)
+
+    return run
+
+@benchmark('cpu.parse_stats')
+def cpuParseStats():
+    src = createSource(basic.CPU)
+    stats = alternate(globs.PROC_STAT.split('\n'),
+                      globs.PROC_STAT_NEXT.split('\n'))
+    return lambda: src._parse_stats(stats())
+
+@benchmark('diskio.parse_stats')
+def diskIOParseStats():
+    src = createSource(basic.DiskIO)
+    stats = globs.PROC_DISKSTATS.split('\n')
+    return lambda: src._parse_stats(stats)
+
+@benchmark('network.parse_stats')
+def networkParseStats():
+    src = createSource(basic.Network)
+    stats = globs.PROC_NET_DEV.split('\n')[2:]
+    return lambda: src._parse_stats(stats)
+
+@benchmark('nginx.parse_nginx_stats')
+def nginxParseStats():
+    src = createSource(nginx.Nginx)
+    return lambda: src._parse_nginx_stats(globs.NGINX_STATS)
+
+@benchmark('apache_log.parse')
+def apacheLogParse():
+    parser = ApacheLogParser('combined')
+    return lambda: parser.parse(globs.APACHE_LOG_COMBINED)
+
+@benchmark('haproxy.csv')
+def haproxyCSV():
+    src = createSource(haproxy.HAProxy)
+    src._get_stats = lambda: defer.succeed(globs.HAPROXY_CSV)
+    # get() runs synchronously since _get_stats has already fired
+    return src.get
+
+@benchmark('sflow.decode')
+def sflowDecode():
+    return lambda: Sflow(globs.SFLOW_PACKET, '172.30.0.5')
+
+def riemannBatch(size=100):
+    """An EventBatch of `size` events like a busy source would produce
+    """
+    batch = EventBatch()
+    now = time.time()
+    for i in range(size):
+        batch.append('ok', 'bench.service.%s' % i, 'Benchmark event', i * 1.5,
+                     60.0, tags=['bench'], hostname='localhost', evtime=now)
+    return batch
+
+@benchmark('riemann.encode_message')
+def riemannEncode():
+    proto = RiemannProtobufMixin()
+    batch = riemannBatch()
+    return lambda: proto.encodeMessage(batch)
+
+@benchmark('riemann.encode_message.events')
+def riemannEncodeEvents():
+    proto = RiemannProtobufMixin()
+    events = list(riemannBatch())
+    return lambda: proto.encodeMessage(events)
+
+@benchmark('riemann.decode_message')
+def riemannDecode():
+    proto = RiemannProtobufMixin()
+    message = proto.encodeMessage(riemannBatch())
+    return lambda: proto.decodeMessage(message)
+
+def timeRound(func, number):
+    """Time `number` calls of `func` with the garbage collector disabled
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = timeit.default_timer()
+        for _ in range(number):
+            func()
+        return timeit.default_timer() - start
+    finally:
+        if enabled:
+            gc.enable()
+
+def calibrate(func, minTime):
+    """Return a number of calls to `func` which takes at least `minTime`
+    """
+    number = 1
+    while True:
+        if timeRound(func, number) >= minTime:
+            return number
+        number *= 2
+
+def measure(func, repeat, minTime):
+    """Time `func` and return a dictionary of results
+    """
+    number = calibrate(func, minTime)
+    rounds = sorted(timeRound(func, number) / number for _ in range(repeat))
+
+    return {
+        'calls': number,
+        'rounds': repeat,
+        'best_us': rounds[0] * 1e6,
+        'median_us': rounds[len(rounds) // 2] * 1e6,
+        'mean_us': sum(rounds) / len(rounds) * 1e6,
+        'calls_per_sec': 1.0 / rounds[0],
+    }
+
+def run(args):
+    """Run the selected benchmarks and return their results
+    """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if args.names and not any(sel in name for sel in args.names):
+            continue
+        results[name] = measure(setup(), args.repeat, args.min_time)
+        sys.stderr.write('%-32s %10.2f us\n' % (name,
+                                                results[name]['best_us']))
+
+    return {
+        'benchmark': 'parsers',
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'repeat': args.repeat,
+            'min_time': args.min_time,
+        },
+        'results': results,
+    }
+
+def main():
+    """Entry point
+    """
+    parser = argparse.ArgumentParser(description='Parser micro-benchmarks')
+    parser.add_argument('names', nargs='*',
+                        help='Only run benchmarks containing these names')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed rounds')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Minimum seconds for each round')
+    parser.add_argument('--list', action='store_true',
+                        help='List the benchmarks and exit')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+        return
+
+    results = json.dumps(run(args), indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'wt') as out:
+            out.write(results + '\n')
+    else:
+        print(results)
+
+if __name__ == '__main__':
+    main()
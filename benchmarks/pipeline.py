@@ -0,0 +1,433 @@
+"""
+.. module:: pipeline
+   :synopsis: Throughput benchmark for the source to output pipeline
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+
+Builds a DuctService with synthetic sources and sends their events to stand-in
+Riemann, Elasticsearch, OpenTSDB and Prometheus endpoints, which run in a
+separate process so their work isn't counted against Duct. Results are
+printed as JSON, or written to the file given by `--output`::
+
+    python benchmarks/pipeline.py --rate 20000 --cardinality 1000 \\
+        --duration 30 --output pipeline.json
+
+Each synthetic event carries its creation time as its metric, so the
+endpoints can measure end-to-end latency, and ignore events created during
+the warmup which are still queued when the measurement starts.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import yaml
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from duct.ihateprotobuf import proto_pb2
+from duct.objects import Source
+from duct.service import DuctService
+from duct.stats import Histogram
+from duct.utils import HTTPRequest
+
+ENDPOINTS = ('riemann', 'elasticsearch', 'opentsdb', 'prometheus')
+
+
+class SyntheticSource(Source):
+    """Generates `rate` events per second spread across `cardinality`
+    series. The metric of each event is the time it was created. Only events
+    created after `measureFrom` are counted.
+    """
+    generated = 0
+    measureFrom = 0
+
+    def __init__(self, *a):
+        Source.__init__(self, *a)
+        self.rate = float(self.config.get('rate', 1000))
+        self.cardinality = int(self.config.get('cardinality', 100))
+        self.services = ['%s.%s' % (self.service, i)
+                         for i in range(self.cardinality)]
+        self.position = 0
+
+    def get(self):
+        count = int(self.rate * self.inter)
+        services = self.services
+        cardinality = self.cardinality
+        position = self.position
+
+        batch = self.createBatch()
+        now = time.time()
+        for i in range(count):
+            batch.append('ok', services[(position + i) % cardinality],
+                         'Benchmark', now, self.ttl, hostname=self.hostname,
+                         evtime=now)
+
+        self.position = (position + count) % cardinality
+        if now >= SyntheticSource.measureFrom:
+            SyntheticSource.generated += count
+
+        return batch
+
+
+class Endpoint(object):
+    """Counts events received by a stand-in endpoint and their latency,
+    ignoring events created before `start`
+    """
+    def __init__(self, start):
+        self.start = start
+        self.received = 0
+        self.latency = Histogram()
+
+    def record(self, created, now):
+        """Record an event whose metric was its creation time
+        """
+        if created < self.start:
+            return
+        self.received += 1
+        self.latency.record(max(0.0, now - created))
+
+    def result(self):
+        """Summary of this endpoint for the results
+        """
+        return {
+            'received': self.received,
+            'latency': {
+                'p50': self.latency.percentile(50),
+                'p99': self.latency.percentile(99),
+                'max': self.latency.max,
+            }
+        }
+
+class RiemannProtocol(Int32StringReceiver):
+    """Stand-in Riemann server
+    """
+    MAX_LENGTH = 256 * 1024 * 1024
+
+    def stringReceived(self, string):
+        now = time.time()
+        message = proto_pb2.Msg.FromString(string)
+        for event in message.events:
+            self.factory.endpoint.record(event.metric_d, now)
+        self.sendString(proto_pb2.Msg(ok=True).SerializeToString())
+
+class RiemannFactory(ServerFactory):
+    """Stand-in Riemann server factory
+    """
+    protocol = RiemannProtocol
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+class ElasticsearchResource(Resource):
+    """Stand-in Elasticsearch bulk API
+    """
+    isLeaf = True
+
+    def __init__(self, endpoint):
+        Resource.__init__(self)
+        self.endpoint = endpoint
+
+    def render_PUT(self, request):
+        now = time.time()
+        lines = request.content.read().decode().splitlines()
+        # Every other line is an index action
+        for line in lines[1::2]:
+            self.endpoint.record(json.loads(line)['metric'], now)
+        return b'{"errors": false}'
+
+    render_POST = render_PUT
+
+class OpenTSDBResource(Resource):
+    """Stand-in OpenTSDB put API
+    """
+    isLeaf = True
+
+    def __init__(self, endpoint):
+        Resource.__init__(self)
+        self.endpoint = endpoint
+
+    def render_POST(self, request):
+        now = time.time()
+        for point in json.loads(request.content.read().decode()):
+            self.endpoint.record(point['value'], now)
+        return b'{}'
+
+class PrometheusScraper(object):
+    """Stand-in Prometheus server which scrapes the output every `interval`
+    seconds. Every scrape returns the latest sample of every series, so
+    scrapes and samples are counted rather than events. Staleness is how old
+    each sample was when scraped. Only scrapes between `start` and `end` are
+    counted.
+    """
+    def __init__(self, start, end, port, interval=1.0):
+        self.start = start
+        self.end = end
+        self.url = 'http://127.0.0.1:%s/metrics' % port
+        self.scrapes = 0
+        self.samples = 0
+        self.staleness = Histogram()
+        self.timer = task.LoopingCall(self.scrape)
+        self.timer.start(interval, now=False)
+
+    def scrape(self):
+        """Fetch and count the exposed samples
+        """
+        def received(body):
+            now = time.time()
+            if not self.start <= now <= self.end:
+                return
+
+            if isinstance(body, bytes):
+                body = body.decode()
+
+            self.scrapes += 1
+            for line in body.splitlines():
+                self.samples += 1
+                self.staleness.record(
+                    max(0.0, now - float(line.rsplit(' ', 1)[1])))
+
+        return HTTPRequest(timeout=10).getBody(self.url).addCallbacks(
+            received, lambda _: None)
+
+    def result(self):
+        """Summary of the scrapes for the results
+        """
+        return {
+            'scrapes': self.scrapes,
+            'samples': self.samples,
+            'staleness': {
+                'p50': self.staleness.percentile(50),
+                'p99': self.staleness.percentile(99),
+                'max': self.staleness.max,
+            }
+        }
+
+def serve(prometheusPort, start, end):
+    """Run the stand-in endpoints until terminated, printing their ports
+    first and their results as JSON when stopped. Events created before
+    `start` are part of the warmup and ignored, as are Prometheus scrapes
+    after `end`
+    """
+    endpoints = dict((name, Endpoint(start)) for name in ENDPOINTS
+                     if name != 'prometheus')
+    ports = {
+        'riemann': reactor.listenTCP(
+            0, RiemannFactory(endpoints['riemann'])),
+        'elasticsearch': reactor.listenTCP(
+            0, Site(ElasticsearchResource(endpoints['elasticsearch']))),
+        'opentsdb': reactor.listenTCP(
+            0, Site(OpenTSDBResource(endpoints['opentsdb']))),
+    }
+
+    sys.stdout.write(json.dumps(dict(
+        (name, port.getHost().port) for name, port in ports.items())) + '\n')
+    sys.stdout.flush()
+
+    endpoints['prometheus'] = PrometheusScraper(start, end,
+                                                prometheusPort)
+
+    reactor.run()
+
+    sys.stdout.write(json.dumps(dict(
+        (name, endpoint.result())
+        for name, endpoint in endpoints.items())) + '\n')
+
+def freePort():
+    """Find a free TCP port
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def buildConfig(args, ports, prometheusPort):
+    """Build the DuctService configuration for a benchmark run
+    """
+    outputs = {
+        'riemann': {
+            'output': 'duct.outputs.riemann.RiemannTCP',
+            'server': '127.0.0.1',
+            'port': ports['riemann'],
+            'interval': 0.1,
+        },
+        'elasticsearch': {
+            'output': 'duct.outputs.elasticsearch.ElasticSearch',
+            'url': 'http://127.0.0.1:%s' % ports['elasticsearch'],
+            'maxrate': 0,
+        },
+        'opentsdb': {
+            'output': 'duct.outputs.opentsdb.OpenTSDB',
+            'url': 'http://127.0.0.1:%s' % ports['opentsdb'],
+            'maxrate': 0,
+        },
+        'prometheus': {
+            'output': 'duct.outputs.prometheus.Prometheus',
+            'port': prometheusPort,
+        },
+    }
+
+    rate = args.rate / float(args.sources)
+    config = {
+        'ttl': 60.0,
+        'interval': args.interval,
+        'outputs': [outputs[name] for name in args.endpoints],
+        'sources': [{
+            'service': 'bench%s' % i,
+            'source': '__main__.SyntheticSource',
+            'hostname': 'bench',
+            'rate': rate,
+            'cardinality': max(1, args.cardinality // args.sources),
+        } for i in range(args.sources)],
+    }
+
+    if args.config:
+        with open(args.config) as conf:
+            config.update(yaml.safe_load(conf) or {})
+
+    return config
+
+def cpuTime():
+    """CPU seconds used by this process
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def run(args):
+    """Run a benchmark and return its results
+    """
+    prometheusPort = freePort()
+
+    # The measurement starts at a fixed time, so the endpoints and sources
+    # agree on which events belong to the warmup
+    start = time.time() + args.warmup
+    SyntheticSource.measureFrom = start
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve',
+         '--prometheus-port', str(prometheusPort), '--start', repr(start),
+         '--end', repr(start + args.duration)],
+        stdout=subprocess.PIPE)
+    ports = json.loads(server.stdout.readline().decode())
+
+    config = buildConfig(args, ports, prometheusPort)
+    service = DuctService(config)
+
+    state = {}
+
+    def begin():
+        state['cpu'] = cpuTime()
+        reactor.callLater(start + args.duration - time.time(), finish)
+
+    def finish():
+        for source in service.sources:
+            source.stopTimer()
+        state['duration'] = time.time() - start
+        state['cpu'] = cpuTime() - state['cpu']
+        state['generated'] = SyntheticSource.generated
+
+        # Let outputs drain their queues before stopping
+        reactor.callLater(args.drain, reactor.stop)
+
+    reactor.callWhenRunning(service.startService)
+    reactor.callLater(max(0, start - time.time()), begin)
+    reactor.run()
+
+    server.send_signal(signal.SIGTERM)
+    endpoints = json.loads(server.stdout.readlines()[-1].decode())
+    server.wait()
+
+    generated = state['generated']
+    duration = state['duration']
+
+    for endpoint in endpoints.values():
+        if 'received' in endpoint:
+            endpoint['events_per_sec'] = endpoint['received'] / duration
+
+    return {
+        'benchmark': 'pipeline',
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'rate': args.rate,
+            'cardinality': args.cardinality,
+            'sources': args.sources,
+            'interval': args.interval,
+            'duration': args.duration,
+            'endpoints': args.endpoints,
+        },
+        'generated': generated,
+        'duration': duration,
+        'events_per_sec': generated / duration,
+        'cpu_seconds': state['cpu'],
+        'cpu_per_100k_events': (state['cpu'] * 100000.0 / generated
+                                if generated else None),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'endpoints': dict((name, endpoints[name])
+                          for name in args.endpoints),
+    }
+
+def main():
+    """Entry point
+    """
+    parser = argparse.ArgumentParser(
+        description='Pipeline throughput benchmark')
+    parser.add_argument('--rate', type=float, default=10000,
+                        help='Events per second across all sources')
+    parser.add_argument('--cardinality', type=int, default=1000,
+                        help='Number of distinct series')
+    parser.add_argument('--sources', type=int, default=10,
+                        help='Number of synthetic sources')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Source interval in seconds')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to generate events for')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='Seconds to run before measuring')
+    parser.add_argument('--drain', type=float, default=5,
+                        help='Seconds to let outputs drain at the end')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                        type=lambda val: val.split(','),
+                        help='Comma separated endpoints to send to')
+    parser.add_argument('--config',
+                        help='YAML file merged into the service config')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    parser.add_argument('--serve', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--prometheus-port', type=int,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--start', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--end', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.prometheus_port, args.start, args.end)
+        return
+
+    results = json.dumps(run(args), indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'wt') as out:
+            out.write(results + '\n')
+    else:
+        print(results)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,11 @@
 .. moduleauthor:: Colin Alston <colin@imcol.in>
 """
 
+import heapq
+import time
+
+from array import array
+
 
 def Counter32(al, br, delta):
     """32bit counter aggregator with wrapping
@@ -31,3 +36,169 @@ def Counter(al, br, delta):
         return None
 
     return (br - al) / float(delta)
+
+# Wrap-around values for aggregators which CounterState can apply inline.
+# None means a decreasing counter produces no metric.
+COUNTER_WRAPS = {
+    Counter32: 4294967295,
+    Counter64: 18446744073709551615,
+    Counter: None,
+}
+
+class CounterState(object):
+    """Bounded store of the last metric and time of each aggregated series
+
+    State is held in flat arrays indexed by a slot number, with a dictionary
+    mapping series ids to slots. Entries expire once a series has not been
+    updated for its `ttl`, and if `maxsize` is reached the least recently
+    updated tenth of the store is evicted to make room.
+
+    :param maxsize: Maximum number of series to hold (0 is no limit)
+    :type maxsize: int.
+    """
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+
+        self.slots = {}
+        self.sids = []
+        self.metrics = []
+        self.times = array('d')
+        self.deadlines = array('d')
+        self.free = []
+
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, sid):
+        return sid in self.slots
+
+    def get(self, sid):
+        """Return the last (metric, time) for `sid` or None
+        """
+        slot = self.slots.get(sid)
+        if slot is None:
+            return None
+        return self.metrics[slot], self.times[slot]
+
+    def _insert(self, sid, metric, mtime, deadline):
+        if self.maxsize and (len(self.slots) >= self.maxsize):
+            self.evictOldest(max(1, self.maxsize // 10))
+
+        if self.free:
+            slot = self.free.pop()
+            self.sids[slot] = sid
+            self.metrics[slot] = metric
+            self.times[slot] = mtime
+            self.deadlines[slot] = deadline
+        else:
+            slot = len(self.sids)
+            self.sids.append(sid)
+            self.metrics.append(metric)
+            self.times.append(mtime)
+            self.deadlines.append(deadline)
+
+        self.slots[sid] = slot
+
+    def _remove(self, slot):
+        del self.slots[self.sids[slot]]
+        self.sids[slot] = None
+        self.metrics[slot] = None
+        self.deadlines[slot] = 0
+        self.free.append(slot)
+
+    def evictOldest(self, count):
+        """Evict the `count` least recently updated series
+        """
+        deadlines = self.deadlines
+        oldest = heapq.nsmallest(count, self.slots.values(),
+                                 key=deadlines.__getitem__)
+        for slot in oldest:
+            self._remove(slot)
+        self.evicted += len(oldest)
+
+    def expire(self, now=None):
+        """Remove series whose ttl has passed
+        """
+        if now is None:
+            now = time.time()
+
+        stale = [slot for slot, deadline in enumerate(self.deadlines)
+                 if 0 < deadline < now]
+        for slot in stale:
+            self._remove(slot)
+        self.expired += len(stale)
+
+        return len(stale)
+
+    def apply(self, batch, ttl):
+        """Aggregate every row of `batch` which has an aggregation function
+
+        Metrics in the batch are replaced with their aggregated values. The
+        common counter aggregators are computed inline rather than with a
+        function call per event. Returns the indices of rows which should be
+        kept, which excludes the first sample of each counter series.
+
+        :param batch: EventBatch with `sids` populated
+        :param ttl: Seconds to keep state for these series without updates
+        """
+        deadline = time.time() + ttl
+
+        slots = self.slots
+        lastMetrics = self.metrics
+        lastTimes = self.times
+        deadlines = self.deadlines
+        metrics = batch.metrics
+        times = batch.times
+        sids = batch.sids
+
+        keep = []
+        lastAggregation = None
+        wrap = None
+        inline = False
+
+        for i, aggregation in enumerate(batch.aggregations):
+            if not aggregation:
+                keep.append(i)
+                continue
+
+            sid = sids[i]
+            thisM = metrics[i]
+            thisTime = times[i]
+
+            slot = slots.get(sid)
+            if slot is None:
+                self._insert(sid, thisM, thisTime, deadline)
+                continue
+
+            lastM = lastMetrics[slot]
+            tDelta = thisTime - lastTimes[slot]
+
+            lastMetrics[slot] = thisM
+            lastTimes[slot] = thisTime
+            deadlines[slot] = deadline
+
+            if aggregation is not lastAggregation:
+                lastAggregation = aggregation
+                inline = aggregation in COUNTER_WRAPS
+                wrap = COUNTER_WRAPS.get(aggregation)
+
+            if inline:
+                if tDelta <= 0:
+                    continue
+                if thisM < lastM:
+                    if wrap is None:
+                        continue
+                    metric = (wrap - lastM + thisM) / float(tDelta)
+                else:
+                    metric = (thisM - lastM) / float(tDelta)
+            else:
+                metric = aggregation(lastM, thisM, tDelta)
+
+            if metric:
+                metrics[i] = metric
+                keep.append(i)
+
+        return keep
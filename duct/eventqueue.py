@@ -0,0 +1,179 @@
+"""
+.. module:: eventqueue
+   :synopsis: Bounded output queue with load shedding policies
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import random
+
+from collections import deque
+
+# Overflow policies understood by EventQueue
+POLICIES = ('drop-newest', 'drop-oldest', 'latest', 'sample')
+
+
+class EventQueue(object):
+    """FIFO queue of events waiting for an output, backed by a deque so
+    adding and removing events is O(1) however large the backlog is
+
+    When `maxsize` is set, events which don't fit are shed according to
+    `policy`:
+
+    * **drop-newest**: Incoming events which don't fit are discarded
+    * **drop-oldest**: The oldest queued events are discarded to make room
+    * **latest**: An incoming event replaces the queued event for the same
+      host and service, so only the latest value of each series is kept.
+      Events for series which aren't queued are discarded
+    * **sample**: Once the queue is `sampleFrom` full, incoming events are
+      discarded with a probability which rises to 1 as it reaches `maxsize`
+
+    :param maxsize: Maximum number of queued events, 0 for no limit
+    :type maxsize: int.
+    :param policy: Overflow policy (default: drop-newest)
+    :type policy: str.
+    :param sampleFrom: Fraction of `maxsize` at which sampling starts
+    :type sampleFrom: float.
+    """
+    def __init__(self, maxsize=0, policy='drop-newest', sampleFrom=0.8):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy %r, expected one of %s"
+                             % (policy, ', '.join(POLICIES)))
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sampleFrom = sampleFrom
+
+        # With the latest policy the queue holds [event] slots, which are
+        # indexed by series so a newer event can replace the queued one
+        self.queue = deque()
+        self.slots = {}
+
+        self.shed = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        if self.policy == 'latest':
+            return (slot[0] for slot in self.queue)
+        return iter(self.queue)
+
+    def extend(self, events):
+        """Add `events` to the back of the queue, shedding any which don't
+        fit. Returns the number of events added, and the number of queued
+        events evicted from the front to make room
+        """
+        if self.policy == 'latest':
+            return self._extendLatest(events), 0
+
+        queue = self.queue
+        maxsize = self.maxsize
+        count = len(events)
+
+        if (maxsize <= 0) or (len(queue) + count <= maxsize):
+            queue.extend(events)
+            return count, 0
+
+        if self.policy == 'drop-oldest':
+            queue.extend(events)
+            evicted = len(queue) - maxsize
+            for _ in range(evicted):
+                queue.popleft()
+            self.shed += evicted
+            return count, evicted
+
+        if self.policy == 'sample':
+            return self._extendSample(events), 0
+
+        space = max(0, maxsize - len(queue))
+        if space:
+            queue.extend(events[:space])
+        self.shed += count - space
+        return space, 0
+
+    def _extendLatest(self, events):
+        queue = self.queue
+        slots = self.slots
+        maxsize = self.maxsize
+        added = 0
+
+        for event in events:
+            key = (event.hostname, event.service)
+            if (maxsize > 0) and (len(queue) >= maxsize):
+                slot = slots.get(key)
+                if slot is not None:
+                    slot[0] = event
+                self.shed += 1
+                continue
+
+            slot = [event]
+            queue.append(slot)
+            slots[key] = slot
+            added += 1
+
+        return added
+
+    def _extendSample(self, events):
+        queue = self.queue
+        maxsize = self.maxsize
+        start = self.sampleFrom * maxsize
+        rand = random.random
+        added = 0
+
+        for event in events:
+            size = len(queue)
+            if (size >= maxsize) or ((size > start) and (
+                    rand() * (maxsize - start) < size - start)):
+                self.shed += 1
+            else:
+                queue.append(event)
+                added += 1
+
+        return added
+
+    def take(self, count=None):
+        """Remove and return a list of up to `count` events from the front
+        of the queue, or all of them if `count` is None or 0
+        """
+        queue = self.queue
+        if (not count) or (count >= len(queue)):
+            items = list(queue)
+            queue.clear()
+            if self.policy == 'latest':
+                self.slots.clear()
+                return [slot[0] for slot in items]
+            return items
+
+        popleft = queue.popleft
+        items = [popleft() for _ in range(count)]
+
+        if self.policy == 'latest':
+            slots = self.slots
+            events = []
+            for slot in items:
+                event = slot[0]
+                key = (event.hostname, event.service)
+                if slots.get(key) is slot:
+                    del slots[key]
+                events.append(event)
+            return events
+
+        return items
+
+    def expire(self, now):
+        """Discard events which are older than their TTL at `now`. Returns
+        the number of events discarded
+        """
+        size = len(self.queue)
+        events = [event for event in self
+                  if (now - event.time) <= event.ttl]
+
+        self.queue.clear()
+        self.slots.clear()
+        if self.policy == 'latest':
+            self._extendLatest(events)
+        else:
+            self.queue.extend(events)
+
+        return size - len(events)
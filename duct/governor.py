@@ -0,0 +1,158 @@
+"""
+.. module:: governor
+   :synopsis: Concurrency limits for source ticks
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import time
+
+from collections import deque
+
+from twisted.internet import defer
+
+
+class Governor(object):
+    """Limits how many source ticks may run at once
+
+    Each source belongs to a resource class given by its `resource` attribute
+    or configuration (for example `fork`, `http` or `snmp`), and sources using
+    SSH are limited per remote host. A tick has to acquire a slot under both
+    the global limit and the limit for its class before it runs. Waiting ticks
+    are queued per source and served round-robin, so one busy source can't
+    starve the others.
+
+    :param limit: Maximum ticks in flight across all sources, 0 for no limit
+    :type limit: int.
+    :param limits: Dictionary of resource class to maximum ticks in flight.
+                   The `ssh` limit applies to each host separately
+    :type limits: dict.
+    """
+    def __init__(self, limit=0, limits=None):
+        self.limit = int(limit)
+        self.limits = dict((key, int(val))
+                           for key, val in (limits or {}).items())
+
+        self.inflight = 0
+        self.classInflight = {}
+
+        # Waiting ticks per source, and the round-robin order of sources
+        self.queues = {}
+        self.order = deque()
+        self.queued = 0
+
+        self.waits = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+
+    def _available(self, key):
+        if self.limit and (self.inflight >= self.limit):
+            return False
+
+        limit = self.limits.get(key[0])
+        if limit and (self.classInflight.get(key, 0) >= limit):
+            return False
+
+        return True
+
+    def _grant(self, key, queuedAt=None):
+        self.inflight += 1
+        self.classInflight[key] = self.classInflight.get(key, 0) + 1
+
+        if queuedAt is not None:
+            wait = time.time() - queuedAt
+            self.waits += 1
+            self.waitTotal += wait
+            if wait > self.waitMax:
+                self.waitMax = wait
+
+    def acquire(self, source, key):
+        """Return a Deferred which fires once `source` may run a tick using
+        resource `key`, a tuple of (class, host)
+        """
+        if (source not in self.queues) and self._available(key):
+            self._grant(key)
+            return defer.succeed(None)
+
+        waiter = [None, key, time.time()]
+        d = defer.Deferred(lambda _: self._cancel(source, waiter))
+        waiter[0] = d
+
+        queue = self.queues.get(source)
+        if queue is None:
+            queue = self.queues[source] = deque()
+            self.order.append(source)
+        queue.append(waiter)
+        self.queued += 1
+
+        return d
+
+    def _cancel(self, source, waiter):
+        queue = self.queues.get(source)
+        if queue and (waiter in queue):
+            queue.remove(waiter)
+            self.queued -= 1
+            if not queue:
+                del self.queues[source]
+                self.order.remove(source)
+
+    def release(self, key):
+        """Release a slot held for resource `key`
+        """
+        self.inflight -= 1
+        count = self.classInflight[key] - 1
+        if count:
+            self.classInflight[key] = count
+        else:
+            del self.classInflight[key]
+
+        self._dispatch()
+
+    def _dispatch(self):
+        # Offer free slots to each waiting source in turn, until a full pass
+        # over the queue grants nothing
+        skipped = 0
+        while self.order and (skipped < len(self.order)):
+            if self.limit and (self.inflight >= self.limit):
+                break
+
+            source = self.order.popleft()
+            queue = self.queues[source]
+            d, key, queuedAt = queue[0]
+
+            if self._available(key):
+                queue.popleft()
+                self.queued -= 1
+                if queue:
+                    self.order.append(source)
+                else:
+                    del self.queues[source]
+                skipped = 0
+
+                self._grant(key, queuedAt)
+                d.callback(None)
+            else:
+                self.order.append(source)
+                skipped += 1
+
+    def classes(self):
+        """Return a dictionary of resource class to ticks in flight
+        """
+        counts = {}
+        for key, count in self.classInflight.items():
+            if key[0]:
+                counts[key[0]] = counts.get(key[0], 0) + count
+        return counts
+
+    def resetWaits(self):
+        """Return (mean wait, max wait) for ticks which had to queue since
+        the last call, and reset them
+        """
+        mean = (self.waitTotal / self.waits) if self.waits else 0.0
+        result = (mean, self.waitMax)
+
+        self.waits = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+
+        return result
@@ -0,0 +1,148 @@
+"""
+.. module:: monitor
+   :synopsis: Reactor lag monitor and slow callback detection
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import sys
+import threading
+import time
+
+from twisted.internet import task, reactor
+
+from duct.objects import Source, Output
+from duct.stats import Histogram
+
+
+def ownerName(owner):
+    """Return a name for a Source or Output which ran a slow callback
+    """
+    if isinstance(owner, Source):
+        return 'source.%s' % owner.config['service']
+    if isinstance(owner, Output):
+        return 'output.%s' % owner.name
+    return 'other'
+
+def findOwner(frame):
+    """Walk up the stack from `frame` and return the first Source or Output
+    which has a method on it, or None
+    """
+    while frame is not None:
+        owner = frame.f_locals.get('self')
+        if isinstance(owner, (Source, Output)):
+            return owner
+        frame = frame.f_back
+    return None
+
+class ReactorMonitor(object):
+    """Measures how late the reactor runs timers, and which sources and
+    outputs are responsible for blocking it
+
+    A timer fires every `interval` seconds and records how late it ran. If
+    `sample` is set, a thread checks whether the reactor has been blocked for
+    longer than `threshold` and inspects the reactor thread's stack to find
+    the source or output it is running, so blocking anywhere in their
+    callbacks is attributed to them. Otherwise only the calls which the
+    service times directly, source ticks and output deliveries, are
+    attributed.
+
+    :param interval: Seconds between lag measurements (default: 0.1)
+    :type interval: float.
+    :param threshold: Calls which block for longer than this many seconds
+                      are attributed to their owner (default: 0.05)
+    :type threshold: float.
+    :param sample: Sample the reactor stack from a thread (default: False)
+    :type sample: bool.
+    """
+    def __init__(self, interval=0.1, threshold=0.05, sample=False):
+        self.interval = interval
+        self.threshold = threshold
+        self.sample = sample
+
+        self.lag = Histogram()
+        self.offenders = {}
+        self.stalls = 0
+
+        self.heartbeat = None
+        self.timer = task.LoopingCall(self.beat)
+        self.thread = None
+        self.threadId = None
+        self.running = False
+
+    def start(self):
+        """Start measuring lag
+        """
+        self.running = True
+        self.heartbeat = time.time()
+        self.timer.start(self.interval, now=False)
+
+        if self.sample:
+            self.threadId = threading.current_thread().ident
+            self.thread = threading.Thread(target=self.sampler,
+                                           name='duct-monitor')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stop measuring lag, and wait for the sampling thread to finish
+        """
+        self.running = False
+        if self.timer.running:
+            self.timer.stop()
+
+        if self.thread is not None:
+            # It wakes up at least every threshold/2 seconds to check
+            self.thread.join(max(1.0, self.threshold))
+            self.thread = None
+
+    def beat(self):
+        """Called by the timer to record lag
+        """
+        now = time.time()
+        lag = max(0.0, now - self.heartbeat - self.interval)
+        self.lag.record(lag)
+        if lag > self.threshold:
+            self.stalls += 1
+        self.heartbeat = now
+
+    def callFinished(self, owner, duration):
+        """Called with the time taken by a call into `owner` which the
+        service timed directly
+        """
+        if (duration > self.threshold) and not self.sample:
+            self.slowCall(owner, duration)
+
+    def slowCall(self, owner, duration):
+        """Blame `owner` for blocking the reactor for `duration` seconds
+        """
+        name = ownerName(owner)
+        self.offenders[name] = self.offenders.get(name, 0.0) + duration
+
+    def sampler(self):
+        """Thread which samples the reactor stack while it is blocked
+        """
+        period = self.threshold / 2.0
+        while self.running:
+            time.sleep(period)
+
+            blocked = time.time() - self.heartbeat - self.interval
+            if blocked < self.threshold:
+                continue
+
+            # pylint: disable=W0212
+            frame = sys._current_frames().get(self.threadId)
+            owner = findOwner(frame)
+            del frame
+
+            if owner is not None:
+                # Recorded once the reactor is free again
+                reactor.callFromThread(self.slowCall, owner, period)
+
+    def worst(self, count=5):
+        """Return the `count` owners which blocked the reactor for longest as
+        (name, seconds) pairs, and reset the totals
+        """
+        offenders = sorted(self.offenders.items(), key=lambda item: -item[1])
+        self.offenders = {}
+        return offenders[:count]
@@ -6,18 +6,68 @@
 """
 
 import hashlib
+import json
 import time
-import socket
 import traceback
 
-from twisted.internet import task, defer
+from collections import deque
+
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+from twisted.internet import task, defer, reactor
 from twisted.python import log
 
-from duct.utils import fork
+from duct.utils import fork, getFQDN
 from duct.protocol import ssh
+from duct.eventqueue import EventQueue
+from duct.spool import Spool
+from duct.stats import Timings
+
+
+class EventMixin(object):
+    """Methods shared by :class:`Event` and :class:`EventRow`
+    """
+    __slots__ = ()
+
+    def eid(self):
+        """Return a unique identifier for this event
+        """
+        return self.hostname + '.' + self.service
 
+    def __repr__(self):
+        ser = ['%s=%s' % (key, repr(val)) for key, val in dict(self).items()]
 
-class Event(object):
+        return "<Event %s>" % (', '.join(ser))
+
+    def __iter__(self):
+        obj = {
+            'hostname': self.hostname,
+            'state': self.state,
+            'service': self.service,
+            'metric': self.metric,
+            'ttl': self.ttl,
+            'tags': self.tags,
+            'time': self.time,
+            'type': self.evtype,
+            'description': self.description,
+        }
+
+        if self.attributes:
+            obj['attributes'] = self.attributes
+
+        for key, val in obj.items():
+            yield key, val
+
+    def copyWithMetric(self, metric):
+        """Create a copy of this event with a different metric value
+        """
+        return Event(self.state, self.service, self.description, metric,
+                     self.ttl, self.tags, self.hostname, self.aggregation)
+
+class Event(EventMixin):
     """Duct Event object
 
     All sources pass these to the queue, which form a proxy object
@@ -34,6 +84,9 @@ class Event(object):
     :param attributes: A dictionary of key/value attributes for this event
     :param evtime: Event timestamp override
     """
+    __slots__ = ('state', 'service', 'description', 'metric', 'ttl', 'tags',
+                 'attributes', 'aggregation', 'evtype', 'time', 'hostname')
+
     def __init__(
             self,
             state,
@@ -64,42 +117,276 @@ class Event(object):
         if hostname:
             self.hostname = hostname
         else:
-            self.hostname = socket.gethostbyaddr(socket.gethostname())[0]
+            self.hostname = getFQDN()
 
-    def eid(self):
-        """Return a unique identifier for this event
+def _intern(val):
+    if type(val) is str:
+        return intern(val)
+    return val
+
+def _column(name):
+    def getter(self):
+        return getattr(self.batch, name)[self.index]
+
+    def setter(self, val):
+        getattr(self.batch, name)[self.index] = val
+
+    return property(getter, setter)
+
+class EventRow(EventMixin):
+    """A view of a single row in an :class:`EventBatch` which behaves like an
+    :class:`Event`. Setting an attribute writes through to the batch.
+    """
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    state = _column('states')
+    service = _column('services')
+    description = _column('descriptions')
+    metric = _column('metrics')
+    ttl = _column('ttls')
+    tags = _column('tags')
+    attributes = _column('attributes')
+    aggregation = _column('aggregations')
+    evtype = _column('evtypes')
+    time = _column('times')
+    hostname = _column('hostnames')
+
+class EventBatch(object):
+    """A list of events stored as parallel columns
+
+    Sources may return one of these instead of a list of :class:`Event`
+    objects, and it is what `DuctService` hands to outputs. Iterating or
+    indexing a batch gives :class:`EventRow` views, so code written for lists
+    of events keeps working, while outputs which understand batches can read
+    the columns directly. Host, service, state and type strings are interned.
+
+    `sids` holds the :class:`duct.series.SeriesRegistry` id of each row once
+    the batch has passed through `DuctService`, and is None before that.
+
+    `encoded` holds a dictionary for each row when the batch is routed to
+    more than one output with the same `serialization`, in which outputs
+    share the serialized forms of the row through :meth:`serialize`. The dictionaries are carried by
+    reference into batches made from this one, so an event queued for
+    several outputs is only serialized once for each format.
+    """
+    columns = ('states', 'services', 'descriptions', 'metrics', 'ttls',
+               'tags', 'attributes', 'aggregations', 'evtypes', 'times',
+               'hostnames')
+
+    __slots__ = columns + ('sids', 'encoded')
+
+    def __init__(self):
+        self.states = []
+        self.services = []
+        self.descriptions = []
+        self.metrics = []
+        self.ttls = []
+        self.tags = []
+        self.attributes = []
+        self.aggregations = []
+        self.evtypes = []
+        self.times = []
+        self.hostnames = []
+
+        self.sids = None
+        self.encoded = None
+
+    @classmethod
+    def fromEvents(cls, events):
+        """Return `events` as an :class:`EventBatch`
+
+        `events` may already be a batch, in which case it is returned as is,
+        a single event or a list of events. Runs of consecutive rows from the
+        same batch are copied a column slice at a time.
         """
-        return self.hostname + '.' + self.service
+        if isinstance(events, EventBatch):
+            return events
 
-    def __repr__(self):
-        ser = ['%s=%s' % (key, repr(val)) for key, val in dict(self).items()]
+        batch = cls()
 
-        return "<Event %s>" % (', '.join(ser))
+        if isinstance(events, EventMixin):
+            batch.addEvent(events)
+            return batch
 
-    def __iter__(self):
-        obj = {
-            'hostname': self.hostname,
-            'state': self.state,
-            'service': self.service,
-            'metric': self.metric,
-            'ttl': self.ttl,
-            'tags': self.tags,
-            'time': self.time,
-            'type': self.evtype,
-            'description': self.description,
-        }
+        run, start, end = None, 0, 0
+        for ev in events:
+            if isinstance(ev, EventRow):
+                if (ev.batch is run) and (ev.index == end):
+                    end += 1
+                    continue
 
-        if self.attributes:
-            obj['attributes'] = self.attributes
+                if run is not None:
+                    batch.extend(run, start, end)
 
-        for key, val in obj.items():
-            yield key, val
+                run, start, end = ev.batch, ev.index, ev.index + 1
+            else:
+                if run is not None:
+                    batch.extend(run, start, end)
+                    run = None
+                batch.addEvent(ev)
 
-    def copyWithMetric(self, metric):
-        """Create a copy of this event with a different metric value
+        if run is not None:
+            batch.extend(run, start, end)
+
+        return batch
+
+    def append(self, state, service, description, metric, ttl, tags=None,
+               hostname=None, aggregation=None, evtime=None, attributes=None,
+               evtype='metric'):
+        """Add an event to the batch. Arguments are the same as
+        :class:`Event`
         """
-        return Event(self.state, self.service, self.description, metric,
-                     self.ttl, self.tags, self.hostname, self.aggregation)
+        self.sids = None
+        self.encoded = None
+
+        self.states.append(_intern(state))
+        self.services.append(_intern(service))
+        self.descriptions.append(description)
+        self.metrics.append(metric)
+        self.ttls.append(ttl)
+        self.tags.append(tags if tags is not None else [])
+        self.attributes.append(attributes)
+        self.aggregations.append(aggregation)
+        self.evtypes.append(_intern(evtype))
+        self.times.append(evtime or time.time())
+        self.hostnames.append(_intern(hostname or getFQDN()))
+
+    def addEvent(self, event):
+        """Add an :class:`Event` (or anything which looks like one)
+        """
+        self.append(event.state, event.service, event.description,
+                    event.metric, event.ttl, event.tags, event.hostname,
+                    event.aggregation, event.time, event.attributes,
+                    event.evtype)
+
+    def extend(self, events, start=0, end=None):
+        """Add events from another batch (optionally only rows `start` to
+        `end`) or from a list of events
+        """
+        if isinstance(events, EventBatch):
+            if (events.sids is not None) and (
+                    (self.sids is not None) or not self.services):
+                if self.sids is None:
+                    self.sids = []
+                self.sids.extend(events.sids[start:end])
+            else:
+                self.sids = None
+
+            if (events.encoded is not None) and (
+                    (self.encoded is not None) or not self.services):
+                if self.encoded is None:
+                    self.encoded = []
+                self.encoded.extend(events.encoded[start:end])
+            else:
+                self.encoded = None
+
+            for column in self.columns:
+                getattr(self, column).extend(
+                    getattr(events, column)[start:end])
+        else:
+            self.sids = None
+            self.encoded = None
+            for ev in events:
+                self.addEvent(ev)
+
+    def encode(self):
+        """Encode the batch as JSON. Aggregation functions aren't kept, so
+        this is only used for batches which have been aggregated
+        """
+        return json.dumps(dict(
+            (column, getattr(self, column)) for column in self.columns
+            if column != 'aggregations')).encode()
+
+    @classmethod
+    def decode(cls, data):
+        """Decode a batch encoded with :meth:`encode`
+        """
+        message = json.loads(data.decode())
+
+        batch = cls()
+        for column in cls.columns:
+            if column != 'aggregations':
+                setattr(batch, column, message[column])
+        batch.aggregations = [None] * len(batch.services)
+
+        return batch
+
+    def select(self, indices):
+        """Return a new batch containing only the rows in `indices`
+        """
+        batch = EventBatch()
+        for column in self.columns:
+            values = getattr(self, column)
+            setattr(batch, column, [values[i] for i in indices])
+
+        if self.sids is not None:
+            batch.sids = [self.sids[i] for i in indices]
+        if self.encoded is not None:
+            batch.encoded = [self.encoded[i] for i in indices]
+        return batch
+
+    def shareEncodings(self):
+        """Start sharing serialized rows between the outputs this batch is
+        sent to
+        """
+        self.encoded = [{} for _ in self.services]
+
+    def serialize(self, key, encode, rows=None):
+        """Return `encode(i)` for each row index `i` in `rows` (by default
+        every row), reusing any results stored under `key` by another output
+        which serialized the same events. `key` must identify the wire
+        format along with any output options which change it
+        """
+        if rows is None:
+            rows = range(len(self.services))
+
+        encoded = self.encoded
+        if encoded is None:
+            return [encode(i) for i in rows]
+
+        values = []
+        for i in rows:
+            cache = encoded[i]
+            value = cache.get(key)
+            if value is None:
+                value = cache[key] = encode(i)
+            values.append(value)
+
+        return values
+
+    def __len__(self):
+        return len(self.services)
+
+    def __iter__(self):
+        for i in range(len(self.services)):
+            yield EventRow(self, i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            batch = EventBatch()
+            for column in self.columns:
+                setattr(batch, column, getattr(self, column)[index])
+
+            if self.sids is not None:
+                batch.sids = self.sids[index]
+            if self.encoded is not None:
+                batch.encoded = self.encoded[index]
+            return batch
+
+        size = len(self.services)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('EventBatch index out of range')
+
+        return EventRow(self, index)
+
+    def __repr__(self):
+        return "<EventBatch %s events>" % len(self)
 
 class Output(object):
     """Output parent class
@@ -107,16 +394,67 @@ class Output(object):
     Outputs can inherit this object which provides a construct
     for a working output
 
+    Events wait in `self.events`, an :class:`duct.eventqueue.EventQueue`.
+    Once it holds `maxsize` events, the `overflow` option chooses which events
+    are shed: `drop-newest` (the default), `drop-oldest`, `latest` or
+    `sample`. If `spool` is set to a directory, events which don't fit are
+    written to a :class:`duct.spool.Spool` there instead, and replayed at up
+    to `spool_rate` events per second once the queue drains below its low
+    watermark.
+
+    Outputs which serialize events with :meth:`EventBatch.serialize` set
+    `serialization` to the key they use, so the service only shares
+    serialized events between outputs on a route which can reuse them.
+
     :param config: Dictionary config for this queue (usually read from the
              yaml configuration)
     :param duct: A DuctService object for interacting with the queue manager
     """
+    serialization = None
+
     def __init__(self, config, duct):
         self.config = config
         self.duct = duct
-        self.events = []
+
+        self.name = config.get('name') or self.__class__.__name__
+
+        # Time spent queued and encoding, and bytes written by this output
+        self.timings = Timings()
+        self.bytesSent = 0
+        self.queueMarks = deque()
+
+        # Queue sizes, as fractions of maxsize, at which the service is told
+        # to hold back the sources routed here and to release them again
+        self.highWatermark = float(config.get('high_watermark', 0.8))
+        self.lowWatermark = float(config.get('low_watermark', 0.5))
+        self.pressured = False
+
+        self.events = EventQueue(policy=config.get('overflow', 'drop-newest'),
+                                 sampleFrom=self.highWatermark)
         self.maxsize = 0
 
+        self.spool = None
+        self.spoolTimer = None
+        self.replayBuffer = None
+        self.spoolRate = int(config.get('spool_rate', 1000))
+        self.spooled = 0
+        self.replayed = 0
+        if config.get('spool'):
+            self.spool = Spool(
+                config['spool'],
+                maxBytes=int(config.get('spool_size', 1 << 30)),
+                segmentSize=int(config.get('spool_segment', 64 << 20)))
+
+    @property
+    def maxsize(self):
+        """Maximum number of queued events, 0 for no limit
+        """
+        return self.events.maxsize
+
+    @maxsize.setter
+    def maxsize(self, value):
+        self.events.maxsize = value
+
     def createClient(self):
         """Deferred which sets up the output
         """
@@ -126,14 +464,161 @@ class Output(object):
         """Receives a list of events and queues them
 
         Arguments:
-        events -- list of `duct.objects.Event`
+        events -- `duct.objects.EventBatch` or list of `duct.objects.Event`
+        """
+        if self.spool is not None:
+            events = self.spoolOverflow(events)
+
+        added, evicted = self.events.extend(events)
+        if added:
+            self.markQueued(added)
+
+        # Events evicted from the front to make room were never sent
+        self.markDequeued(evicted, record=False)
+
+    def spoolOverflow(self, events):
+        """Write the events which don't fit in the queue to the spool, and
+        return the rest
+        """
+        space = self.maxsize - len(self.events)
+        if (self.maxsize <= 0) or (len(events) <= space):
+            return events
+
+        batch = EventBatch.fromEvents(events)
+        space = max(0, space)
+        self.spoolEvents(batch[space:])
+        return batch[:space]
+
+    def spoolEvents(self, events):
+        """Write `events` to the spool
+        """
+        self.spool.append(EventBatch.fromEvents(events).encode())
+        self.spooled += len(events)
+
+    def startSpool(self):
+        """Start replaying the spool, if there is one
         """
-        # Make sure queue isn't oversized
+        if self.spool is not None:
+            self.spoolTimer = task.LoopingCall(self.replaySpool)
+            self.spoolTimer.start(1.0)
+
+    def replaySpool(self):
+        """Move up to `spool_rate` events from the spool to the queue while
+        the queue is below its low watermark, so a backlog drains without
+        crowding out new events
+        """
+        budget = self.spoolRate
         if self.maxsize > 0:
-            if (self.maxsize < 1) or (len(self.events) < self.maxsize):
-                self.events.extend(events)
+            budget = min(budget, int(self.lowWatermark * self.maxsize) -
+                         len(self.events))
+
+        replayed = 0
+        while replayed < budget:
+            # Records can hold more events than the budget, so the rest of
+            # the last one read waits in the replay buffer
+            batch = self.replayBuffer
+            if batch is None:
+                data = self.spool.read()
+                if data is None:
+                    break
+                batch = EventBatch.decode(data)
+
+            count = min(len(batch), budget - replayed)
+            if count < len(batch):
+                self.replayBuffer = batch[count:]
+                batch = batch[:count]
+            else:
+                self.replayBuffer = None
+
+            added, evicted = self.events.extend(batch)
+            self.markQueued(added)
+            self.markDequeued(evicted, record=False)
+            replayed += count
+
+        if replayed:
+            self.replayed += replayed
+            # A partly replayed record is read again after a crash
+            if self.replayBuffer is None:
+                self.spool.commit()
+        self.spool.sync()
+
+    def stopSpool(self):
+        """Stop replaying, and write anything left in the queue to the spool
+        so it survives a restart
+        """
+        if self.spool is None:
+            return
+
+        if self.spoolTimer and self.spoolTimer.running:
+            self.spoolTimer.stop()
+
+        events = self.events.take()
+        self.markDequeued(len(events), record=False)
+
+        if self.replayBuffer is not None:
+            events = EventBatch.fromEvents(events)
+            events.extend(self.replayBuffer, 0, len(self.replayBuffer))
+            self.replayBuffer = None
+
+        if events:
+            self.spoolEvents(events)
+
+        self.spool.commit()
+        self.spool.close()
+
+    def queueSize(self):
+        """Number of events waiting in the queue
+        """
+        return len(self.events)
+
+    def checkPressure(self):
+        """Tell the service when the queue rises past its high watermark or
+        drains below its low watermark. Does nothing without a maxsize.
+        Spooled outputs aren't backed up until the spool is full as well
+        """
+        if self.maxsize <= 0:
+            return
+
+        size = self.queueSize()
+        if (self.spool is not None) and self.spool.hasRoom():
+            pressured = False
+        elif self.pressured:
+            pressured = size > self.lowWatermark * self.maxsize
         else:
-            self.events.extend(events)
+            pressured = size >= self.highWatermark * self.maxsize
+
+        if pressured == self.pressured:
+            return
+
+        self.pressured = pressured
+
+        outputPressure = getattr(self.duct, 'outputPressure', None)
+        if outputPressure is not None:
+            outputPressure(self, self.pressured)
+
+    def markQueued(self, count):
+        """Note that `count` events were added to the end of the queue
+        """
+        self.queueMarks.append([time.time(), count])
+
+    def markDequeued(self, count, record=True):
+        """Record how long the `count` events taken from the front of the
+        queue were waiting, unless `record` is False
+        """
+        now = time.time()
+        marks = self.queueMarks
+        while (count > 0) and marks:
+            mark = marks[0]
+            if record:
+                self.timings.record('queue', now - mark[0])
+            if mark[1] <= count:
+                count -= mark[1]
+                marks.popleft()
+            else:
+                mark[1] -= count
+                count = 0
+
+        self.checkPressure()
 
     def stop(self):
         """Called when the service shuts down
@@ -154,10 +639,16 @@ class Source(object):
 
     sync = False
     ssh = False
+    worker = True
+    serviceNameCacheSize = 10000
+
+    # Resource class used to limit concurrent ticks, eg. 'fork' or 'http'
+    resource = None
 
     def __init__(self, config, queueBack, duct):
         self.config = config
         self.duct = duct
+        self.serviceNames = {}
 
         self.timer = task.LoopingCall(self.tick)
         self.timerDeferred = None
@@ -167,6 +658,24 @@ class Source(object):
         self.inter = float(config.get('interval', duct.inter))
         self.ttl = float(config.get('ttl', duct.ttl))
 
+        # Ticks which run longer than this many seconds are cancelled
+        self.deadline = float(config.get(
+            'deadline', duct.config.get('deadline', 0)) or 0)
+        self.timeouts = 0
+
+        # Time spent in each stage of the pipeline for this source
+        self.timings = Timings()
+
+        # Set by the service while an output this source routes to is backed
+        # up. Slowed sources only run every `backpressure_slowdown` ticks
+        self.backpressure = None
+        self.slowdown = max(1, int(config.get(
+            'backpressure_slowdown',
+            duct.config.get('backpressure_slowdown', 4))))
+        self.pressureTicks = 0
+        self.pressureSkipped = 0
+        self.pressureSampled = 0
+
         if 'tags' in config:
             self.tags = [tag.strip() for tag in config['tags'].split(',')]
         else:
@@ -178,12 +687,15 @@ class Source(object):
 
         self.hostname = config.get('hostname')
         if self.hostname is None:
-            self.hostname = socket.gethostbyaddr(socket.gethostname())[0]
+            self.hostname = getFQDN()
 
         self.use_ssh = config.get('use_ssh', False)
 
         if self.use_ssh:
             self._init_ssh()
+            self.resourceKey = ('ssh', self.ssh_host)
+        else:
+            self.resourceKey = (config.get('resource', self.resource), None)
 
         self.queueBack = self._queueBack(queueBack)
 
@@ -269,7 +781,11 @@ class Source(object):
         """Starts the timer for this source"""
         yield defer.maybeDeferred(self.start)
 
-        self.timerDeferred = self.timer.start(self.inter)
+        scheduler = getattr(self.duct, 'scheduler', None)
+        if scheduler is not None:
+            scheduler.add(self)
+        else:
+            self.timerDeferred = self.timer.start(self.inter)
 
         if self.use_ssh and self.ssh_connector:
             yield defer.maybeDeferred(self.ssh_client.connect)
@@ -283,10 +799,39 @@ class Source(object):
     def stopTimer(self):
         """Stops the timer for this source"""
         self.timerDeferred = None
+        scheduler = getattr(self.duct, 'scheduler', None)
+        if scheduler is not None:
+            scheduler.remove(self)
         if self.timer.running:
             self.timer.stop()
         return defer.maybeDeferred(self.stop)
 
+    def applyBackpressure(self, mode):
+        """Called by the service with `pause`, `slow` or `sample` when an
+        output this source routes to is backed up, and with None once it
+        has drained
+        """
+        previous = self.backpressure
+        self.backpressure = mode
+        self.pressureTicks = 0
+
+        if (mode == 'pause') and (previous != 'pause'):
+            self.pauseProducing()
+        elif (previous == 'pause') and (mode != 'pause'):
+            self.resumeProducing()
+
+    def pauseProducing(self):
+        """Stop producing events while paused by backpressure. Timed sources
+        skip their ticks, sources which receive events from the network
+        override this to stop reading from their transports
+        """
+        pass
+
+    def resumeProducing(self):
+        """Start producing events again once backpressure is released
+        """
+        pass
+
     def fork(self, *a, **kw):
         """Wrapper function to execute another process
 
@@ -300,11 +845,19 @@ class Source(object):
 
     @defer.inlineCallbacks
     def _get(self):
-        if self.use_ssh and not self.ssh:
-            event = yield defer.maybeDeferred(self.sshGet)
+        governor = getattr(self.duct, 'governor', None)
+        if governor is not None:
+            yield governor.acquire(self, self.resourceKey)
 
-        else:
-            event = yield defer.maybeDeferred(self.get)
+        try:
+            if self.use_ssh and not self.ssh:
+                event = yield defer.maybeDeferred(self.sshGet)
+
+            else:
+                event = yield defer.maybeDeferred(self.get)
+        finally:
+            if governor is not None:
+                governor.release(self.resourceKey)
 
         if self.config.get('debug', False):
             log.msg("[%s] Tick: %s" % (self.config['service'], event))
@@ -322,13 +875,28 @@ class Source(object):
             if self.running:
                 defer.returnValue(None)
 
+        if self.backpressure in ('pause', 'slow'):
+            self.pressureTicks += 1
+            if (self.backpressure == 'pause') or (
+                    self.pressureTicks % self.slowdown):
+                self.pressureSkipped += 1
+                defer.returnValue(None)
+
         self.running = True
+        started = time.time()
 
         try:
-            event = yield self._get()
+            d = self._get()
+            if self.deadline:
+                d.addTimeout(self.deadline, reactor)
+
+            event = yield d
             if event:
                 self.queueBack(event)
 
+        except defer.TimeoutError:
+            self.tickTimedOut(time.time() - started)
+
         except Exception as ex:
             if self.duct.config.get('debug'):
                 tb_lines = traceback.format_exc().splitlines()
@@ -341,21 +909,62 @@ class Source(object):
             else:
                 log.msg("[%s] Unhandled error: %s" % (self.service, ex))
 
+        self.timings.record('tick', time.time() - started)
         self.running = False
 
+    def tickTimedOut(self, elapsed):
+        """Called when a tick was cancelled for exceeding its deadline.
+        Sends a critical `(service).timeout` event"""
+        self.timeouts += 1
+
+        log.msg("[%s] Tick cancelled after %.2fs deadline" % (
+            self.service, self.deadline))
+
+        self.queueBack([self.createEvent(
+            'critical', 'Tick exceeded %ss deadline' % self.deadline,
+            elapsed, prefix='timeout')])
+
+    def serviceName(self, prefix=None):
+        """Returns the service name for events with `prefix`. Names are
+        built once per prefix and cached, since most sources use the same
+        prefixes on every tick"""
+        if not prefix:
+            return self.service
+
+        service_name = self.serviceNames.get(prefix)
+        if service_name is None:
+            if len(self.serviceNames) >= self.serviceNameCacheSize:
+                self.serviceNames.clear()
+
+            service_name = _intern(self.service + "." + prefix)
+            self.serviceNames[prefix] = service_name
+
+        return service_name
+
     def createEvent(self, state, description, metric, prefix=None,
                     hostname=None, aggregation=None, evtime=None):
         """Creates an Event object from the Source configuration"""
-        if prefix:
-            service_name = self.service + "." + prefix
-        else:
-            service_name = self.service
+        service_name = self.serviceName(prefix)
 
         return Event(state, service_name, description, metric, self.ttl,
                      hostname=hostname or self.hostname,
                      aggregation=aggregation,
                      evtime=evtime, tags=self.tags, attributes=self.attributes)
 
+    def createBatch(self):
+        """Creates an empty EventBatch which can be filled with
+        `appendEvent` and returned from `get` in place of a list"""
+        return EventBatch()
+
+    def appendEvent(self, batch, state, description, metric, prefix=None,
+                    hostname=None, aggregation=None, evtime=None):
+        """Adds an event to `batch` from the Source configuration. Arguments
+        are the same as `createEvent`"""
+        batch.append(state, self.serviceName(prefix), description, metric,
+                     self.ttl, hostname=hostname or self.hostname,
+                     aggregation=aggregation,
+                     evtime=evtime, tags=self.tags, attributes=self.attributes)
+
     def createLog(self, evtype, data, evtime=None, hostname=None):
         """Creates an Event object from the Source configuration"""
 
@@ -365,7 +974,7 @@ class Source(object):
 
     def get(self):
         """Get method for source called every `self.inter`
-           Should return a list of `Event` objects or `None`
+           Should return a list of `Event` objects, an `EventBatch` or `None`
         """
         raise NotImplementedError()
 
@@ -23,6 +23,10 @@ class Bosun(opentsdb.OpenTSDB):
     :type url: str.
     :param maxsize: Maximum queue backlog size (default: 250000, 0 disables)
     :type maxsize: int.
+    :param overflow: Events to shed when the queue is full, `drop-newest`,
+                     `drop-oldest`, `latest` or `sample` (default:
+                     drop-newest)
+    :type overflow: str.
     :param maxrate: Maximum rate of documents added to index (default: 100)
     :type maxrate: int.
     :param interval: Queue check interval in seconds (default: 1.0)
@@ -5,13 +5,15 @@
 .. moduleauthor:: Colin Alston <colin@imcol.in>
 """
 import datetime
+import json
+import time
 
 from twisted.internet import defer, task
 from twisted.python import log
 
 from duct.protocol import elasticsearch
 
-from duct.objects import Output
+from duct.objects import Output, EventBatch
 
 
 class ElasticSearch(Output):
@@ -23,6 +25,10 @@ class ElasticSearch(Output):
     :type url: str
     :param maxsize: Maximum queue backlog size (default: 250000, 0 disables)
     :type maxsize: int
+    :param overflow: Events to shed when the queue is full, `drop-newest`,
+                     `drop-oldest`, `latest` or `sample` (default:
+                     drop-newest)
+    :type overflow: str
     :param maxrate: Maximum rate of documents added to index (default: 100)
     :type maxrate: int
     :param interval: Queue check interval in seconds (default: 1.0)
@@ -35,9 +41,10 @@ class ElasticSearch(Output):
                   (default: duct-%Y.%m.%d)
     :type index: str
     """
+    serialization = 'elasticsearch'
+
     def __init__(self, *a):
         Output.__init__(self, *a)
-        self.events = []
         self.timer = task.LoopingCall(self.tick)
 
         self.inter = float(self.config.get('interval', 1.0))  # tick interval
@@ -87,33 +94,74 @@ class ElasticSearch(Output):
 
         return data
 
+    def transformRow(self, batch, i):
+        """Transform row `i` of an EventBatch into an Elasticsearch document,
+        reading the batch columns directly
+        """
+        evtime = batch.times[i]
+        data = {
+            'hostname': batch.hostnames[i],
+            'state': batch.states[i],
+            'service': batch.services[i],
+            'metric': float(batch.metrics[i]),
+            'tags': batch.tags[i],
+            'time': evtime,
+            'type': batch.evtypes[i],
+            'description': batch.descriptions[i],
+            '@timestamp': datetime.datetime.utcfromtimestamp(
+                evtime).isoformat(),
+        }
+
+        attributes = batch.attributes[i]
+        if attributes:
+            data['attributes'] = attributes
+
+        return data
+
+    def transformBatch(self, batch):
+        """Transform an EventBatch into a list of Elasticsearch documents
+        """
+        return [self.transformRow(batch, i) for i in range(len(batch))]
+
     def sendEvents(self, events):
-        """Send events to Elasticsearch in bulk
+        """Send events to Elasticsearch in bulk. Documents are serialized
+        once for all the Elasticsearch outputs the events were sent to
         """
-        return self.client.bulkIndex([self.transformEvent(event)
-                                      for event in events])
+        batch = EventBatch.fromEvents(events)
+
+        def encode(i):
+            """Serialize row `i` of the batch as a document
+            """
+            return json.dumps(self.transformRow(batch, i))
+
+        documents = batch.serialize(self.serialization, encode)
+
+        return self.client.bulkIndexJson(zip(batch.evtypes, documents))
 
     @defer.inlineCallbacks
     def tick(self):
         """Clock tick called every self.inter
         """
         if self.events:
-            if self.queueDepth and (len(self.events) > self.queueDepth):
-                # Remove maximum of self.queueDepth items from queue
-                events = self.events[:self.queueDepth]
-                self.events = self.events[self.queueDepth:]
-            else:
-                events = self.events
-                self.events = []
+            # Remove a maximum of self.queueDepth events from the queue
+            events = self.events.take(self.queueDepth)
+
+            self.markDequeued(len(events))
 
             try:
-                result = yield self.sendEvents(events)
+                started = time.time()
+                sent = self.client.bytesSent
+                d = self.sendEvents(events)
+                self.timings.record('encode', time.time() - started)
+                self.bytesSent += self.client.bytesSent - sent
+
+                result = yield d
                 if result.get('errors', False):
                     log.msg(repr(result))
 
             except Exception as ex:
                 log.msg('Could not connect to elasticsearch ' + str(ex))
-                self.events.extend(events)
+                self.eventsReceived(events)
 
 # Backward compatibility stub
 ElasticSearchLog = ElasticSearch
@@ -6,7 +6,7 @@
 """
 from twisted.python import log
 
-from duct.objects import Output
+from duct.objects import Output, EventBatch
 
 
 class Logger(Output):
@@ -17,6 +17,8 @@ class Logger(Output):
     :param logfile: Logfile (default: Write to standard log)
     :type logfile: str
     """
+    serialization = 'repr'
+
     def __init__(self, *a, **kw):
         Output.__init__(self, *a, **kw)
         if self.config.get('logfile'):
@@ -31,8 +33,10 @@ class Logger(Output):
     def eventsReceived(self, events):
         """Log received events
         """
-        for ev in events:
+        batch = EventBatch.fromEvents(events)
+        for line in batch.serialize(self.serialization,
+                                    lambda i: repr(batch[i])):
             if self.logfile:
-                self.logfile.write(repr(ev) + '\n')
+                self.logfile.write(line + '\n')
             else:
-                log.msg(repr(ev))
+                log.msg(line)
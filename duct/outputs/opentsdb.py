@@ -4,10 +4,13 @@
 
 .. moduleauthor:: Colin Alston <colin@imcol.in>
 """
+import json
+import time
+
 from twisted.internet import defer, task
 from twisted.python import log
 
-from duct.objects import Output
+from duct.objects import Output, EventBatch
 from duct.protocol.opentsdb import OpenTSDBClient
 
 
@@ -20,6 +23,10 @@ class OpenTSDB(Output):
     :type url: str
     :param maxsize: Maximum queue backlog size (default: 250000, 0 disables)
     :type maxsize: int
+    :param overflow: Events to shed when the queue is full, `drop-newest`,
+                     `drop-oldest`, `latest` or `sample` (default:
+                     drop-newest)
+    :type overflow: str
     :param maxrate: Maximum rate of documents added to index (default: 100)
     :type maxrate: int
     :param interval: Queue check interval in seconds (default: 1.0)
@@ -31,9 +38,10 @@ class OpenTSDB(Output):
     :param debug: Log tracebacks from OpenTSDB
     :type debug: str
     """
+    serialization = 'opentsdb'
+
     def __init__(self, *a):
         Output.__init__(self, *a)
-        self.events = []
         self.timer = task.LoopingCall(self.tick)
 
         self.inter = float(self.config.get('interval', 1.0))  # tick interval
@@ -86,26 +94,67 @@ class OpenTSDB(Output):
                 data['tags'][key] = val
         return data
 
+    def transformRow(self, batch, i):
+        """Convert row `i` of an EventBatch into OpenTSDB format, reading the
+        batch columns directly
+        """
+        data = {
+            'timestamp': int(batch.times[i] * 1000),
+            'metric': batch.services[i].replace(' ', '_'),
+            'value': batch.metrics[i],
+            'tags': {
+                'host': batch.hostnames[i],
+                'state': batch.states[i],
+            }
+        }
+
+        tags = batch.tags[i]
+        if tags:
+            data['tags'] = ",".join(tags)
+
+        attributes = batch.attributes[i]
+        if attributes:
+            for key, val in attributes.items():
+                data['tags'][key] = val
+
+        return data
+
+    def transformBatch(self, batch):
+        """Convert an EventBatch into OpenTSDB format
+        """
+        return [self.transformRow(batch, i) for i in range(len(batch))]
+
     def sendEvents(self, events):
-        """Send events to OpenTSDB
+        """Send events to OpenTSDB. Points are serialized once for all the
+        OpenTSDB outputs the events were sent to
         """
-        return self.client.put([self.transformEvent(ev) for ev in events])
+        batch = EventBatch.fromEvents(events)
+
+        def encode(i):
+            """Serialize row `i` of the batch as a point
+            """
+            return json.dumps(self.transformRow(batch, i))
+
+        return self.client.putJson(batch.serialize(self.serialization, encode))
 
     @defer.inlineCallbacks
     def tick(self):
         """Clock tick called every self.inter
         """
         if self.events:
-            if self.queueDepth and (len(self.events) > self.queueDepth):
-                # Remove maximum of self.queueDepth items from queue
-                events = self.events[:self.queueDepth]
-                self.events = self.events[self.queueDepth:]
-            else:
-                events = self.events
-                self.events = []
+            # Remove a maximum of self.queueDepth events from the queue
+            events = self.events.take(self.queueDepth)
+
+            self.markDequeued(len(events))
 
             try:
-                result = yield self.sendEvents(events)
+                started = time.time()
+                sent = self.client.bytesSent
+                d = self.sendEvents(events)
+                self.timings.record('encode', time.time() - started)
+                self.bytesSent += self.client.bytesSent - sent
+
+                result = yield d
                 if result.get('errors'):
                     log.msg('OpenTSDB error: %s' % repr(result['errors']))
                 if result.get('error'):
@@ -116,4 +165,4 @@ class OpenTSDB(Output):
 
             except Exception as ex:
                 log.msg('Could not connect to OpenTSDB ' + str(ex))
-                self.events.extend(events)
+                self.eventsReceived(events)
@@ -14,7 +14,7 @@ from twisted.internet import reactor, endpoints
 from twisted.web.server import Site
 from twisted.web.resource import Resource
 
-from duct.objects import Output
+from duct.objects import Output, EventBatch
 
 from duct.utils import HTTPRequest
 
@@ -34,14 +34,18 @@ class PrometheusResource(Resource):
         return content
 
     def render_GET(self, request):
-        if request.path == "/" + self.output.metric_path:
-            return self.render_metrics()
+        path = request.path
+        if isinstance(path, bytes):
+            path = path.decode()
+
+        if path == "/" + self.output.metric_path:
+            return self.render_metrics().encode()
 
         body = """<html><head><title>Duct</title></head>
                   <body><h1>Duct</h1><p>"<a href="/%s">Metrics</a></p>
                   </body></html>""" % self.output.metric_path
 
-        return body
+        return body.encode()
 
 class Prometheus(Output):
     """Prometheus output
@@ -61,8 +65,14 @@ class Prometheus(Output):
         self.port = int(self.config.get('port', 9100))
         self.metric_path = self.config.get('metric_path', 'metrics')
         self.prefix = self.config.get('prefix', 'duct_')
+
+        # Sample names depend on the prefix, so only outputs with the same
+        # prefix can share them
+        self.serialization = 'prometheus.' + self.prefix
         
         self.metric_table = {}
+        self.metric_names = {}
+        self.generation = None
 
     def createClient(self):
         self.resource = PrometheusResource(self)
@@ -71,10 +81,34 @@ class Prometheus(Output):
         endpoint.listen(site)
 
     def eventsReceived(self, events):
-        for event in events:
-            metric_name = self.prefix + event.service.replace('.', '_')
-            if event.attributes:
+        events = EventBatch.fromEvents(events)
+        series = self.duct.series
+        sids = series.resolve(events)
+
+        # Forget the names of series the registry has retired
+        if series.generation != self.generation:
+            self.generation = series.generation
+            self.metric_names = dict(
+                (sid, name) for sid, name in self.metric_names.items()
+                if sid in series.keys)
+        metric_names = self.metric_names
+
+        def sampleName(i):
+            """Name and labels of the sample for row `i`
+            """
+            metric_name = metric_names.get(sids[i])
+            if metric_name is None:
+                metric_name = self.prefix + events.services[i].replace(
+                    '.', '_')
+                metric_names[sids[i]] = metric_name
+
+            attributes = events.attributes[i]
+            if attributes:
                 metric_name += "{%s}" % ','.join(
-                    ['%s=%s' % (k, v) for k, v in event.attributes.items()]
+                    ['%s=%s' % (k, v) for k, v in attributes.items()]
                 )
-            self.metric_table[metric_name] = event.metric
+            return metric_name
+
+        names = events.serialize(self.serialization, sampleName)
+        for metric_name, metric in zip(names, events.metrics):
+            self.metric_table[metric_name] = metric
@@ -4,6 +4,9 @@
 
 .. moduleauthor:: Colin Alston <colin@imcol.in>
 """
+import bisect
+import hashlib
+import os
 import time
 import random
 
@@ -19,7 +22,7 @@ except:
 
 from duct.protocol import riemann
 
-from duct.objects import Output
+from duct.objects import Output, EventBatch
 
 if SSL:
     class ClientTLSContext(ssl.ClientContextFactory):
@@ -38,9 +41,33 @@ if SSL:
             return ctx
 
 
+def hashKey(key):
+    """Position of `key` on a consistent hash ring
+    """
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
 class RiemannTCP(Output):
     """Riemann TCP output
 
+    Messages are pipelined, with up to `window` of them waiting for Riemann
+    to acknowledge them, and more are sent as soon as acknowledgements
+    arrive rather than once per `interval`. Each message holds about
+    `batch_bytes` of events. While acknowledgements come back close to the
+    shortest round trip time seen, the window opens by one message per
+    window of acknowledgements, and once it is fully open messages grow
+    instead. When round trips rise to twice the shortest Riemann is falling
+    behind, so the window and message size are halved. Events in messages
+    which were never acknowledged are queued again when the connection is
+    lost.
+
+    With `shard` enabled, `server` is a list and a connection is kept to
+    every server in it. Each event goes to a server chosen by consistent
+    hashing of its host and service, so a series always reaches the same
+    Riemann index. Each connection has its own queue, window and
+    backpressure. While a server is down its series move to the next server
+    on the hash ring, along with anything queued for it, and move back when
+    it recovers.
+
     **Configuration arguments:**
 
     :param server: Riemann server hostname (default: localhost)
@@ -50,14 +77,31 @@ class RiemannTCP(Output):
     :param failover: Enable server failover, in which case `server` may be a
                      list
     :type failover: bool.
+    :param shard: Send to every server in `server`, sharding events between
+                  them (default false)
+    :type shard: bool.
+    :param replicas: Points on the hash ring for each shard (default: 64)
+    :type replicas: int.
     :param maxrate: Maximum de-queue rate (0 is no limit)
     :type maxrate: int.
-    :param maxsize: Maximum queue size (0 is no limit, default is 250000)
+    :param maxsize: Maximum queue size of each connection (0 is no limit,
+                    default is 250000)
     :type maxsize: int.
+    :param overflow: Events to shed when the queue is full, `drop-newest`,
+                     `drop-oldest`, `latest` or `sample` (default:
+                     drop-newest)
+    :type overflow: str.
     :param interval: De-queue interval in seconds (default: 1.0)
     :type interval: float.
-    :param pressure: Maximum backpressure (-1 is no limit)
+    :param window: Maximum number of unacknowledged messages (default: 16)
+    :type window: int.
+    :param pressure: Deprecated, the maximum number of unacknowledged
+                     messages less one when `window` isn't set
     :type pressure: int.
+    :param batch_bytes: Initial message size in bytes (default: 65536)
+    :type batch_bytes: int.
+    :param max_batch_bytes: Largest message size in bytes (default: 1048576)
+    :type max_batch_bytes: int.
     :param tls: Use TLS (default false)
     :type tls: bool.
     :param cert: Host certificate path
@@ -67,12 +111,19 @@ class RiemannTCP(Output):
     :param allow_nan: Send events with None metric value (default true)
     :type allow_nan: bool
     """
-    def __init__(self, *a):
-        Output.__init__(self, *a)
+    serialization = 'riemann'
+
+    def __init__(self, config, duct):
+        # Shards keep their own spools, in directories under this one
+        shardSpool = None
+        if config.get('shard') and config.get('spool'):
+            config = dict(config)
+            shardSpool = config.pop('spool')
+
+        Output.__init__(self, config, duct)
         self.timer = task.LoopingCall(self.tick)
 
         self.inter = float(self.config.get('interval', 1.0))  # tick interval
-        self.pressure = int(self.config.get('pressure', -1))
         self.maxsize = int(self.config.get('maxsize', 250000))
         self.expire = self.config.get('expire', False)
         self.allow_nan = self.config.get('allow_nan', True)
@@ -85,6 +136,22 @@ class RiemannTCP(Output):
             self.queueDepth = int(maxrate * self.inter)
         else:
             self.queueDepth = None
+        self.budget = self.queueDepth
+
+        window = self.config.get('window')
+        if window is None:
+            pressure = int(self.config.get('pressure', -1))
+            window = pressure + 1 if pressure >= 0 else 16
+        self.maxWindow = max(1, int(window))
+
+        self.maxBatchBytes = int(self.config.get('max_batch_bytes', 1 << 20))
+        self.initialBatchBytes = min(
+            int(self.config.get('batch_bytes', 65536)), self.maxBatchBytes)
+
+        # Running estimate of the encoded size of an event
+        self.eventSize = 100.0
+        self.requeued = 0
+        self.resetWindow()
 
         self.tls = self.config.get('tls', False)
 
@@ -92,15 +159,56 @@ class RiemannTCP(Output):
             self.cert = self.config['cert']
             self.key = self.config['key']
 
+        self.shards = []
+        if self.config.get('shard', False):
+            self.createShards(shardSpool)
+
+    def createShards(self, spool=None):
+        """Create an output for each server, and the hash ring which assigns
+        series to them
+        """
+        servers = self.config.get('server', 'localhost')
+        if not isinstance(servers, list):
+            servers = [servers]
+
+        for server in servers:
+            config = dict(self.config, server=server, shard=False,
+                          failover=False, name='%s.%s' % (
+                              self.name, server.replace('.', '_')))
+            if spool:
+                config['spool'] = os.path.join(spool, server)
+
+            # Shards report backpressure to this output rather than the
+            # service
+            self.shards.append(RiemannTCP(config, self))
+
+        replicas = int(self.config.get('replicas', 64))
+        ring = sorted((hashKey('%s-%s' % (shard.config['server'], i)), n)
+                      for n, shard in enumerate(self.shards)
+                      for i in range(replicas))
+        self.ringKeys = [key for key, _ in ring]
+        self.ringShards = [self.shards[n] for _, n in ring]
+
+        self.live = set()
+        self.owners = {}
+        self.pressuredShards = set()
+        self.timer = task.LoopingCall(self.updateShards)
+
     def createClient(self):
         """Create a TCP connection to Riemann with automatic reconnection
         """
+        if self.shards:
+            self.timer.start(self.inter)
+            return defer.DeferredList([shard.createClient()
+                                       for shard in self.shards])
 
         server = self.config.get('server', 'localhost')
         port = self.config.get('port', 5555)
         failover = self.config.get('failover', False)
 
         self.factory = riemann.RiemannClientFactory(server, failover=failover)
+        self.factory.acked = self.messageAcked
+        self.factory.lost = self.messagesLost
 
         if failover:
             initial = random.choice(server)
@@ -140,59 +248,262 @@ class RiemannTCP(Output):
     def stop(self):
         """Stop this client.
         """
-        self.timer.stop()
-        self.factory.stopTrying()
-        self.connector.disconnect()
+        if self.timer.running:
+            self.timer.stop()
+
+        for shard in self.shards:
+            shard.stop()
+
+        if self.factory is not None:
+            self.factory.stopTrying()
+            self.connector.disconnect()
+
+    def eventsReceived(self, events):
+        """Queue events, or with sharding pass each one to the shard which
+        owns its series
+        """
+        if not self.shards:
+            return Output.eventsReceived(self, events)
+
+        self.updateShards()
+
+        batch = EventBatch.fromEvents(events)
+        rows = {}
+        for i, key in enumerate(zip(batch.hostnames, batch.services)):
+            shard = self.shardFor('%s.%s' % key)
+            indices = rows.get(shard)
+            if indices is None:
+                rows[shard] = [i]
+            else:
+                indices.append(i)
+
+        for shard, indices in rows.items():
+            shard.eventsReceived(batch.select(indices))
+
+    def shardFor(self, eid):
+        """Return the shard which owns the series `eid`, which is the next
+        connected shard on the hash ring
+        """
+        shard = self.owners.get(eid)
+        if shard is None:
+            ring = self.ringShards
+            start = bisect.bisect(self.ringKeys, hashKey(eid))
+            shard = ring[start % len(ring)]
+            for step in range(len(ring)):
+                candidate = ring[(start + step) % len(ring)]
+                if candidate in self.live:
+                    shard = candidate
+                    break
+
+            # Owners are only cached, so a churn of series can't grow this
+            # without limit
+            if len(self.owners) >= 100000:
+                self.owners.clear()
+            self.owners[eid] = shard
+
+        return shard
+
+    def updateShards(self):
+        """Rebalance when a shard connects or disconnects. Events queued for
+        a disconnected shard move to the shards which now own their series
+        """
+        live = set(shard for shard in self.shards
+                   if shard.factory is not None and shard.factory.proto)
+        if live == self.live:
+            return
+
+        log.msg('Riemann shards connected: %s of %s' % (len(live),
+                                                        len(self.shards)))
+        self.live = live
+        self.owners.clear()
+        if not live:
+            return
+
+        for shard in self.shards:
+            if (shard not in live) and shard.events:
+                events = shard.events.take()
+                shard.markDequeued(len(events), record=False)
+                self.eventsReceived(events)
+
+    def outputPressure(self, shard, pressured):
+        """Called by a shard when its queue backs up or drains. This output
+        holds back its sources while any shard is backed up
+        """
+        if pressured:
+            self.pressuredShards.add(shard)
+        else:
+            self.pressuredShards.discard(shard)
+
+        if bool(self.pressuredShards) != self.pressured:
+            self.pressured = not self.pressured
+            outputPressure = getattr(self.duct, 'outputPressure', None)
+            if outputPressure is not None:
+                outputPressure(self, self.pressured)
+
+    def queueSize(self):
+        """Number of events waiting in the queue, or in all the shards
+        """
+        if self.shards:
+            return sum(shard.queueSize() for shard in self.shards)
+        return Output.queueSize(self)
+
+    def startSpool(self):
+        """Start replaying the spool of this output and its shards
+        """
+        for shard in self.shards:
+            shard.startSpool()
+        Output.startSpool(self)
+
+    def stopSpool(self):
+        """Stop the spool of this output and its shards
+        """
+        for shard in self.shards:
+            shard.stopSpool()
+        Output.stopSpool(self)
+
+    def resetWindow(self):
+        """Start sending with a small window and no round trip estimate,
+        for a new connection
+        """
+        self.window = min(2, self.maxWindow)
+        self.batchBytes = self.initialBatchBytes
+        self.minRtt = None
+        self.srtt = None
+        self.acks = 0
+        self.lastDecrease = 0
 
     def tick(self):
         """Clock tick called every self.inter
         """
         if self.factory.proto:
-            # Check backpressure
-            if (self.pressure < 0) or (
-                    self.factory.proto.pressure <= self.pressure):
-                self.emptyQueue()
+            self.budget = self.queueDepth
+            self.emptyQueue()
         elif self.expire:
             # Check queue age and expire stale events
-            for i, ev in enumerate(self.events):
-                if (time.time() - ev.time) > ev.ttl:
-                    self.events.pop(i)
+            self.markDequeued(self.events.expire(time.time()), record=False)
 
     def emptyQueue(self):
-        """Remove all or self.queueDepth events from the queue
+        """Send messages until the queue is empty, the window is full or
+        this interval's `maxrate` budget is spent
         """
-        if self.events:
-            if self.queueDepth and (len(self.events) > self.queueDepth):
-                # Remove maximum of self.queueDepth items from queue
-                events = self.events[:self.queueDepth]
-                self.events = self.events[self.queueDepth:]
-            else:
-                events = self.events
-                self.events = []
+        proto = self.factory.proto
+        while proto and self.events and len(proto.inflight) < self.window:
+            count = max(1, int(self.batchBytes / self.eventSize))
+            if self.budget is not None:
+                count = min(count, self.budget)
+                if count <= 0:
+                    break
+                self.budget -= count
+
+            self.sendBatch(proto, count)
+
+    def sendBatch(self, proto, count):
+        """Send up to `count` events from the queue as one message
+        """
+        events = self.events.take(count)
 
-            if self.allow_nan:
-                self.factory.proto.sendEvents(events)
-            else:
-                self.factory.proto.sendEvents([ev for ev in events
-                                               if ev.metric is not None])
+        self.markDequeued(len(events))
+
+        started = time.time()
+        batch = EventBatch.fromEvents(events)
+
+        if not self.allow_nan:
+            batch = batch.select([i for i, metric
+                                  in enumerate(batch.metrics)
+                                  if metric is not None])
+
+        size = proto.sendEvents(batch, events)
+        self.bytesSent += size
+        self.eventSize = 0.8 * self.eventSize + 0.2 * (
+            float(size) / len(events))
+        self.timings.record('encode', time.time() - started)
+
+    def messageAcked(self, rtt, _events, _ok):
+        """Adapt the window and message size to the round trip time of an
+        acknowledged message, and send more
+        """
+        self.timings.record('ack', rtt)
+
+        if (self.minRtt is None) or (rtt < self.minRtt):
+            self.minRtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        proto = self.factory.proto
+        # The window was full before this message was acknowledged
+        full = proto is not None and len(proto.inflight) + 1 >= self.window
+
+        now = time.time()
+        if self.srtt > max(2 * self.minRtt, self.minRtt + 0.005):
+            # Riemann is queueing our messages. Back off at most once per
+            # round trip, so one burst of slow acks only counts once
+            if now - self.lastDecrease > self.srtt:
+                self.window = max(1, self.window // 2)
+                self.batchBytes = max(4096, self.batchBytes // 2)
+                self.lastDecrease = now
+            self.acks = 0
+        elif full:
+            self.acks += 1
+            if self.acks >= self.window:
+                self.acks = 0
+                if self.window < self.maxWindow:
+                    self.window += 1
+                else:
+                    self.batchBytes = min(self.maxBatchBytes,
+                                          self.batchBytes * 2)
+
+        self.emptyQueue()
+
+    def messagesLost(self, pending):
+        """Queue the events of unacknowledged messages again after the
+        connection is lost
+        """
+        events = [event for events in pending for event in events]
+        log.msg('Requeueing %s unacknowledged events' % len(events))
+        self.requeued += len(events)
+        self.resetWindow()
+        self.eventsReceived(events)
 
 
 class RiemannUDP(Output):
     """Riemann UDP output (spray-and-pray mode)
 
+    Events are held for up to `flush_interval` seconds and then packed into
+    as few datagrams of at most `max_datagram` bytes as possible, which are
+    all written in the same flush. The default size fits in a 1500 byte
+    Ethernet MTU with room for IP and UDP headers and tunnel overhead, so
+    datagrams aren't fragmented. Events too large for a datagram are dropped
+    and counted.
+
     **Configuration arguments:**
 
     :param server: Riemann server IP address (default: 127.0.0.1)
     :type server: str.
     :param port: Riemann server port (default: 5555)
     :type port: int.
+    :param max_datagram: Maximum datagram size in bytes (default: 1400)
+    :type max_datagram: int.
+    :param flush_interval: Seconds to hold events before sending them
+                           (default: 0.1)
+    :type flush_interval: float.
     """
+    serialization = 'riemann'
 
     def __init__(self, *a):
         Output.__init__(self, *a)
         self.protocol = None
         self.endpoint = None
 
+        self.maxDatagram = int(self.config.get('max_datagram', 1400))
+        self.flushInterval = float(self.config.get('flush_interval', 0.1))
+        self.buffer = EventBatch()
+        self.flushCall = None
+
+        # Datagrams sent and dropped, and events too large to send
+        self.datagrams = {'sent': 0, 'dropped': 0, 'oversize': 0}
+
     def createClient(self):
         """Create a UDP connection to Riemann"""
         server = self.config.get('server', '127.0.0.1')
@@ -209,10 +520,40 @@ class RiemannUDP(Output):
         return de
 
     def eventsReceived(self, events):
-        """Receives a list of events and transmits them to Riemann
+        """Receives a list of events and buffers them to be transmitted to
+        Riemann
 
         Arguments:
-        events -- list of `duct.objects.Event`
+        events -- `duct.objects.EventBatch` or list of `duct.objects.Event`
         """
         if self.protocol:
-            self.protocol.sendEvents(events)
+            self.buffer.extend(events)
+            if self.flushCall is None:
+                self.flushCall = reactor.callLater(self.flushInterval,
+                                                   self.flush)
+
+    def flush(self):
+        """Pack the buffered events into datagrams and send them
+        """
+        self.flushCall = None
+        batch, self.buffer = self.buffer, EventBatch()
+        if not (batch and self.protocol):
+            return
+
+        started = time.time()
+        sent, dropped = self.protocol.sent, self.protocol.dropped
+
+        size, oversize = self.protocol.sendDatagrams(batch, self.maxDatagram)
+
+        self.bytesSent += size
+        self.datagrams['sent'] += self.protocol.sent - sent
+        self.datagrams['dropped'] += self.protocol.dropped - dropped
+        self.datagrams['oversize'] += oversize
+        self.timings.record('encode', time.time() - started)
+
+    def stop(self):
+        """Send anything still buffered
+        """
+        if self.flushCall is not None:
+            self.flushCall.cancel()
+        self.flush()
@@ -0,0 +1,222 @@
+"""
+.. module:: profiler
+   :synopsis: On-demand sampling profiler and memory snapshots
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from duct.monitor import findOwner
+from duct.objects import Source
+
+
+def frameName(frame):
+    """Return a name for a stack frame in collapsed stack output
+    """
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+def collapseStack(frame):
+    """Return the stack from `frame` as a collapsed stack string, rooted at
+    the class of the source or output running it
+    """
+    owner = findOwner(frame)
+    if owner is None:
+        root = 'reactor'
+    elif isinstance(owner, Source):
+        root = 'source:' + owner.__class__.__name__
+    else:
+        root = 'output:' + owner.__class__.__name__
+
+    names = []
+    while frame is not None:
+        names.append(frameName(frame))
+        frame = frame.f_back
+    names.append(root)
+
+    return ';'.join(reversed(names))
+
+class SamplingProfiler(object):
+    """Samples the stack of the reactor thread from a background thread
+
+    Samples are counted per collapsed stack, which can be written out in the
+    format used by flamegraph.pl and speedscope.
+
+    :param interval: Seconds between samples (default: 0.005)
+    :type interval: float.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = {}
+        self.threadId = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        """Start sampling the calling thread
+        """
+        self.samples = {}
+        self.running = True
+        self.threadId = threading.current_thread().ident
+        self.thread = threading.Thread(target=self.sampler,
+                                       name='duct-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def sampler(self):
+        """Thread which records samples
+        """
+        samples = self.samples
+        while self.running:
+            time.sleep(self.interval)
+
+            # pylint: disable=W0212
+            frame = sys._current_frames().get(self.threadId)
+            if frame is None:
+                continue
+            stack = collapseStack(frame)
+            del frame
+
+            samples[stack] = samples.get(stack, 0) + 1
+
+    def write(self, path):
+        """Write collapsed stacks to `path`
+        """
+        with open(path, 'wt') as out:
+            for stack, count in sorted(self.samples.items()):
+                out.write('%s %s\n' % (stack, count))
+
+class MemoryTracker(object):
+    """Compares tracemalloc snapshots taken at the start and end of a
+    profiling window
+
+    :param frames: Number of frames tracemalloc keeps per allocation
+    :type frames: int.
+    """
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.snapshot = None
+        self.started = False
+
+    def start(self):
+        """Start tracing allocations, unless they already are, and take the
+        first snapshot
+        """
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start(self.frames)
+        self.snapshot = tracemalloc.take_snapshot()
+
+    def stop(self):
+        """Take the second snapshot, stop tracing if we started it and return
+        the differences grouped by file, largest growth first
+        """
+        snapshot = tracemalloc.take_snapshot()
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        stats = snapshot.filter_traces(filters).compare_to(
+            self.snapshot.filter_traces(filters), 'filename')
+        self.snapshot = None
+
+        return stats
+
+    def write(self, path, stats, limit=50):
+        """Write the top `limit` differences in `stats` to `path`
+        """
+        with open(path, 'wt') as out:
+            for stat in stats[:limit]:
+                out.write('%s\n' % stat)
+
+class Profiler(object):
+    """Runs a profiling window inside the service, started and stopped by a
+    signal
+
+    The first signal starts the sampling profiler and takes a tracemalloc
+    snapshot. The next signal stops both and writes
+    `duct-(pid)-(time).folded` with the collapsed stacks and
+    `duct-(pid)-(time).memory` with the memory growth per file, to
+    `directory`.
+
+    :param directory: Directory to write profiles to
+    :type directory: str.
+    :param interval: Seconds between samples
+    :type interval: float.
+    :param signame: Name of the signal which toggles profiling
+    :type signame: str.
+    """
+    def __init__(self, directory, interval=0.005, signame='SIGUSR2'):
+        self.directory = directory
+        self.signame = signame
+        self.cpu = SamplingProfiler(interval)
+        self.memory = MemoryTracker() if tracemalloc else None
+        self.running = False
+
+    def install(self):
+        """Toggle profiling when the process receives our signal
+        """
+        signal.signal(getattr(signal, self.signame), self.signalReceived)
+
+    def signalReceived(self, _signum, _frame):
+        """Signal handler, which defers to the reactor
+        """
+        reactor.callFromThread(self.toggle)
+
+    def toggle(self):
+        """Start profiling if stopped, otherwise stop and write results
+        """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        """Start a profiling window
+        """
+        log.msg('Starting profiler')
+        self.running = True
+        if self.memory:
+            self.memory.start()
+        self.cpu.start()
+
+    def stop(self):
+        """Stop profiling and return the paths of the files written
+        """
+        self.running = False
+        self.cpu.stop()
+
+        base = os.path.join(self.directory, 'duct-%s-%s' % (
+            os.getpid(), int(time.time())))
+
+        paths = [base + '.folded']
+        self.cpu.write(paths[0])
+
+        if self.memory:
+            paths.append(base + '.memory')
+            self.memory.write(paths[1], self.memory.stop())
+
+        log.msg('Profile written to %s' % ', '.join(paths))
+        return paths
@@ -21,6 +21,7 @@ class ElasticSearch(object):
         self.index = index
         self.user = user
         self.password = password
+        self.bytesSent = 0
 
     def _get_index(self):
         return time.strftime(self.index)
@@ -32,8 +33,11 @@ class ElasticSearch(object):
                                      ).decode()
             headers['Authorization'] = ['Basic ' + authorization]
 
+        body = data.encode()
+        self.bytesSent += len(body)
+
         return utils.HTTPRequest().getJson(
-            self.url + path, method, headers=headers, data=data.encode())
+            self.url + path, method, headers=headers, data=body)
 
     def _gen_id(self):
         return b64encode(uuid.uuid4().bytes).decode().rstrip('=')
@@ -79,3 +83,21 @@ class ElasticSearch(object):
             serdata += json.dumps(row) + '\n'
 
         return self._request('/_bulk', serdata, 'PUT')
+
+    def bulkIndexJson(self, documents):
+        """Insert many documents which are already serialized, given as
+        (type, JSON document) pairs
+        """
+        lines = []
+        for doctype, document in documents:
+            lines.append(json.dumps({
+                "index": {
+                    "_index": self._get_index(),
+                    "_type": doctype,
+                    "_id": self._gen_id(),
+                }
+            }))
+            lines.append(document)
+
+        return self._request('/_bulk', ''.join(line + '\n' for line in lines),
+                             'PUT')
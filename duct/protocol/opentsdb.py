@@ -17,6 +17,7 @@ class OpenTSDBClient(object):
         self.url = url.rstrip('/')
         self.user = user
         self.password = password
+        self.bytesSent = 0
 
     def _request(self, path, data=None, method='POST'):
         headers = {}
@@ -25,10 +26,19 @@ class OpenTSDBClient(object):
                                      ).decode()
             headers['Authorization'] = ['Basic ' + authorization]
 
+        body = data.encode()
+        self.bytesSent += len(body)
+
         return utils.HTTPRequest().getJson(
-            self.url + path, method, headers=headers, data=data.encode())
+            self.url + path, method, headers=headers, data=body)
 
     def put(self, data):
         """Put one or more metrics
         """
         return self._request('/api/put', json.dumps(data))
+
+    def putJson(self, points):
+        """Put metrics which are already serialized as JSON objects
+        """
+        # The same separators as json.dumps of the list of points
+        return self._request('/api/put', '[' + ', '.join(points) + ']')
@@ -5,27 +5,205 @@
 
 .. moduleauthor:: Colin Alston <colin@imcol.in>
 """
+import socket
+import struct
+import time
+
+from collections import deque
+
 from duct.ihateprotobuf import proto_pb2
 from duct.interfaces import IDuctProtocol
+from duct.objects import EventBatch
 
 from zope.interface import implementer
 
 from twisted.protocols.basic import Int32StringReceiver
 from twisted.internet.protocol import DatagramProtocol
-from twisted.internet import protocol
+from twisted.internet import error, protocol
 from twisted.python import log
 
+# Tag of the repeated `events` field (6, length delimited) of a Msg
+EVENT_TAG = b'\x32'
+
+# Tags of the Event fields which change on every tick: time (1, varint),
+# metric_sint64 (13, zigzag varint), metric_d (14, double) and metric_f
+# (15, float), and description (5, length delimited) which can change
+# between ticks
+TIME_TAG = b'\x08'
+SINT64_TAG = b'\x68'
+DOUBLE_TAG = b'\x71'
+FLOAT_TAG = b'\x7d'
+DESCRIPTION_TAG = b'\x2a'
+
+DOUBLE = struct.Struct('<d')
+FLOAT = struct.Struct('<f')
+INFINITY = float('inf')
+
+
+def encodeVarint(value):
+    """Encode an unsigned integer as a protobuf varint
+    """
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+def packFloat(value):
+    """Pack a float field, saturating to infinity like protobuf does
+    """
+    try:
+        return FLOAT.pack(value)
+    except OverflowError:
+        return FLOAT.pack(INFINITY if value > 0 else -INFINITY)
+
+def encodeDescription(description):
+    """Encode the description field of an event, which is left out when it
+    is None
+    """
+    if description is None:
+        return b''
+    if not isinstance(description, bytes):
+        description = description.encode('utf-8')
+    return DESCRIPTION_TAG + encodeVarint(len(description)) + description
+
+def frameEvents(encoded):
+    """Frame serialized Riemann events as a Msg
+    """
+    return b''.join([EVENT_TAG + encodeVarint(len(event)) + event
+                     for event in encoded])
+
+def packMessages(encoded, maxSize):
+    """Pack serialized Riemann events, in order, into as few Msg messages of
+    at most `maxSize` bytes as possible. Returns the messages and the number
+    of events which are too large to fit in one
+    """
+    messages = []
+    parts = []
+    size = 0
+    oversize = 0
+
+    for event in encoded:
+        field = EVENT_TAG + encodeVarint(len(event)) + event
+        if len(field) > maxSize:
+            oversize += 1
+            continue
+
+        if size + len(field) > maxSize:
+            messages.append(b''.join(parts))
+            parts = []
+            size = 0
+
+        parts.append(field)
+        size += len(field)
+
+    if parts:
+        messages.append(b''.join(parts))
+
+    return messages, oversize
+
+
+class EventEncoder(object):
+    """Serializes Riemann events without building protobuf objects
+
+    The fields of an event which rarely change between ticks (service,
+    host, tags, ttl and attributes) are serialized by :mod:`proto_pb2` once
+    per series and cached. Each event is then the time, the state, the
+    cached fields with the description between them and the metric written
+    out directly, in field number order, which is byte for byte what
+    :meth:`SerializeToString` produces. The last description of each series
+    is kept too, so it is only encoded again when it changes.
+
+    :param maxSeries: Number of series to cache (default: 100000)
+    :type maxSeries: int.
+    """
+    def __init__(self, maxSeries=100000):
+        self.maxSeries = maxSeries
+        self.series = {}
+        self.states = {}
+        self.timeValue = None
+        self.timeField = None
+
+    def encode(self, evtime, state, service, hostname, description, tags,
+               ttl, metric, attributes):
+        """Return a serialized Riemann event
+        """
+        key = (hostname, service)
+        cached = self.series.get(key)
+        if (cached is None) or (cached[0] != tags) or (
+                cached[1] != ttl) or (cached[2] != attributes):
+            cached = self._cacheSeries(key, service, hostname, tags, ttl,
+                                       attributes)
+
+        if (cached[5] != description) or (cached[6] is None):
+            cached[5] = description
+            cached[6] = encodeDescription(description)
+
+        evtime = int(evtime)
+        if evtime != self.timeValue:
+            # Events in a batch mostly share the same second
+            self.timeField = TIME_TAG + encodeVarint(
+                evtime & 0xffffffffffffffff)
+            self.timeValue = evtime
+
+        stateField = self.states.get(state)
+        if stateField is None:
+            # pylint: disable=no-member
+            stateField = proto_pb2.Event(state=state).SerializeToString()
+            if len(self.states) < 64:
+                self.states[state] = stateField
+
+        if metric is None:
+            metricField = b''
+        elif isinstance(metric, int):
+            # Zigzag encoding, which only fits 64 bit integers
+            if not -0x8000000000000000 <= metric <= 0x7fffffffffffffff:
+                raise ValueError('Metric %s is out of range' % metric)
+            metricField = (SINT64_TAG + encodeVarint(
+                ((metric << 1) ^ (metric >> 63)) & 0xffffffffffffffff) +
+                           FLOAT_TAG + packFloat(float(metric)))
+        else:
+            metric = float(metric)
+            metricField = (DOUBLE_TAG + DOUBLE.pack(metric) +
+                           FLOAT_TAG + packFloat(metric))
+
+        return (self.timeField + stateField + cached[3] + cached[6] +
+                cached[4] + metricField)
+
+    def _cacheSeries(self, key, service, hostname, tags, ttl, attributes):
+        # pylint: disable=no-member
+        head = proto_pb2.Event(service=service, host=hostname)
+        tail = proto_pb2.Event(tags=tags, ttl=ttl)
+
+        if attributes is not None:
+            for akey, value in attributes.items():
+                attribute = tail.attributes.add()
+                attribute.key, attribute.value = akey, value
+
+        # Copies, so changes to the event's own tags or attributes are seen.
+        # The description and its encoding are filled in by encode
+        cached = [list(tags) if tags is not None else None, ttl,
+                  dict(attributes) if attributes is not None else None,
+                  head.SerializeToString(), tail.SerializeToString(),
+                  None, None]
+
+        if len(self.series) >= self.maxSeries:
+            self.series.clear()
+        self.series[key] = cached
+
+        return cached
 
 class RiemannProtobufMixin(object):
     """Class mix-in for protocol buffer stuff
     """
     def __init__(self):
         self.pressure = 0
+        self.encoder = EventEncoder()
 
     def encodeEvent(self, event):
         """Adapts an Event object to a Riemann protobuf event Event"""
         # pylint: disable=no-member
-
         pbevent = proto_pb2.Event(
             time=int(event.time),
             state=event.state,
@@ -36,14 +214,15 @@ class RiemannProtobufMixin(object):
             ttl=event.ttl,
         )
 
-        if event.metric is not None:
+        metric = event.metric
+        if metric is not None:
             # I have no idea what I'm doing
-            if isinstance(event.metric, int):
-                pbevent.metric_sint64 = event.metric
-                pbevent.metric_f = float(event.metric)
+            if isinstance(metric, int):
+                pbevent.metric_sint64 = metric
+                pbevent.metric_f = float(metric)
             else:
-                pbevent.metric_d = float(event.metric)
-                pbevent.metric_f = float(event.metric)
+                pbevent.metric_d = float(metric)
+                pbevent.metric_f = float(metric)
 
         if event.attributes is not None:
             for key, value in event.attributes.items():
@@ -53,12 +232,32 @@ class RiemannProtobufMixin(object):
         return pbevent
 
     def encodeMessage(self, events):
-        """Encode a list of Duct events with protobuf"""
-
-        encoded = [self.encodeEvent(ev) for ev in events
-                   if ev.evtype == 'metric']
-
-        return proto_pb2.Msg(events=encoded).SerializeToString()
+        """Encode a list of Duct events or an EventBatch with protobuf"""
+        return frameEvents(self.encodeEvents(events))
+
+    def encodeEvents(self, events):
+        """Serialize each metric event in a list of Duct events or an
+        EventBatch separately, for packing with :func:`packMessages`"""
+        encode = self.encoder.encode
+
+        if isinstance(events, EventBatch):
+            def encodeRow(i):
+                """Serialize row `i` of the batch
+                """
+                return encode(events.times[i], events.states[i],
+                              events.services[i], events.hostnames[i],
+                              events.descriptions[i], events.tags[i],
+                              events.ttls[i], events.metrics[i],
+                              events.attributes[i])
+
+            return events.serialize('riemann', encodeRow, [
+                i for i, evtype in enumerate(events.evtypes)
+                if evtype == 'metric'])
+
+        return [encode(ev.time, ev.state, ev.service, ev.hostname,
+                       ev.description, ev.tags, ev.ttl, ev.metric,
+                       ev.attributes)
+                for ev in events if ev.evtype == 'metric']
 
     def decodeMessage(self, data):
         """Decode a protobuf message into a list of Duct events"""
@@ -68,20 +267,67 @@ class RiemannProtobufMixin(object):
         return message
 
     def sendEvents(self, events):
-        """Send a Duct Event to Riemann"""
+        """Send a Duct Event to Riemann. Returns the size of the message"""
         self.pressure += 1
-        self.sendString(self.encodeMessage(events))
+        message = self.encodeMessage(events)
+        self.sendString(message)
+        return len(message)
 
 @implementer(IDuctProtocol)
 class RiemannProtocol(Int32StringReceiver, RiemannProtobufMixin):
     """Riemann protobuf protocol
+
+    Riemann acknowledges each message in the order it was sent, so any
+    number of messages can be pipelined. Messages waiting for their
+    acknowledgement are kept in `inflight`, and the factory's `acked` hook
+    is called with the round trip time of each one.
     """
+    def __init__(self):
+        RiemannProtobufMixin.__init__(self)
+        self.inflight = deque()
+
+    def sendEvents(self, events, pending=None):
+        """Send events to Riemann and keep `pending` (by default `events`)
+        until the message is acknowledged. Returns the size of the message
+        """
+        message = self.encodeMessage(events)
+        self.inflight.append((time.time(), events if pending is None
+                              else pending))
+        self.pressure += 1
+        self.sendString(message)
+        return len(message)
 
     def stringReceived(self, string):
         self.pressure -= 1
+        if not self.inflight:
+            return
+
+        sent, pending = self.inflight.popleft()
+        rtt = time.time() - sent
+
+        message = self.decodeMessage(string)
+        if not message.ok:
+            log.msg('Riemann rejected %s events: %s' % (len(pending),
+                                                        message.error))
+
+        factory = getattr(self, 'factory', None)
+        if factory is not None and factory.acked is not None:
+            factory.acked(rtt, pending, message.ok)
+
+    def takeInflight(self):
+        """Remove and return the events of all unacknowledged messages
+        """
+        pending = [pending for _, pending in self.inflight]
+        self.inflight.clear()
+        self.pressure = 0
+        return pending
 
 class RiemannClientFactory(protocol.ReconnectingClientFactory):
     """A reconnecting client factory which creates RiemannProtocol instances
+
+    `acked` is called with the round trip time, pending events and status
+    of each acknowledged message, and `lost` with the pending events of
+    every message left unacknowledged when a connection is lost.
     """
     maxDelay = 30
     initialDelay = 5
@@ -91,6 +337,8 @@ class RiemannClientFactory(protocol.ReconnectingClientFactory):
     def __init__(self, hosts, failover=False):
         self.failover = failover
         self.proto = None
+        self.acked = None
+        self.lost = None
 
         if self.failover:
             if isinstance(hosts, list):
@@ -103,6 +351,7 @@ class RiemannClientFactory(protocol.ReconnectingClientFactory):
     def buildProtocol(self, addr):
         self.resetDelay()
         self.proto = RiemannProtocol()
+        self.proto.factory = self
         return self.proto
 
     def _do_failover(self, connector):
@@ -116,6 +365,10 @@ class RiemannClientFactory(protocol.ReconnectingClientFactory):
 
     def clientConnectionLost(self, connector, reason):
         log.msg('Lost connection.  Reason:' + str(reason))
+        if self.proto is not None:
+            pending = self.proto.takeInflight()
+            if pending and self.lost is not None:
+                self.lost(pending)
         self.proto = None
 
         self._do_failover(connector)
@@ -139,15 +392,40 @@ class RiemannClientFactory(protocol.ReconnectingClientFactory):
 @implementer(IDuctProtocol)
 class RiemannUDP(DatagramProtocol, RiemannProtobufMixin):
     """UDP datagram protocol for Riemann
+
+    Datagrams which the transport refuses, for being too large or because
+    the socket buffer is full, are counted in `dropped`.
     """
 
     def __init__(self, host, port):
         RiemannProtobufMixin.__init__(self)
         self.host = host
         self.port = port
+        self.sent = 0
+        self.dropped = 0
 
     def sendString(self, string):
         """Write a string to the transport
         """
-        self.transport.write(string, (self.host, self.port))
         self.pressure -= 1
+        self.writeDatagram(string)
+
+    def writeDatagram(self, datagram):
+        """Write a datagram to the transport, counting it as dropped if the
+        transport refuses it
+        """
+        try:
+            self.transport.write(datagram, (self.host, self.port))
+            self.sent += 1
+        except (socket.error, error.MessageLengthError):
+            self.dropped += 1
+
+    def sendDatagrams(self, events, maxSize):
+        """Send events packed into datagrams of at most `maxSize` bytes.
+        Returns the number of bytes sent and the number of events which were
+        too large for a datagram
+        """
+        messages, oversize = packMessages(self.encodeEvents(events), maxSize)
+        for message in messages:
+            self.writeDatagram(message)
+        return sum(len(message) for message in messages), oversize
@@ -235,7 +235,15 @@ class SSHClient(object):
 
         factory = protocol.Factory()
         factory.protocol = SSHCommandProtocol
-        factory.done = defer.Deferred()
+        factory.command = None
+
+        def cancel(_d):
+            """Close the channel if the command is cancelled
+            """
+            if factory.command is not None:
+                factory.command.transport.loseConnection()
+
+        factory.done = defer.Deferred(cancel)
 
         def finished(result):
             """Command finished
@@ -250,6 +258,7 @@ class SSHClient(object):
             """
             # Be nice if Conch exposed this better...
             connection.transport.extReceived = connection.extReceived
+            factory.command = connection
             return factory.done
 
         return existing.connect(factory).addCallback(connected)
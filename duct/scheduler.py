@@ -0,0 +1,278 @@
+"""
+.. module:: scheduler
+   :synopsis: Timing wheel scheduler for source ticks
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import time
+import zlib
+
+from twisted.internet import task, defer
+from twisted.python import log
+
+
+class TimingWheel(object):
+    """Hierarchical timing wheel
+
+    Items are placed in slots by the absolute tick they are due on. Level 0
+    has one slot per tick, and each higher level has slots `size` times wider
+    than the one below. When a lower wheel wraps around, the matching slot of
+    the level above is cascaded down, so inserting and expiring items is O(1)
+    regardless of how many are scheduled.
+
+    :param size: Slots per level
+    :type size: int.
+    :param levels: Number of levels
+    :type levels: int.
+    """
+    def __init__(self, size=256, levels=4):
+        self.size = size
+        self.wheels = [[[] for _ in range(size)] for _ in range(levels)]
+        self.current = 0
+
+    def insert(self, tick, item):
+        """Schedule `item` to be returned by `advance` at `tick`
+        """
+        if tick <= self.current:
+            tick = self.current + 1
+
+        delta = tick - self.current
+        span = self.size
+        for level, wheel in enumerate(self.wheels):
+            if (delta < span) or (level == len(self.wheels) - 1):
+                slot = (tick // (span // self.size)) % self.size
+                wheel[slot].append((tick, item))
+                return
+            span *= self.size
+
+    def advance(self, tick):
+        """Move the wheel forward to `tick` and return a list of items which
+        became due
+        """
+        due = []
+        size = self.size
+        wheels = self.wheels
+
+        while self.current < tick:
+            self.current += 1
+            current = self.current
+
+            # Cascade higher levels when the level below wraps
+            span = size
+            for wheel in wheels[1:]:
+                if current % span:
+                    break
+                slot = (current // span) % size
+                items = wheel[slot]
+                wheel[slot] = []
+                for itemTick, item in items:
+                    if itemTick <= current:
+                        due.append(item)
+                    else:
+                        self.insert(itemTick, item)
+                span *= size
+
+            slot = current % size
+            items = wheels[0][slot]
+            if items:
+                wheels[0][slot] = []
+                for itemTick, item in items:
+                    if itemTick <= current:
+                        due.append(item)
+                    else:
+                        self.insert(itemTick, item)
+
+        return due
+
+class ScheduledSource(object):
+    """Schedule state and lag statistics for one source
+    """
+    __slots__ = ('source', 'bucket', 'lag', 'skipped', 'ticks')
+
+    def __init__(self, source):
+        self.source = source
+        self.bucket = None
+        self.lag = 0.0
+        self.skipped = 0
+        self.ticks = 0
+
+class Bucket(object):
+    """Sources which share an interval and phase, fired together
+    """
+    __slots__ = ('key', 'interval', 'due', 'entries')
+
+    def __init__(self, key, interval, due):
+        self.key = key
+        self.interval = interval
+        self.due = due
+        self.entries = []
+
+class Scheduler(object):
+    """Central scheduler which owns all source ticks
+
+    Sources are fired from a single timing wheel driven by one reactor timer,
+    instead of a LoopingCall each. Sources with the same interval and phase
+    share a bucket and are fired together. A source whose previous tick is
+    still running is skipped rather than piling up more ticks, and ticks
+    missed while the reactor was blocked are dropped. How late each tick
+    fired is recorded in the source's `schedule` timing.
+
+    **Source configuration arguments:**
+
+    :param align: Align ticks to multiples of `interval` on the wall clock
+    :type align: bool.
+    :param splay: Spread ticks of this source by up to `splay` seconds. The
+                  offset is derived from the service name, so it is stable
+                  between restarts
+    :type splay: float.
+
+    :param resolution: Wheel tick length in seconds (default: 0.1)
+    :type resolution: float.
+    :param splay: Default splay for sources (default: 0)
+    :type splay: float.
+    :param align: Default for `align` (default: False)
+    :type align: bool.
+    """
+    def __init__(self, resolution=0.1, splay=0, align=False, clock=None):
+        self.resolution = resolution
+        self.splay = splay
+        self.align = align
+
+        self.clock = clock
+        self.wheel = TimingWheel()
+        self.origin = None
+
+        self.entries = {}
+        self.buckets = {}
+
+        # ReactorMonitor told about ticks which block the reactor
+        self.monitor = None
+
+        self.timer = task.LoopingCall(self.tick)
+        if clock is not None:
+            self.timer.clock = clock
+
+    def now(self):
+        """Current time
+        """
+        if self.clock is not None:
+            return self.clock.seconds()
+        return time.time()
+
+    def _ticks(self, seconds):
+        return int(round(seconds / self.resolution))
+
+    def _offset(self, source):
+        splay = float(source.config.get('splay', self.splay))
+        if splay <= 0:
+            return 0.0
+
+        name = source.config.get('service', '').encode()
+        return (zlib.crc32(name) & 0xffffffff) % int(
+            splay * 1000) / 1000.0
+
+    def add(self, source):
+        """Start scheduling ticks for `source`
+        """
+        if source in self.entries:
+            return
+
+        now = self.now()
+        if self.origin is None:
+            self.origin = now
+
+        interval = max(1, self._ticks(source.inter))
+        offset = self._offset(source)
+        current = self.wheel.current
+
+        if source.config.get('align', self.align):
+            # Next multiple of the interval on the wall clock
+            period = interval * self.resolution
+            due = self._ticks(((now // period) + 1) * period + offset -
+                              self.origin)
+        else:
+            due = current + self._ticks(offset)
+
+        due = max(due, current + 1)
+        key = (interval, due % interval)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = Bucket(key, interval, due)
+            self.buckets[key] = bucket
+            self.wheel.insert(due, bucket)
+
+        entry = ScheduledSource(source)
+        entry.bucket = bucket
+        bucket.entries.append(entry)
+        self.entries[source] = entry
+
+        if not self.timer.running:
+            self.timer.start(self.resolution, now=False)
+
+    def remove(self, source):
+        """Stop scheduling `source`
+        """
+        entry = self.entries.pop(source, None)
+        if entry is None:
+            return
+
+        entry.bucket.entries.remove(entry)
+        if not entry.bucket.entries:
+            # The bucket is dropped from the wheel when it next fires
+            del self.buckets[entry.bucket.key]
+
+        if (not self.entries) and self.timer.running:
+            self.timer.stop()
+            self.origin = None
+            self.wheel = TimingWheel()
+
+    def tick(self):
+        """Advance the wheel and fire due sources
+        """
+        now = self.now()
+        current = self._ticks(now - self.origin)
+
+        for bucket in self.wheel.advance(current):
+            if self.buckets.get(bucket.key) is not bucket:
+                continue
+
+            scheduled = self.origin + bucket.due * self.resolution
+            lag = max(0.0, now - scheduled)
+
+            for entry in list(bucket.entries):
+                self._fire(entry, lag)
+
+            # Skip any ticks we missed while the reactor was busy
+            due = bucket.due + bucket.interval
+            if due <= current:
+                due += ((current - due) // bucket.interval + 1
+                        ) * bucket.interval
+            bucket.due = due
+            self.wheel.insert(due, bucket)
+
+    def _fire(self, entry, lag):
+        source = entry.source
+
+        entry.lag = lag
+        source.timings.record('schedule', lag)
+
+        if source.running:
+            entry.skipped += 1
+            return
+
+        entry.ticks += 1
+        started = time.time()
+        d = defer.maybeDeferred(source.tick)
+        d.addErrback(log.err, 'Error in tick for %s' % (
+            source.config.get('service'),))
+
+        if self.monitor is not None:
+            self.monitor.callFinished(source, time.time() - started)
+
+    def skipped(self):
+        """Return a list of (source, skipped ticks) for scheduled sources
+        """
+        return [(source, entry.skipped)
+                for source, entry in self.entries.items()]
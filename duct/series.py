@@ -0,0 +1,127 @@
+"""
+.. module:: series
+   :synopsis: Interned series keys
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+
+class SeriesRegistry(object):
+    """Gives every (hostname, service) pair a stable integer id
+
+    Ids are allocated sequentially and never reused, so they can be used as
+    list indices or dictionary keys in place of :meth:`Event.eid` strings.
+
+    Series are held in two generations. Once `maxsize` series have been
+    added to the current generation it becomes the previous one, and series
+    seen again are moved back with their id intact. Series which were not
+    seen for a whole generation are retired, so at most twice `maxsize`
+    series are held however many come and go. A retired series which comes
+    back is given a new id.
+
+    :param maxsize: Number of series in a generation (0 is no limit)
+    :type maxsize: int.
+    """
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+
+        self.hosts = {}
+        self.previous = {}
+        self.keys = {}
+
+        self.size = 0
+        self.nextId = 0
+        self.generation = 0
+        self.retired = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _add(self, services, hostname, service):
+        # Allocate or promote the id of a series missing from the current
+        # generation
+        if self.maxsize and (self.size >= self.maxsize):
+            self.rotate()
+            services = self.hosts[hostname] = {}
+
+        sid = None
+        previous = self.previous.get(hostname)
+        if previous:
+            sid = previous.pop(service, None)
+
+        if sid is None:
+            sid = self.nextId
+            self.nextId += 1
+            self.keys[sid] = (hostname, service)
+
+        services[service] = sid
+        self.size += 1
+        return sid
+
+    def rotate(self):
+        """Start a new generation, retiring series which were not seen during
+        the previous one
+        """
+        keys = self.keys
+        for services in self.previous.values():
+            for sid in services.values():
+                del keys[sid]
+                self.retired += 1
+
+        self.previous = self.hosts
+        self.hosts = {}
+        self.size = 0
+        self.generation += 1
+
+    def lookup(self, hostname, service):
+        """Return the id for `hostname` and `service`, allocating one if this
+        series has not been seen before
+        """
+        services = self.hosts.get(hostname)
+        if services is None:
+            services = self.hosts[hostname] = {}
+
+        sid = services.get(service)
+        if sid is None:
+            sid = self._add(services, hostname, service)
+
+        return sid
+
+    def lookupBatch(self, batch):
+        """Return a list of ids for every row in an EventBatch
+        """
+        sids = []
+
+        lastHost = None
+        services = None
+        for hostname, service in zip(batch.hostnames, batch.services):
+            if hostname is not lastHost:
+                services = self.hosts.get(hostname)
+                if services is None:
+                    services = self.hosts[hostname] = {}
+                lastHost = hostname
+
+            sid = services.get(service)
+            if sid is None:
+                generation = self.generation
+                sid = self._add(services, hostname, service)
+                if self.generation != generation:
+                    services = self.hosts[hostname]
+
+            sids.append(sid)
+
+        return sids
+
+    def resolve(self, batch):
+        """Make sure `batch.sids` is populated and return it
+        """
+        if batch.sids is None:
+            batch.sids = self.lookupBatch(batch)
+        return batch.sids
+
+    def eid(self, sid):
+        """Return the string identifier for a series id, as returned by
+        :meth:`Event.eid`
+        """
+        hostname, service = self.keys[sid]
+        return hostname + '.' + service
@@ -9,13 +9,86 @@ import time
 import sys
 import os
 import importlib
+import random
 import re
-import copy
+import heapq
+import tempfile
 
 from twisted.application import service
 from twisted.internet import task, reactor, defer
 from twisted.python import log
 
+from duct.aggregators import CounterState
+from duct.governor import Governor
+from duct.monitor import ReactorMonitor
+from duct.objects import EventBatch
+from duct.profiler import Profiler
+from duct.scheduler import Scheduler
+from duct.series import SeriesRegistry
+from duct.triggers import Triggers
+from duct.utils import getPool
+
+# Ways the service can hold back sources while their outputs are backed up
+BACKPRESSURE_MODES = ('pause', 'slow', 'sample')
+
+class Route(object):
+    """Resolved routing table for a source
+
+    :param config: The `route` configuration this was built from
+    :param table: The outputs dictionary this was resolved against
+    :param outputs: Outputs which receive every event
+    :param rules: List of (compiled regex, outputs) which receive events with
+                  a matching service name
+    """
+    cacheSize = 100000
+
+    def __init__(self, config, table, outputs, rules):
+        self.config = config
+        self.table = table
+        self.outputs = outputs
+        self.rules = rules
+        self.matches = {}
+
+        # Every output this route can send to
+        self.targets = set(outputs)
+        for _, routeOutputs in rules:
+            self.targets.update(routeOutputs)
+
+        # Whether two of them serialize events the same way, so can share
+        # the work
+        keys = [output.serialization for output in self.targets
+                if output.serialization is not None]
+        self.shared = len(set(keys)) < len(keys)
+
+    def outputsFor(self, sid, service):
+        """Return the rule outputs for a series, cached by series id
+        """
+        outputs = self.matches.get(sid)
+        if outputs is None:
+            if len(self.matches) >= self.cacheSize:
+                self.matches.clear()
+
+            outputs = []
+            for regex, routeOutputs in self.rules:
+                if regex.match(service):
+                    outputs.extend(routeOutputs)
+            outputs = self.matches[sid] = tuple(outputs)
+
+        return outputs
+
+    def match(self, batch):
+        """Return a dictionary of output to the indices of rows in `batch`
+        which the routing rules send to it
+        """
+        outputsFor = self.outputsFor
+        selected = {}
+        for i, (sid, service) in enumerate(zip(batch.sids, batch.services)):
+            for output in outputsFor(sid, service):
+                if output in selected:
+                    selected[output].append(i)
+                else:
+                    selected[output] = [i]
+        return selected
 
 class DuctService(service.Service):
     """Duct service
@@ -27,10 +100,12 @@ class DuctService(service.Service):
         self.sources = []
         self.lastEvents = {}
         self.outputs = {}
+        self.routes = {}
+        self.pending = {}
+        self.dispatcher = None
 
-        self.evCache = {}
-        self.critical = {}
-        self.warn = {}
+        self.series = None
+        self.triggers = {}
 
         self.hostConnectorCache = {}
 
@@ -39,6 +114,12 @@ class DuctService(service.Service):
         self.factory = None
         self.protocol = None
         self.watchdog = None
+        self.expiryTimer = None
+
+        self.watchdogHeap = []
+        self.watchdogSeq = 0
+        self.restarts = 0
+        self.restartReasons = {}
 
         self.config = config
 
@@ -48,7 +129,53 @@ class DuctService(service.Service):
         # Read some config stuff
         self.debug = float(self.config.get('debug', False))
         self.ttl = float(self.config.get('ttl', 60.0))
-        self.stagger = float(self.config.get('stagger', 0.2))
+
+        # Source ticks are driven by a shared timing wheel unless disabled,
+        # in which case each source runs its own LoopingCall
+        self.scheduler = None
+        if self.config.get('scheduler', True):
+            self.scheduler = Scheduler(
+                resolution=float(self.config.get('scheduler_resolution', 0.1)),
+                splay=float(self.config.get('splay', 0)),
+                align=self.config.get('align', False))
+
+        self.monitor = None
+        if self.config.get('reactor_monitor', True):
+            self.monitor = ReactorMonitor(
+                threshold=float(self.config.get('slow_callback', 0.05)),
+                sample=self.config.get('reactor_sampling', False))
+            if self.scheduler:
+                self.scheduler.monitor = self.monitor
+
+        # Installed by the twistd plugin, so only the daemon takes the signal
+        self.profiler = Profiler(
+            self.config.get('profile_dir', tempfile.gettempdir()),
+            float(self.config.get('profile_interval', 0.005)),
+            self.config.get('profile_signal', 'SIGUSR2'))
+
+        # Limits on concurrent source ticks, overall and per resource class
+        self.governor = Governor(
+            int(self.config.get('concurrency', 0)),
+            self.config.get('concurrency_limits'))
+
+        # Splay spreads scheduled sources, so staggering their start would
+        # only stop them sharing a wheel slot
+        self.stagger = float(self.config.get(
+            'stagger', 0 if self.scheduler else 0.2))
+
+        # Sources routed to an output whose queue passed its high watermark
+        # can be paused, slowed or sampled until it drains
+        self.backpressure = self.config.get('backpressure')
+        self.backpressureSample = float(
+            self.config.get('backpressure_sample', 0.1))
+        self.pressured = set()
+
+        # HTTP requests share a pool of persistent connections
+        getPool().configure(self.config.get('http_max_per_host'),
+                            self.config.get('http_idle_timeout'))
+
+        # Limit on how many stale sources the watchdog restarts at once
+        self.watchdogRestarts = int(self.config.get('watchdog_restarts', 10))
 
         # Backward compatibility
         self.server = self.config.get('server', None)
@@ -56,6 +183,25 @@ class DuctService(service.Service):
         self.proto = self.config.get('proto', 'tcp')
         self.inter = self.config.get('interval', 60.0)
 
+        # Series ids which haven't been seen for a generation of this many
+        # new series are retired
+        self.series = SeriesRegistry(
+            int(self.config.get('series_maxsize', 250000)))
+
+        # Counter state is dropped for series which haven't been seen for
+        # this many of their source's intervals
+        self.aggregationExpire = float(
+            self.config.get('aggregation_expire', 10))
+        self.counterState = CounterState(
+            int(self.config.get('aggregation_maxsize', 250000)))
+
+        self.workers = None
+        workers = int(self.config.get('workers', 0))
+        if workers > 0:
+            # Imported here since duct.workers subclasses DuctService
+            from duct.workers import WorkerPool
+            self.workers = WorkerPool(self, workers)
+
         if self.debug:
             print("config:", repr(config))
 
@@ -102,6 +248,7 @@ class DuctService(service.Service):
 
             # connect the output
             reactor.callLater(0, outputObj.createClient)
+            reactor.callLater(0, outputObj.startSpool)
 
     def createSource(self, source):
         """Construct the source object as defined in the configuration
@@ -133,13 +280,10 @@ class DuctService(service.Service):
     def setupTriggers(self, source, sobj):
         """Setup trigger actions for a source
         """
-        if source.get('critical'):
-            self.critical[sobj] = [(re.compile(key), val)
-                                   for key, val in source['critical'].items()]
+        triggers = Triggers(source.get('warning'), source.get('critical'))
 
-        if source.get('warning'):
-            self.warn[sobj] = [(re.compile(key), val)
-                               for key, val in source['warning'].items()]
+        if triggers:
+            self.triggers[sobj] = triggers
 
     def setupSources(self, config):
         """Sets up source objects from the given config"""
@@ -151,90 +295,237 @@ class DuctService(service.Service):
 
             self.sources.append(src)
 
-    def _aggregateQueue(self, events):
-        # Handle aggregation for each event
-        queue = []
-        for ev in events:
-            if ev.aggregation:
-                eid = ev.eid()
-                thisM = ev.metric
-
-                if eid in self.evCache:
-                    lastM, lastTime = self.evCache[eid]
-                    tDelta = ev.time - lastTime
-                    metric = ev.aggregation(
-                        lastM, ev.metric, tDelta)
-                    if metric:
-                        ev.metric = metric
-                        queue.append(ev)
-
-                self.evCache[eid] = (thisM, ev.time)
-            else:
-                queue.append(ev)
+            if self.workers and source.get('worker', src.worker):
+                self.workers.add(src)
+
+    def _aggregateBatch(self, batch, source=None):
+        # Handle aggregation for each event in an EventBatch
+        if not any(batch.aggregations):
+            return batch
+
+        if source is not None:
+            inter = source.inter
+        else:
+            inter = float(self.inter)
+
+        self.series.resolve(batch)
+        keep = self.counterState.apply(batch, inter * self.aggregationExpire)
 
-        return queue
+        if len(keep) == len(batch):
+            return batch
+
+        return batch.select(keep)
+
+    def expireState(self):
+        """Drop aggregation state for series which have gone away, and
+        activity times for sources which no longer exist
+        """
+        self.counterState.expire()
+
+        if len(self.lastEvents) > len(self.sources):
+            sources = set(self.sources)
+            for source in list(self.lastEvents.keys()):
+                if source not in sources:
+                    del self.lastEvents[source]
+
+    def _aggregateQueue(self, events):
+        # Handle aggregation for a list of events
+        return list(self._aggregateBatch(EventBatch.fromEvents(events)))
 
     def setStates(self, source, queue):
         """
         Check Event triggers against the configured source and apply the
         corresponding state
         """
-        for ev in queue:
-            if ev.state == 'ok':
-                for key, val in self.warn.get(source, []):
-                    if key.match(ev.service):
-                        state = eval("service %s" % val, {'service': ev.metric})
-                        if state:
-                            ev.state = 'warning'
-
-                for key, val in self.critical.get(source, []):
-                    if key.match(ev.service):
-                        state = eval("service %s" % val, {'service': ev.metric})
-                        if state:
-                            ev.state = 'critical'
+        triggers = self.triggers.get(source)
+        if triggers:
+            triggers.apply(queue)
 
-    def routeEvent(self, source, events):
-        """Route event to the queue of the output configured for it
+    def _resolveOutputs(self, source, names):
+        if not isinstance(names, list):
+            names = [names]
+
+        outputs = []
+        for name in names:
+            if name in self.outputs:
+                outputs.extend(self.outputs[name])
+            else:
+                # Non existant route
+                log.msg('Could not route %s -> %s.' % (
+                    source.config['service'], name))
+        return outputs
+
+    def buildRoute(self, source):
+        """Resolve the `route` configuration of a source into a Route
         """
         routes = source.config.get('route', None)
+        config = routes
 
         if not isinstance(routes, list):
             routes = [routes]
 
+        outputs = []
+        rules = []
         for route in routes:
-            if self.debug:
-                log.msg("Sending events %s to %s" % (events, route))
+            if isinstance(route, dict):
+                rules.append((re.compile(route['match']),
+                              self._resolveOutputs(source, route['output'])))
+            else:
+                outputs.extend(self._resolveOutputs(source, route))
 
-            if not route in self.outputs:
-                # Non existant route
-                log.msg('Could not route %s -> %s.' % (
-                    source.config['service'], route))
+        route = Route(config, self.outputs, outputs, rules)
+        self.routes[source] = route
+        return route
+
+    def buildRoutes(self):
+        """Resolve routes for all sources
+        """
+        self.routes = {}
+        for source in self.sources:
+            self.buildRoute(source)
+
+    def routeEvent(self, source, events):
+        """Route event to the queue of the output configured for it
+        """
+        route = self.routes.get(source)
+
+        if (route is None) or (route.config is not source.config.get(
+                'route', None)) or (route.table is not self.outputs):
+            route = self.buildRoute(source)
+
+        if self.debug:
+            log.msg("Sending events %s to %s" % (events, route.config))
+
+        # Outputs which serialize the same events to the same format share
+        # the work
+        if route.shared:
+            events.shareEncodings()
+
+        for output in route.outputs:
+            self.queueOutput(output, events)
+
+        if route.rules:
+            self.series.resolve(events)
+            for output, indices in route.match(events).items():
+                self.queueOutput(output, events.select(indices))
+
+    def outputPressure(self, output, pressured):
+        """Called by an output when its queue rises past its high watermark
+        or drains below its low watermark
+        """
+        if pressured:
+            log.msg("Output %s is backed up, holding back its sources" % (
+                output.name))
+            self.pressured.add(output)
+        else:
+            log.msg("Output %s has drained, releasing its sources" % (
+                output.name))
+            self.pressured.discard(output)
+
+        for source in self.sources:
+            self.updateBackpressure(source)
+
+    def updateBackpressure(self, source):
+        """Hold back `source` if any output it routes to is backed up, or
+        release it
+        """
+        mode = source.config.get('backpressure', self.backpressure)
+        if mode not in BACKPRESSURE_MODES:
+            mode = None
+
+        if mode and self.pressured:
+            route = self.routes.get(source)
+            if route is None:
+                route = self.buildRoute(source)
+            if not route.targets & self.pressured:
+                mode = None
+        else:
+            mode = None
+
+        if mode != source.backpressure:
+            source.applyBackpressure(mode)
+
+            # Sources in workers tick there, so only sampling, which is done
+            # as their events arrive, works without telling the worker
+            if self.workers and (source in self.workers):
+                self.workers.applyBackpressure(source, mode)
+
+    def sampleBatch(self, source, batch):
+        """Keep a random `backpressure_sample` fraction of `batch`
+        """
+        rate = self.backpressureSample
+        keep = [i for i in range(len(batch)) if random.random() < rate]
+        source.pressureSampled += len(batch) - len(keep)
+        return batch.select(keep)
+
+    def queueOutput(self, output, events):
+        """Queue events for an output. Everything queued for an output is
+        delivered to it in one call on the next reactor iteration
+        """
+        if output in self.pending:
+            self.pending[output].append(events)
+        else:
+            self.pending[output] = [events]
+
+        if self.dispatcher is None:
+            self.dispatcher = reactor.callLater(0, self.dispatch)
+
+    def dispatch(self):
+        """Deliver queued events to outputs
+        """
+        pending = self.pending
+        self.pending = {}
+        self.dispatcher = None
+
+        for output, batches in pending.items():
+            if len(batches) == 1:
+                events = batches[0]
             else:
-                for output in self.outputs[route]:
-                    reactor.callLater(0, output.eventsReceived, events)
+                events = EventBatch()
+                for batch in batches:
+                    events.extend(batch)
+
+            started = time.time()
+            try:
+                output.eventsReceived(events)
+            except Exception:
+                log.err(None, 'Error delivering events to %r' % output)
+
+            if self.monitor is not None:
+                self.monitor.callFinished(output, time.time() - started)
 
     def sendEvent(self, source, events):
-        """Callback that all event sources call when they have a new event
-        or list of events
+        """Callback that all event sources call when they have a new event,
+        list of events or EventBatch
         """
+        started = time.time()
+        timings = source.timings
 
-        if isinstance(events, list):
-            self.eventCounter += len(events)
-        else:
-            self.eventCounter += 1
-            events = [events]
+        batch = EventBatch.fromEvents(events)
+
+        self.eventCounter += len(batch)
 
-        queue = self._aggregateQueue(events)
+        self.series.resolve(batch)
+
+        queue = self._aggregateBatch(batch, source)
+        now = time.time()
+        timings.record('aggregate', now - started)
+
+        if queue and (source.backpressure == 'sample'):
+            queue = self.sampleBatch(source, queue)
 
         if queue:
-            if (source in self.critical) or (source in self.warn):
+            if source in self.triggers:
                 self.setStates(source, queue)
+                triggered = time.time()
+                timings.record('triggers', triggered - now)
+                now = triggered
 
             self.routeEvent(source, queue)
+            now = time.time()
 
-        queue = []
-
-        self.lastEvents[source] = time.time()
+        timings.record('send', now - started)
+        self.lastEvents[source] = now
 
     @defer.inlineCallbacks
     def _startSource(self, source):
@@ -244,12 +535,17 @@ class DuctService(service.Service):
     def startService(self):
         yield self.setupOutputs(self.config)
 
+        self.buildRoutes()
+
         if self.debug:
             log.msg("Starting service")
 
         stagger = 0
         # Start sources internal timers
         for source in self.sources:
+            if self.workers and (source in self.workers):
+                continue
+
             if self.debug:
                 log.msg("Starting source " + source.config['service'])
             # Stagger source timers, or use per-source start_delay
@@ -257,52 +553,128 @@ class DuctService(service.Service):
             reactor.callLater(start_delay, self._startSource, source)
             stagger += self.stagger
 
+        if self.workers:
+            self.workers.start()
+
         reactor.callLater(stagger, self.startWatchdog)
+
+        self.expiryTimer = task.LoopingCall(self.expireState)
+        self.expiryTimer.start(60, now=False)
+
+        if self.monitor:
+            self.monitor.start()
+
         self.running = 1
 
     def startWatchdog(self):
         """Start source watchdog
         """
+        now = time.time()
+        for source in self.sources:
+            self.watchSource(source, now)
+
         self.watchdog = task.LoopingCall(self.sourceWatchdog)
         self.watchdog.start(10)
 
-    @defer.inlineCallbacks
+    def watchSource(self, source, now=None):
+        """Add `source` to the watchdog if it has watchdog set to true in its
+        configuration
+        """
+        if not source.config.get('watchdog', False):
+            return
+        if self.workers and (source in self.workers):
+            return
+
+        if now is None:
+            now = time.time()
+
+        self.watchdogSeq += 1
+        heapq.heappush(self.watchdogHeap, (
+            now + source.inter * 10, self.watchdogSeq, source))
+
     def sourceWatchdog(self):
         """Watchdog timer function.
 
         Recreates sources which have not generated events in 10*interval if
-        they have watchdog set to true in their configuration
+        they have watchdog set to true in their configuration. Each watched
+        source has one entry in a heap ordered by the time it would become
+        stale, so only sources at the top of the heap are checked. At most
+        `watchdog_restarts` sources are restarted per run, the rest are
+        retried on the next run.
         """
-        for i, source in enumerate(self.sources):
-            if not source.config.get('watchdog', False):
+        now = time.time()
+        heap = self.watchdogHeap
+        sources = set(self.sources)
+        restarts = 0
+        retry = []
+
+        while heap and (heap[0][0] <= now):
+            _, seq, source = heapq.heappop(heap)
+
+            if source not in sources:
+                continue
+
+            last = self.lastEvents.get(source)
+            if last is None:
+                # Sources which have never sent events aren't restarted
+                deadline = now + source.inter * 10
+            else:
+                deadline = last + source.inter * 10
+
+            if source.backpressure == 'pause':
+                # Paused sources are quiet on purpose
+                deadline = now + source.inter * 10
+
+            if deadline > now:
+                heapq.heappush(heap, (deadline, seq, source))
                 continue
-            last = self.lastEvents.get(source, None)
-            if last:
-                sn = repr(source)
-                try:
-                    if last < (time.time()-(source.inter*10)):
-                        log.msg("Trying to restart stale source %s: %ss" % (
-                            sn, int(time.time() - last)
-                        ))
-
-                        source = self.sources.pop(i)
-                        try:
-                            yield source.stopTimer()
-                        except Exception as ex:
-                            log.msg("Could not stop timer for %s: %s" % (
-                                sn, ex))
-
-                        config = copy.deepcopy(source.config)
-
-                        del self.lastEvents[source]
-                        del source
-
-                        source = self.createSource(config)
-
-                        reactor.callLater(0, self._startSource, source)
-                except Exception as ex:
-                    log.msg("Could not reset source %s: %s" % (
-                        sn, ex))
+
+            if restarts >= self.watchdogRestarts:
+                retry.append((now + 10, seq, source))
+                continue
+
+            restarts += 1
+
+            reason = "no events for %ss" % int(now - last)
+            if source.running:
+                reason += ", tick still running"
+
+            self.restartSource(source, reason)
+
+        for entry in retry:
+            heapq.heappush(heap, entry)
+
+    @defer.inlineCallbacks
+    def restartSource(self, source, reason):
+        """Replace `source` with a new instance built from its configuration
+        """
+        sn = repr(source)
+        log.msg("Restarting source %s: %s" % (sn, reason))
+
+        self.restarts += 1
+        self.restartReasons[source.config['service']] = reason
+
+        try:
+            newSource = self.createSource(source.config)
+        except Exception as ex:
+            log.msg("Could not reset source %s: %s" % (sn, ex))
+            return
+
+        self.sources[self.sources.index(source)] = newSource
+
+        if source in self.triggers:
+            self.triggers[newSource] = self.triggers.pop(source)
+        self.routes.pop(source, None)
+        self.lastEvents.pop(source, None)
+
+        try:
+            yield source.stopTimer()
+        except Exception as ex:
+            log.msg("Could not stop timer for %s: %s" % (sn, ex))
+
+        self.updateBackpressure(newSource)
+        self.watchSource(newSource)
+        reactor.callLater(0, self._startSource, newSource)
 
     @defer.inlineCallbacks
     def stopService(self):
@@ -311,9 +683,23 @@ class DuctService(service.Service):
         if self.watchdog and self.watchdog.running:
             self.watchdog.stop()
 
+        if self.expiryTimer and self.expiryTimer.running:
+            self.expiryTimer.stop()
+
+        if self.monitor:
+            self.monitor.stop()
+
+        if self.workers:
+            yield self.workers.stop()
+
         for source in self.sources:
+            if self.workers and (source in self.workers):
+                continue
             yield defer.maybeDeferred(source.stopTimer)
 
         for _, outputs in self.outputs.items():
             for output in outputs:
                 yield defer.maybeDeferred(output.stop)
+                output.stopSpool()
+
+        yield getPool().closeCachedConnections()
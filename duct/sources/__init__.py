@@ -12,6 +12,7 @@ from twisted.internet import defer
 
 from duct.interfaces import IDuctSource
 from duct.objects import Source
+from duct.utils import getPool
 
 
 @implementer(IDuctSource)
@@ -19,20 +20,95 @@ class Duct(Source):
     """Reports Duct information about numbers of checks
     and queue sizes.
 
+    **Configuration arguments:**
+
+    :param pipeline: Report the time spent in each pipeline stage by every
+                     source and output (default: false)
+    :type pipeline: bool.
+    :param offenders: Number of sources or outputs which blocked the reactor
+                      for longest to report (default: 5)
+    :type offenders: int.
+
     **Metrics:**
 
     :(service name).event qrate: Events added to the queue per second
     :(service name).dequeue rate: Events removed from the queue per second
     :(service name).event qsize: Number of events held in the queue
     :(service name).sources: Number of sources running
+    :(service name).aggregation.series: Number of series holding counter state
+    :(service name).aggregation.expired: Series expired from the counter state
+    :(service name).aggregation.evicted: Series evicted because the counter
+                                         state was full
+    :(service name).series.held: Number of series with an interned id
+    :(service name).series.retired: Series ids retired from the registry
+    :(service name).schedule.skipped.(source): Ticks skipped because the
+                                               previous tick was still
+                                               running, for sources which
+                                               skipped any
+    :(service name).watchdog.restarts: Stale sources restarted by the
+                                       watchdog
+    :(service name).timeouts: Ticks cancelled for exceeding their deadline
+    :(service name).backpressure.outputs: Outputs whose queues are backed up
+    :(service name).backpressure.sources: Sources being held back
+    :(service name).backpressure.skipped: Ticks skipped by paused or slowed
+                                          sources
+    :(service name).backpressure.sampled: Events discarded by sampled
+                                          sources
+    :(service name).concurrency.inflight: Source ticks running
+    :(service name).concurrency.inflight.(class): Source ticks running per
+                                                  resource class
+    :(service name).concurrency.queued: Source ticks waiting for a slot
+    :(service name).concurrency.wait: Mean time ticks waited for a slot
+    :(service name).concurrency.wait.max: Longest time a tick waited for a
+                                          slot
+    :(service name).http.pool.(hits|misses): HTTP requests which reused an
+                                             idle connection, and which
+                                             opened a new one
+    :(service name).http.pool.idle: Idle HTTP connections kept open
+    :(service name).reactor.lag.(p50|p99|max): How late the reactor ran
+                                               timers, in seconds
+    :(service name).reactor.stalls: Number of times the reactor was blocked
+                                    for longer than `slow_callback`
+    :(service name).reactor.slow.(source|output).(name): Seconds the
+        reactor was blocked by the worst offending sources and outputs
+    :(service name).pipeline.source.(source).(stage).(p50|p99|max): Time in
+        seconds spent in each stage for a source since the last report.
+        Stages are `schedule` (how late the tick started), `tick`,
+        `aggregate`, `triggers` and `send` (all processing in the service)
+    :(service name).pipeline.output.(output).(stage).(p50|p99|max): Time in
+        seconds spent in each stage for an output. Stages are `queue` (time
+        events waited before being flushed), `encode` and `ack` (round trip
+        time of Riemann acknowledgements)
+    :(service name).pipeline.output.(output).queued: Events queued for an
+                                                     output
+    :(service name).pipeline.output.(output).bytes: Bytes sent by an output
+    :(service name).pipeline.output.(output).(server).(metric): The output
+        metrics of each shard of a sharded Riemann output, with the dots in
+        `server` replaced by underscores
+    :(service name).pipeline.output.(output).shed.(policy): Events shed by
+        an output's overflow policy because its queue was full
+    :(service name).pipeline.output.(output).datagrams.(sent|dropped):
+        Datagrams sent by a UDP output, and those the socket refused
+    :(service name).pipeline.output.(output).datagrams.oversize: Events
+        dropped by a UDP output for being larger than a datagram
+    :(service name).pipeline.output.(output).spool.(spooled|replayed):
+        Events written to and replayed from an output's disk spool
+    :(service name).pipeline.output.(output).spool.(pending|dropped): Bytes
+        waiting in the spool, and bytes lost because it was full
     """
 
+    # This source reports on the service itself, so it can't run in a worker
+    worker = False
+
     def __init__(self, *a):
         Source.__init__(self, *a)
 
         self.events = self.duct.eventCounter
         self.rtime = time.time()
 
+        self.pipeline = self.config.get('pipeline', False)
+        self.offenders = int(self.config.get('offenders', 5))
+
     def get(self):
         sources = len(self.duct.sources)
 
@@ -44,7 +120,120 @@ class Duct(Source):
 
         self.rtime = time.time()
 
-        return [
-            self.createEvent('ok', 'Event rate', erate, prefix="event rate"),
-            self.createEvent('ok', 'Sources', sources, prefix="sources"),
-        ]
+        state = self.duct.counterState
+
+        batch = self.createBatch()
+
+        def add(description, metric, prefix):
+            self.appendEvent(batch, 'ok', description, metric, prefix=prefix)
+
+        add('Event rate', erate, "event rate")
+        add('Sources', sources, "sources")
+        add('Aggregated series', len(state), "aggregation.series")
+        add('Expired series', state.expired, "aggregation.expired")
+        add('Evicted series', state.evicted, "aggregation.evicted")
+        add('Series', len(self.duct.series), "series.held")
+        add('Retired series', self.duct.series.retired, "series.retired")
+
+        if self.duct.scheduler:
+            for source, skipped in self.duct.scheduler.skipped():
+                if not skipped:
+                    continue
+                add('Skipped ticks', skipped,
+                    "schedule.skipped.%s" % source.config['service'])
+
+        add('Watchdog restarts', self.duct.restarts, "watchdog.restarts")
+        add('Tick timeouts',
+            sum(source.timeouts for source in self.duct.sources), "timeouts")
+
+        held = [source for source in self.duct.sources if source.backpressure]
+        add('Backed up outputs', len(self.duct.pressured),
+            "backpressure.outputs")
+        add('Sources held back', len(held), "backpressure.sources")
+        add('Ticks skipped for backpressure',
+            sum(source.pressureSkipped for source in self.duct.sources),
+            "backpressure.skipped")
+        add('Events sampled away for backpressure',
+            sum(source.pressureSampled for source in self.duct.sources),
+            "backpressure.sampled")
+
+        governor = self.duct.governor
+        wait, maxWait = governor.resetWaits()
+        add('Ticks in flight', governor.inflight, "concurrency.inflight")
+        add('Ticks queued', governor.queued, "concurrency.queued")
+        add('Tick wait', wait, "concurrency.wait")
+        add('Max tick wait', maxWait, "concurrency.wait.max")
+        for name, count in governor.classes().items():
+            add('Ticks in flight', count, "concurrency.inflight.%s" % name)
+
+        pool = getPool()
+        add('HTTP connections reused', pool.hits, "http.pool.hits")
+        add('HTTP connections opened', pool.misses, "http.pool.misses")
+        add('Idle HTTP connections', pool.idle(), "http.pool.idle")
+
+        monitor = self.duct.monitor
+        if monitor:
+            add('Reactor stalls', monitor.stalls, "reactor.stalls")
+            self._addHistogram(batch, 'reactor lag', monitor.lag,
+                               "reactor.lag")
+            monitor.lag.reset()
+
+            for name, blocked in monitor.worst(self.offenders):
+                add('Time blocking the reactor', blocked,
+                    "reactor.slow.%s" % name)
+
+        if self.pipeline:
+            for source in self.duct.sources:
+                self._addTimings(
+                    batch, source.timings,
+                    "pipeline.source.%s" % source.config['service'])
+
+        for outputs in self.duct.outputs.values():
+            # Sharded outputs are reported along with each shard
+            for output in [shard for output in outputs
+                           for shard in [output] + getattr(
+                               output, 'shards', [])]:
+                prefix = "pipeline.output.%s" % output.name
+                if self.pipeline:
+                    self._addTimings(batch, output.timings, prefix)
+                add('Queued events', output.queueSize(), prefix + ".queued")
+                add('Bytes sent', output.bytesSent, prefix + ".bytes")
+
+                queue = output.events
+                add('Shed events', queue.shed,
+                    "%s.shed.%s" % (prefix, queue.policy))
+
+                datagrams = getattr(output, 'datagrams', {})
+                for name, count in sorted(datagrams.items()):
+                    add('Datagrams %s' % name, count,
+                        "%s.datagrams.%s" % (prefix, name))
+
+                if output.spool is not None:
+                    add('Spooled events', output.spooled,
+                        prefix + ".spool.spooled")
+                    add('Replayed events', output.replayed,
+                        prefix + ".spool.replayed")
+                    add('Spool pending bytes', output.spool.pending(),
+                        prefix + ".spool.pending")
+                    add('Spool dropped bytes', output.spool.dropped,
+                        prefix + ".spool.dropped")
+
+        return batch
+
+    def _addTimings(self, batch, timings, prefix):
+        """Add p50, p99 and max of each stage in `timings` to `batch`, and
+        reset them"""
+        for stage, hist in timings.items():
+            self._addHistogram(batch, stage + ' time', hist,
+                               "%s.%s" % (prefix, stage))
+        timings.reset()
+
+    def _addHistogram(self, batch, description, hist, prefix):
+        if not hist.count:
+            return
+        self.appendEvent(batch, 'ok', 'Median ' + description,
+                         hist.percentile(50), prefix=prefix + ".p50")
+        self.appendEvent(batch, 'ok', '99th percentile ' + description,
+                         hist.percentile(99), prefix=prefix + ".p99")
+        self.appendEvent(batch, 'ok', 'Maximum ' + description,
+                         hist.max, prefix=prefix + ".max")
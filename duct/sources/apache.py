@@ -40,6 +40,7 @@ class Apache(Source):
     :(service name).workers.busy: Busy workers
     :(service name).workers.idle: Idle workers
     """
+    resource = 'http'
 
     def _parse_stats(self, stats):
         stats = stats.strip('\n').split('\n')
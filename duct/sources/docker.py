@@ -40,6 +40,7 @@ class ContainerStats(Source):
     then `container name` will be used instead of that.
 
     """
+    resource = 'http'
 
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
@@ -36,6 +36,7 @@ class HAProxy(Source):
 
     :(service name).(backend|frontend|nodes).(stats): Various statistics
     """
+    resource = 'http'
 
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
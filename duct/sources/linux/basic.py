@@ -70,7 +70,7 @@ class DiskIO(Source):
         self.twc = {}
 
     def _parse_stats(self, stats):
-        events = []
+        events = self.createBatch()
         for s in stats:
             parts = s.strip().split()
             n = parts[2]
@@ -121,34 +121,27 @@ class DiskIO(Source):
                 self.tcache[n] = (reads, writes, read_t, write_t)
 
                 if read_lat:
-                    events.append(self.createEvent(
-                        'ok',
-                        'Read latency (ms)',
-                        read_lat,
-                        prefix='%s.read_latency' % dname
-                    ))
+                    self.appendEvent(events, 'ok', 'Read latency (ms)',
+                                     read_lat,
+                                     prefix='%s.read_latency' % dname)
 
                 if write_lat:
-                    events.append(self.createEvent(
-                        'ok',
-                        'Write latency (ms)', write_lat,
-                        prefix='%s.write_latency' % dname
-                    ))
-
-                events.extend([
-                    self.createEvent('ok', 'Reads', reads,
-                                     prefix='%s.reads' % dname,
-                                     aggregation=Counter64),
-                    self.createEvent('ok', 'Read Bps', read_sec * 512,
-                                     prefix='%s.read_bytes' % dname,
-                                     aggregation=Counter64),
-                    self.createEvent('ok', 'Writes', writes,
-                                     prefix='%s.writes' % dname,
-                                     aggregation=Counter64),
-                    self.createEvent('ok', 'Write Bps', write_sec * 512,
-                                     prefix='%s.write_bytes' % dname,
-                                     aggregation=Counter64),
-                ])
+                    self.appendEvent(events, 'ok', 'Write latency (ms)',
+                                     write_lat,
+                                     prefix='%s.write_latency' % dname)
+
+                self.appendEvent(events, 'ok', 'Reads', reads,
+                                 prefix='%s.reads' % dname,
+                                 aggregation=Counter64)
+                self.appendEvent(events, 'ok', 'Read Bps', read_sec * 512,
+                                 prefix='%s.read_bytes' % dname,
+                                 aggregation=Counter64)
+                self.appendEvent(events, 'ok', 'Writes', writes,
+                                 prefix='%s.writes' % dname,
+                                 aggregation=Counter64)
+                self.appendEvent(events, 'ok', 'Write Bps', write_sec * 512,
+                                 prefix='%s.write_bytes' % dname,
+                                 aggregation=Counter64)
 
         return events
 
@@ -241,46 +234,25 @@ class CPU(Source):
 
         return None
 
-    def _transpose_metrics(self, metrics, prefix):
+    def _transpose_metrics(self, metrics, prefix, events=None):
         if metrics:
-            events = [
-                self.createEvent('ok',
+            if events is None:
+                events = self.createBatch()
+
+            for name, cpu_m in metrics[1:]:
+                self.appendEvent(events, 'ok',
                                  'CPU %s %s%%' % (name, int(cpu_m * 100)),
                                  cpu_m, prefix=prefix+name)
-                for name, cpu_m in metrics[1:]
-            ]
 
-            events.append(self.createEvent(
-                'ok', 'CPU %s%%' % int(metrics[0][1] * 100), metrics[0][1],
-                prefix=prefix.rstrip('.')))
+            self.appendEvent(events, 'ok',
+                             'CPU %s%%' % int(metrics[0][1] * 100),
+                             metrics[0][1], prefix=prefix.rstrip('.'))
 
             return events
         return None
 
-    @defer.inlineCallbacks
-    def sshGet(self):
-        procstat, err, code = yield self.fork('cat /proc/stat')
-        if code == 0:
-            metrics = []
-            stat = procstat.strip('\n').split('\n')
-            for cpu in stat:
-                if not cpu.startswith('cpu'):
-                    continue
-                if cpu.split()[0] == 'cpu':
-                    prefix = ""
-                else:
-                    prefix = 'core' + cpu.split()[0].strip('cpu') + '.'
-                stats = self._calculate_metrics(cpu)
-                if stats:
-                    metrics.extend(self._transpose_metrics(stats, prefix))
-
-            defer.returnValue(metrics or None)
-        else:
-            raise Exception(err)
-
-    def get(self):
-        stat = self._read_proc_stat()
-        metrics = []
+    def _parse_stats(self, stat):
+        events = self.createBatch()
         for cpu in stat:
             if not cpu.startswith('cpu'):
                 continue
@@ -290,9 +262,21 @@ class CPU(Source):
                 prefix = 'core' + cpu.split()[0].strip('cpu') + '.'
             stats = self._calculate_metrics(cpu)
             if stats:
-                metrics.extend(self._transpose_metrics(stats, prefix))
+                self._transpose_metrics(stats, prefix, events)
+
+        return events or None
 
-        return metrics or None
+    @defer.inlineCallbacks
+    def sshGet(self):
+        procstat, err, code = yield self.fork('cat /proc/stat')
+        if code == 0:
+            defer.returnValue(
+                self._parse_stats(procstat.strip('\n').split('\n')))
+        else:
+            raise Exception(err)
+
+    def get(self):
+        return self._parse_stats(self._read_proc_stat())
 
 
 @implementer(IDuctSource)
@@ -353,6 +337,7 @@ class DiskFree(Source):
     """
 
     ssh = True
+    resource = 'fork'
 
     @defer.inlineCallbacks
     def get(self):
@@ -404,7 +389,7 @@ class Network(Source):
 
     def _parse_stats(self, stats):
         ifaces = self.config.get('interfaces')
-        ev = []
+        ev = self.createBatch()
 
         for stat in stats:
             items = stat.split()
@@ -420,32 +405,17 @@ class Network(Source):
             rx_packets = int(items[10])
             rx_err = int(items[11])
 
-            ev.extend([
-                self.createEvent('ok',
-                                 'Network %s TX bytes/sec' % (iface),
-                                 tx_bytes, prefix='%s.tx_bytes' % iface,
-                                 aggregation=Counter64),
-                self.createEvent('ok',
-                                 'Network %s TX packets/sec' % (iface),
-                                 tx_packets, prefix='%s.tx_packets' % iface,
-                                 aggregation=Counter64),
-                self.createEvent('ok',
-                                 'Network %s TX errors/sec' % (iface),
-                                 tx_err, prefix='%s.tx_errors' % iface,
-                                 aggregation=Counter64),
-                self.createEvent('ok',
-                                 'Network %s RX bytes/sec' % (iface),
-                                 rx_bytes, prefix='%s.rx_bytes' % iface,
-                                 aggregation=Counter64),
-                self.createEvent('ok',
-                                 'Network %s RX packets/sec' % (iface),
-                                 rx_packets, prefix='%s.rx_packets' % iface,
-                                 aggregation=Counter64),
-                self.createEvent('ok',
-                                 'Network %s RX errors/sec' % (iface),
-                                 rx_err, prefix='%s.rx_errors' % iface,
-                                 aggregation=Counter64),
-            ])
+            for name, label, metric in (
+                    ('tx_bytes', 'TX bytes/sec', tx_bytes),
+                    ('tx_packets', 'TX packets/sec', tx_packets),
+                    ('tx_errors', 'TX errors/sec', tx_err),
+                    ('rx_bytes', 'RX bytes/sec', rx_bytes),
+                    ('rx_packets', 'RX packets/sec', rx_packets),
+                    ('rx_errors', 'RX errors/sec', rx_err)):
+                self.appendEvent(ev, 'ok',
+                                 'Network %s %s' % (iface, label),
+                                 metric, prefix='%s.%s' % (iface, name),
+                                 aggregation=Counter64)
 
         return ev
 
@@ -22,6 +22,7 @@ class StrongSwan(Source):
     :(service name).(peer name): Tunnel status
     """
     ssh = True
+    resource = 'fork'
 
     @defer.inlineCallbacks
     def get(self):
@@ -25,6 +25,7 @@ class ProcessCount(Source):
     """
 
     ssh = True
+    resource = 'fork'
 
     @defer.inlineCallbacks
     def get(self):
@@ -50,6 +51,7 @@ class ProcessStats(Source):
     """
 
     ssh = True
+    resource = 'fork'
 
     @defer.inlineCallbacks
     def get(self):
@@ -105,6 +105,7 @@ class LMSensors(Source):
     :(service name).(adapter).(sensor): Sensor value
     """
     ssh = True
+    resource = 'fork'
 
     @defer.inlineCallbacks
     def _get_sensors(self):
@@ -174,6 +175,7 @@ class SMART(Source):
     """
 
     ssh = True
+    resource = 'fork'
 
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
@@ -31,6 +31,7 @@ class DarwinRTSP(Source):
     You can also override the `hostname` argument to make it match
     metrics from that host.
     """
+    resource = 'fork'
 
     @defer.inlineCallbacks
     def get(self):
@@ -40,6 +40,7 @@ class HTTP(Source):
 
     :(service name).latency: Time to complete request
     """
+    resource = 'http'
 
     @defer.inlineCallbacks
     def get(self):
@@ -41,6 +41,7 @@ class Nginx(Source):
     :(service name).writing: Writing responses
     :(service name).waiting: Waiting connections
     """
+    resource = 'http'
 
     def _parse_nginx_stats(self, stats):
         stats = stats.split('\n')
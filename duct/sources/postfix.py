@@ -38,6 +38,7 @@ class Postfix(Source):
     :(service_name).bounce:
     """
     ssh = True
+    resource = 'fork'
 
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
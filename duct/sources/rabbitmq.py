@@ -35,6 +35,7 @@ class Queues(Source):
 
     """
     ssh = True
+    resource = 'fork'
 
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
@@ -34,6 +34,7 @@ class Queues(Source):
     :(service_name): Queue rate
     """
     ssh = True
+    resource = 'fork'
 
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
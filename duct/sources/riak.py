@@ -17,7 +17,7 @@ from twisted.web.http_headers import Headers
 from duct.interfaces import IDuctSource
 from duct.objects import Source
 
-from duct.utils import BodyReceiver
+from duct.utils import BodyReceiver, getPool
 
 
 @implementer(IDuctSource)
@@ -35,10 +35,11 @@ class RiakStats(Source):
 
     :(service name).latency: Time to complete request
     """
+    resource = 'http'
 
     @defer.inlineCallbacks
     def _get_stats_from_node(self):
-        agent = Agent(reactor)
+        agent = Agent(reactor, pool=getPool())
 
         url = self.config.get('url', 'http://%s:8098/stats' % self.hostname)
         ua = self.config.get('useragent', 'Duct Riak stats checker')
@@ -24,6 +24,14 @@ class RiemannTCPServer(riemann.RiemannProtocol):
         riemann.RiemannProtocol.__init__(self)
         self.source = source
 
+    def connectionMade(self):
+        self.factory.clients.add(self)
+        if self.factory.paused:
+            self.transport.pauseProducing()
+
+    def connectionLost(self, reason):
+        self.factory.clients.discard(self)
+
     def stringReceived(self, string):
         message = self.decodeMessage(string)
 
@@ -45,9 +53,27 @@ class RiemannTCPFactory(Factory):
     """
     def __init__(self, source):
         self.source = source
+        self.clients = set()
+        self.paused = False
 
     def buildProtocol(self, addr):
-        return RiemannTCPServer(self.source)
+        proto = RiemannTCPServer(self.source)
+        proto.factory = self
+        return proto
+
+    def pauseProducing(self):
+        """Stop reading from all clients
+        """
+        self.paused = True
+        for client in self.clients:
+            client.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """Start reading from all clients again
+        """
+        self.paused = False
+        for client in self.clients:
+            client.transport.resumeProducing()
 
 @implementer(IDuctSource)
 class RiemannTCP(Source):
@@ -59,12 +85,28 @@ class RiemannTCP(Source):
     :param port: Port to listen on (default 5555)
     :type port: int.
 
+    While paused by backpressure the server stops reading from its clients,
+    so they are slowed down by TCP flow control.
     """
+    factory = None
+
     def startTimer(self):
         """Creates a Riemann TCP server instead of a timer
         """
-        reactor.listenTCP(int(self.config.get('port', 5555)),
-                          RiemannTCPFactory(self))
+        self.factory = RiemannTCPFactory(self)
+        reactor.listenTCP(int(self.config.get('port', 5555)), self.factory)
+
+        # Backpressure may have been applied before we started
+        if self.backpressure == 'pause':
+            self.pauseProducing()
+
+    def pauseProducing(self):
+        if self.factory is not None:
+            self.factory.pauseProducing()
+
+    def resumeProducing(self):
+        if self.factory is not None:
+            self.factory.resumeProducing()
 
     def get(self):
         pass
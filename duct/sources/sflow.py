@@ -63,19 +63,19 @@ class sFlowReceiver(server.DatagramReceiver):
             port['src'][sport] += cbytes
             port['dst'][dport] += cbytes
 
+        events = self.source.createBatch()
+
         for direction, v in addr.items():
             for ip, cbytes in v.items():
                 m = ((cbytes/float(btotal)) * deltaIn)/tDelta
 
-                self.source.queueBack(
-                    self.source.createEvent(
-                        'ok',
-                        'sFlow if:%s addr:%s inOctets/sec %0.2f' % (idx,
-                                                                    ip, m),
-                        m,
-                        prefix='%s.ip.%s.%s' % (idx, ip, direction),
-                        hostname=host
-                    )
+                self.source.appendEvent(
+                    events,
+                    'ok',
+                    'sFlow if:%s addr:%s inOctets/sec %0.2f' % (idx, ip, m),
+                    m,
+                    prefix='%s.ip.%s.%s' % (idx, ip, direction),
+                    hostname=host
                 )
 
         for direction, v in port.items():
@@ -83,18 +83,19 @@ class sFlowReceiver(server.DatagramReceiver):
                 m = ((cbytes/float(btotal)) * deltaIn)/tDelta
 
                 if port:
-                    self.source.queueBack(
-                        self.source.createEvent(
-                            'ok',
-                            'sFlow if:%s port:%s inOctets/sec %0.2f' % (idx,
-                                                                        port,
-                                                                        m),
-                            m,
-                            prefix='%s.port.%s.%s' % (idx, port, direction),
-                            hostname=host
-                        )
+                    self.source.appendEvent(
+                        events,
+                        'ok',
+                        'sFlow if:%s port:%s inOctets/sec %0.2f' % (idx, port,
+                                                                    m),
+                        m,
+                        prefix='%s.port.%s.%s' % (idx, port, direction),
+                        hostname=host
                     )
 
+        if events:
+            self.source.queueBack(events)
+
     def receive_flow(self, flow, sample, host):
         def queueFlow(host):
             """Queue the incomming flows per host
@@ -152,20 +153,22 @@ class sFlowReceiver(server.DatagramReceiver):
                     self.convoQueue[host][idx] = []
                     self.process_convo_queue(queue, host, idx, deltaIn, tDelta)
 
-                self.source.queueBack([
-                    self.source.createEvent(
-                        'ok',
-                        'sFlow index %s inOctets/sec %0.2f' % (idx, inRate),
-                        inRate,
-                        prefix='%s.inOctets' % idx, hostname=host
-                    ),
-                    self.source.createEvent(
-                        'ok',
-                        'sFlow index %s outOctets/sec %0.2f' % (idx, outRate),
-                        outRate,
-                        prefix='%s.outOctets' % idx, hostname=host
-                    ),
-                ])
+                events = self.source.createBatch()
+                self.source.appendEvent(
+                    events,
+                    'ok',
+                    'sFlow index %s inOctets/sec %0.2f' % (idx, inRate),
+                    inRate,
+                    prefix='%s.inOctets' % idx, hostname=host
+                )
+                self.source.appendEvent(
+                    events,
+                    'ok',
+                    'sFlow index %s outOctets/sec %0.2f' % (idx, outRate),
+                    outRate,
+                    prefix='%s.outOctets' % idx, hostname=host
+                )
+                self.source.queueBack(events)
 
             else:
                 self.counterCache[host][idx] = (
@@ -194,7 +197,11 @@ class sFlow(Source):
     (device).(service name).(interface).(in|out)Octets
     (device).(service name).(interface).ip
     (device).(service name).(interface).port
+
+    While paused by backpressure the collector stops reading datagrams, so
+    they are dropped by the kernel once its socket buffer is full.
     """
+    listener = None
 
     def get(self):
         pass
@@ -202,4 +209,17 @@ class sFlow(Source):
     def startTimer(self):
         """Creates a sFlow datagram server
         """
-        reactor.listenUDP(self.config.get('port', 6343), sFlowReceiver(self))
+        self.listener = reactor.listenUDP(self.config.get('port', 6343),
+                                          sFlowReceiver(self))
+
+        # Backpressure may have been applied before we started
+        if self.backpressure == 'pause':
+            self.pauseProducing()
+
+    def pauseProducing(self):
+        if self.listener is not None:
+            self.listener.stopReading()
+
+    def resumeProducing(self):
+        if self.listener is not None:
+            self.listener.startReading()
@@ -111,6 +111,7 @@ class SNMP(Source):
     :param community: SNMP read community
     :type community: str.
     """
+    resource = 'snmp'
 
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
@@ -27,6 +27,7 @@ class Stats(Source):
 
     """
     ssh = True
+    resource = 'fork'
 
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
@@ -0,0 +1,269 @@
+"""
+.. module:: spool
+   :synopsis: Disk spool for events an output can't hold in memory
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+# Record header of payload length and CRC32. A zero length marks the end of
+# the records in a segment, since segments are created full of zeros
+RECORD = struct.Struct('>II')
+END = b'\x00' * RECORD.size
+
+
+class Segment(object):
+    """A spool segment file, created at a fixed size and memory mapped.
+    Records are appended in place, and the end of an existing segment is
+    found by reading records until one is missing, truncated or fails its
+    checksum, so a write torn by a crash is discarded.
+
+    :param path: Segment file path
+    :type path: str.
+    :param base: Position of this segment in the spool as a whole
+    :type base: int.
+    :param size: Size to create the file with, if it doesn't exist
+    :type size: int.
+    """
+    def __init__(self, path, base, size=None):
+        self.path = path
+        self.base = base
+
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(size)
+
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+        # Recovery reads records up to the end of the file
+        self.end = self.size
+        self.end = self._recover() if exists else 0
+
+    def _recover(self):
+        position = 0
+        while True:
+            data, following = self.read(position)
+            if data is None:
+                return position
+            position = following
+
+    def read(self, position):
+        """Return the record at `position` and the position after it, or
+        (None, `position`) if there are no more records
+        """
+        start = position + RECORD.size
+        if start > self.end:
+            return None, position
+
+        length, crc = RECORD.unpack_from(self.map, position)
+        if (length == 0) or (start + length > self.end):
+            return None, position
+
+        data = self.map[start:start + length]
+        if (zlib.crc32(data) & 0xffffffff) != crc:
+            return None, position
+
+        return data, start + length
+
+    def append(self, data):
+        """Append a record, returning False if it doesn't fit
+        """
+        start = self.end + RECORD.size
+        end = start + len(data)
+        if end > self.size:
+            return False
+
+        self.map[start:end] = data
+        self.map[self.end:start] = RECORD.pack(
+            len(data), zlib.crc32(data) & 0xffffffff)
+
+        # Leftovers of a torn record can follow a recovered end
+        if end + RECORD.size <= self.size:
+            self.map[end:end + RECORD.size] = END
+
+        self.end = end
+        return True
+
+    def sync(self):
+        """Flush written records to disk
+        """
+        self.map.flush()
+
+    def close(self):
+        """Flush and close the segment
+        """
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    def remove(self):
+        """Close and delete the segment
+        """
+        self.close()
+        os.unlink(self.path)
+
+class Spool(object):
+    """Append-only log of records on disk, split into memory mapped segments
+
+    Records are read back in the order they were written. The read position
+    is only saved by :meth:`commit`, which writes it to an `offset` file
+    atomically and deletes segments which have been read completely, so
+    after a crash reading resumes from the last commit.
+
+    The segments take up at most `maxBytes`. When a new segment would go
+    over that the oldest segments are deleted, unread or not, and the bytes
+    lost are counted in `dropped`.
+
+    :param directory: Directory to keep segments in
+    :type directory: str.
+    :param maxBytes: Maximum size of all segments (default: 1GB)
+    :type maxBytes: int.
+    :param segmentSize: Size of each segment (default: 64MB)
+    :type segmentSize: int.
+    """
+    def __init__(self, directory, maxBytes=1 << 30, segmentSize=64 << 20):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.segmentSize = max(4096, min(segmentSize, maxBytes // 2))
+        self.offsetPath = os.path.join(directory, 'offset')
+        self.dropped = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.segments = [
+            Segment(os.path.join(directory, name), int(name.split('.')[0]))
+            for name in sorted(os.listdir(directory))
+            if name.endswith('.seg')]
+
+        if not self.segments:
+            self.segments.append(self._createSegment(0, self.segmentSize))
+
+        self.readSegment = self.segments[0]
+        self.readPosition = 0
+
+        base, position = self._loadOffset()
+        for segment in self.segments:
+            if segment.base == base:
+                self.readSegment = segment
+                self.readPosition = min(position, segment.end)
+
+    def _createSegment(self, base, size):
+        return Segment(os.path.join(self.directory, '%020d.seg' % base),
+                       base, size)
+
+    def _loadOffset(self):
+        try:
+            with open(self.offsetPath, 'rt') as offset:
+                base, position = offset.read().split()
+            return int(base), int(position)
+        except (IOError, OSError, ValueError):
+            return None, 0
+
+    def append(self, data):
+        """Append a record to the spool
+        """
+        if not self.segments[-1].append(data):
+            self._rotate(len(data)).append(data)
+
+    def _rotate(self, length):
+        last = self.segments[-1]
+        last.sync()
+
+        size = max(self.segmentSize, length + 2 * RECORD.size)
+        while self.segments and (
+                self.diskSize() + size > self.maxBytes):
+            self._drop(self.segments[0])
+
+        segment = self._createSegment(last.base + last.size, size)
+        self.segments.append(segment)
+
+        if self.readSegment not in self.segments:
+            self.readSegment = segment
+            self.readPosition = 0
+
+        return segment
+
+    def _drop(self, segment):
+        index = self.segments.index(segment)
+        readIndex = self.segments.index(self.readSegment)
+        if index == readIndex:
+            self.dropped += segment.end - self.readPosition
+        elif index > readIndex:
+            self.dropped += segment.end
+
+        del self.segments[index]
+        segment.remove()
+
+        if segment is self.readSegment:
+            if self.segments:
+                self.readSegment = self.segments[0]
+            self.readPosition = 0
+
+    def read(self):
+        """Return the next unread record, or None
+        """
+        while True:
+            data, position = self.readSegment.read(self.readPosition)
+            if data is not None:
+                self.readPosition = position
+                return data
+
+            index = self.segments.index(self.readSegment)
+            if index + 1 >= len(self.segments):
+                return None
+
+            self.readSegment = self.segments[index + 1]
+            self.readPosition = 0
+
+    def commit(self):
+        """Save the read position and delete segments which have been read
+        """
+        index = self.segments.index(self.readSegment)
+        for segment in self.segments[:index]:
+            segment.remove()
+        del self.segments[:index]
+
+        temp = self.offsetPath + '.tmp'
+        with open(temp, 'wt') as offset:
+            offset.write('%d %d\n' % (self.readSegment.base,
+                                      self.readPosition))
+            offset.flush()
+            os.fsync(offset.fileno())
+        os.rename(temp, self.offsetPath)
+
+    def pending(self):
+        """Number of bytes of records which haven't been read
+        """
+        index = self.segments.index(self.readSegment)
+        return sum(segment.end for segment in self.segments[index:]) - (
+            self.readPosition)
+
+    def hasRoom(self):
+        """True while another segment can be added without dropping records
+        which haven't been read
+        """
+        return self.pending() + self.segmentSize <= self.maxBytes
+
+    def diskSize(self):
+        """Number of bytes taken by segment files
+        """
+        return sum(segment.size for segment in self.segments)
+
+    def sync(self):
+        """Flush the segment being written to disk
+        """
+        self.segments[-1].sync()
+
+    def close(self):
+        """Flush and close all segments. Records read since the last commit
+        will be read again when the spool is reopened
+        """
+        for segment in self.segments:
+            segment.close()
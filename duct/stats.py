@@ -0,0 +1,105 @@
+"""
+.. module:: stats
+   :synopsis: Lightweight statistics used for self monitoring
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import math
+
+
+class Histogram(object):
+    """Histogram of durations with logarithmically sized buckets
+
+    Each bucket is `factor` times wider than the one before, starting at
+    `base` seconds, so percentiles are accurate to within `factor` across
+    several orders of magnitude while recording stays O(1).
+
+    :param base: Upper bound of the first bucket in seconds
+    :type base: float.
+    :param factor: Growth factor between buckets
+    :type factor: float.
+    :param size: Number of buckets. Larger values go in the last bucket
+    :type size: int.
+    """
+    def __init__(self, base=0.0001, factor=1.25, size=100):
+        self.base = base
+        self.factor = factor
+        self.scale = 1 / math.log(factor)
+        self.buckets = [0] * size
+        self.reset()
+
+    def reset(self):
+        """Clear all recorded values
+        """
+        self.buckets = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """Record a duration of `value` seconds
+        """
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+        if value <= self.base:
+            index = 0
+        else:
+            index = min(int(math.ceil(math.log(value / self.base) *
+                                      self.scale)),
+                        len(self.buckets) - 1)
+        self.buckets[index] += 1
+
+    def percentile(self, pct):
+        """Return an upper bound for the `pct` percentile
+        """
+        if not self.count:
+            return 0.0
+
+        rank = self.count * pct / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and (seen >= rank):
+                return min(self.base * (self.factor ** index), self.max)
+
+        return self.max
+
+    def mean(self):
+        """Mean of recorded values
+        """
+        return (self.total / self.count) if self.count else 0.0
+
+class Timings(object):
+    """A set of named :class:`Histogram` objects, one for each stage of the
+    pipeline being timed
+    """
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, stage, value):
+        """Record `value` seconds for `stage`
+        """
+        hist = self.histograms.get(stage)
+        if hist is None:
+            hist = self.histograms[stage] = Histogram()
+        hist.record(value)
+
+    def get(self, stage):
+        """Return the Histogram for `stage`, or None
+        """
+        return self.histograms.get(stage)
+
+    def items(self):
+        """Return (stage, Histogram) pairs sorted by stage
+        """
+        return sorted(self.histograms.items())
+
+    def reset(self):
+        """Reset all histograms
+        """
+        for hist in self.histograms.values():
+            hist.reset()
@@ -769,3 +769,53 @@ health,FRONTEND,,,0,0,6000,0,0,0,0,0,0,,,,,OPEN,,,,,,,,,1,11,0,,,,0,0,0,0,,,,,,,
 health,BACKEND,0,0,0,0,600,0,0,0,0,0,,0,0,0,0,UP,0,0,0,,0,34,0,,1,11,0,,0,,1,0,,0,,,,,,,,,,,,,,0,0,0,0,0,0,-1,,,0,0,0,0,
 health,FRONTEND,,,0,0,6000,0,0,0,0,0,0,,,,,OPEN,,,,,,,,,1,12,0,,,,0,0,0,0,,,,,,,,,,,0,0,0,,,0,0,0,0,,,,,,,,
 health,BACKEND,0,0,0,0,600,0,0,0,0,0,,0,0,0,0,UP,0,0,0,,0,34,0,,1,12,0,,0,,1,0,,0,,,,,,,,,,,,,,0,0,0,0,0,0,-1,,,0,0,0,0,\n"""
+
+PROC_STAT = """cpu  2255 34 2290 25563 6290 127 456 0 0 0
+cpu0 564 8 572 6390 1572 31 114 0 0 0
+cpu1 563 9 573 6391 1573 32 114 0 0 0
+cpu2 564 8 572 6391 1572 32 114 0 0 0
+cpu3 564 9 573 6391 1573 32 114 0 0 0
+intr 114930548 113199788 3 0 5 263 0 0 0 1 0 0 0 0 0 0 0 0
+ctxt 1990473
+btime 1062191376
+processes 2915
+procs_running 1
+procs_blocked 0"""
+
+PROC_STAT_NEXT = """cpu  4510 68 4580 51126 12580 254 912 0 0 0
+cpu0 1128 17 1145 12781 3145 63 228 0 0 0
+cpu1 1127 17 1145 12782 3145 63 228 0 0 0
+cpu2 1128 17 1145 12781 3145 64 228 0 0 0
+cpu3 1127 17 1145 12782 3145 64 228 0 0 0
+intr 114932019 113201259 3 0 5 263 0 0 0 1 0 0 0 0 0 0 0 0
+ctxt 1991210
+btime 1062191376
+processes 2917
+procs_running 2
+procs_blocked 0"""
+
+PROC_DISKSTATS = """   1       0 ram0 0 0 0 0 0 0 0 0 0 0 0
+   7       0 loop0 0 0 0 0 0 0 0 0 0 0 0
+   8       0 sda 84211 12313 4419654 51348 165390 179263 5738872 380016 0 104624 431304
+   8       1 sda1 83844 12313 4416742 51224 163128 179263 5738872 379240 0 104024 430408
+   8      16 sdb 2183 188 92954 1848 46 48 752 184 0 1448 2032
+   8      17 sdb1 2001 188 91410 1708 46 48 752 184 0 1336 1892
+ 202       2 xvda2 2 0 4 64 0 0 0 0 0 64 64
+ 202      32 xvdc 576 10 3739 748 144 0 4497 18080 0 8616 18828
+ 202      33 xvdc1 423 0 2435 264 144 0 4497 18080 0 8132 18344"""
+
+PROC_NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo: 74383646    7872    0    0    0     0          0         0 74383646    7872    0    0    0     0       0          0
+  eth0: 2164780318 2387106    0    0    0     0          0     14207 231718293 1402871    0    0    0     0       0          0
+  eth1: 1072881    9876    0    0    0     0          0         0   816238    7812    0    0    0     0       0          0
+docker0:  6012745   52983    0    0    0     0          0         0 289167063   88671    0    0    0     0       0          0
+ wlan0: 8201739   10722    0   14    0     0          0         0  1208384    8931    0    0    0     0       0          0"""
+
+NGINX_STATS = """Active connections: 3
+server accepts handled requests
+ 20649 20649 686969
+Reading: 0 Writing: 1 Waiting: 2
+"""
+
+APACHE_LOG_COMBINED = '192.168.0.102 - - [16/Jan/2015:11:11:45 +0200] "GET / HTTP/1.1" 200 709 "-" "My browser"'
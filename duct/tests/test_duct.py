@@ -7,8 +7,9 @@ from twisted.trial import unittest
 from twisted.internet import defer, reactor, error
 from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
 
+from duct.ihateprotobuf import proto_pb2
 from duct.protocol import riemann, elasticsearch, opentsdb
-from duct.objects import Event
+from duct.objects import Event, EventBatch
 from duct.utils import fork
 from duct.configuration import ConfigFile
 from duct.tests import globs
@@ -92,6 +93,58 @@ class Tests(unittest.TestCase):
         # Well, I guess we'll just assume this is right
         message = proto.encodeMessage([event])
 
+    def test_riemann_protobuf_batch(self):
+        proto = riemann.RiemannProtocol()
+
+        events = [
+            Event('ok', 'sky', 'Sky has not fallen', 1.0, 60.0,
+                  hostname='localhost', attributes={"chicken": "little"}),
+            Event('ok', 'sky.count', 'Chickens', 3, 60.0,
+                  hostname='localhost'),
+        ]
+
+        self.assertEqual(proto.encodeMessage(EventBatch.fromEvents(events)),
+                         proto.encodeMessage(events))
+
+    def test_riemann_encoder(self):
+        proto = riemann.RiemannProtocol()
+
+        events = [
+            Event('ok', 'sky', 'Sky has not fallen', 1.0, 60.0,
+                  hostname='localhost', attributes={"chicken": "little"}),
+            Event('ok', 'sky', 'Sky has not fallen', 2.5, 60.0,
+                  hostname='localhost', attributes={"chicken": "little"}),
+            Event('critical', 'sky', 'Sky is falling', -3, 30.0,
+                  hostname='localhost', tags=['acorn']),
+            Event('ok', 'sky.count', 'Chickens', 2**62, 60.0,
+                  hostname='localhost', evtime=-1),
+            Event(None, 'sky.size', None, 1e39, None, evtime=0),
+            Event('ok', 'sky.gone', 'Nothing', None, 60.0,
+                  hostname='localhost'),
+        ]
+
+        # The cached encoding matches protobuf, including when a series'
+        # description or tags change
+        expected = proto_pb2.Msg(events=[proto.encodeEvent(ev)
+                                         for ev in events])
+        self.assertEqual(proto.encodeMessage(events),
+                         expected.SerializeToString())
+        self.assertEqual(proto.encodeMessage(EventBatch.fromEvents(events)),
+                         expected.SerializeToString())
+        self.assertEqual(len(proto.encoder.series), 4)
+
+        # Descriptions which carry a value don't replace the cached fields
+        cached = proto.encoder.series[('localhost', 'sky.gone')]
+        tail = cached[4]
+        events = [Event('ok', 'sky.gone', u'%s acorns \xe9' % i, i, 60.0,
+                        hostname='localhost') for i in range(3)]
+        expected = proto_pb2.Msg(events=[proto.encodeEvent(ev)
+                                         for ev in events])
+        self.assertEqual(proto.encodeMessage(events),
+                         expected.SerializeToString())
+        self.assertTrue(
+            proto.encoder.series[('localhost', 'sky.gone')][4] is tail)
+
     def test_riemann_protobuf_with_attributes(self):
         proto = riemann.RiemannProtocol()
 
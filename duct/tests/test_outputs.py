@@ -1,10 +1,20 @@
 import json
+import os
+import shutil
+import socket
+import tempfile
 
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
 
-from duct.outputs import elasticsearch, opentsdb
-from duct.objects import Event
+from duct.ihateprotobuf import proto_pb2
+from duct.outputs import elasticsearch, opentsdb, riemann
+from duct.protocol.opentsdb import OpenTSDBClient
+from duct.protocol.riemann import RiemannClientFactory, RiemannUDP
+from duct.objects import Event, EventBatch, Output
+from duct.eventqueue import EventQueue
+from duct.spool import Spool
 from duct.service import DuctService
 
 class ManualLooper(object):
@@ -24,6 +34,16 @@ class ManualLooper(object):
 
         return defer.maybeDeferred(self.task)
 
+class FakeDatagramTransport(object):
+    def __init__(self):
+        self.written = []
+        self.refuse = False
+
+    def write(self, datagram, addr):
+        if self.refuse:
+            raise socket.error(105, 'No buffer space available')
+        self.written.append(datagram)
+
 class Tests(unittest.TestCase):
     def setUp(self):
         self.service = DuctService({})
@@ -75,3 +95,295 @@ class Tests(unittest.TestCase):
         requestData = json.loads(self.last_request[0][1])[0]
 
         self.assertEqual(requestData['metric'], 'sky')
+
+    def test_event_queue(self):
+        events = [Event('ok', 'series%s' % (i % 3), 'Test', float(i), 60.0)
+                  for i in range(6)]
+
+        queue = EventQueue(4)
+        self.assertEqual(queue.extend(events), (4, 0))
+        self.assertEqual(queue.shed, 2)
+        self.assertEqual([ev.metric for ev in queue.take(3)], [0, 1, 2])
+        self.assertEqual(len(queue), 1)
+
+        queue = EventQueue(4, 'drop-oldest')
+        self.assertEqual(queue.extend(events), (6, 2))
+        self.assertEqual([ev.metric for ev in queue.take()], [2, 3, 4, 5])
+
+        # The latest value of queued series replaces the older one
+        queue = EventQueue(3, 'latest')
+        queue.extend(events)
+        self.assertEqual(queue.shed, 3)
+        self.assertEqual([ev.metric for ev in queue.take(1)], [3])
+        queue.extend(events[:1])
+        self.assertEqual([ev.metric for ev in queue.take()], [4, 5, 0])
+
+        queue = EventQueue(4, 'sample', sampleFrom=0.5)
+        queue.extend(events * 10)
+        self.assertEqual(len(queue) + queue.shed, 60)
+        self.assertTrue(2 <= len(queue) <= 4)
+
+    def test_output_overflow(self):
+        out = Output({'overflow': 'drop-oldest'}, self.service)
+        out.maxsize = 2
+
+        out.eventsReceived([self.event] * 3)
+        self.assertEqual(len(out.events), 2)
+        self.assertEqual(out.events.shed, 1)
+        self.assertEqual(sum(mark[1] for mark in out.queueMarks), 2)
+
+        out.markDequeued(len(out.events.take()))
+        self.assertEqual(len(out.queueMarks), 0)
+
+    def make_spool_dir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return path
+
+    def test_spool(self):
+        path = self.make_spool_dir()
+
+        spool = Spool(path, maxBytes=40960, segmentSize=4096)
+        records = [('record %s ' % i).encode() * 50 for i in range(30)]
+        for record in records[:20]:
+            spool.append(record)
+
+        self.assertTrue(len(spool.segments) > 1)
+        self.assertEqual(spool.read(), records[0])
+        self.assertEqual(spool.read(), records[1])
+        spool.commit()
+        self.assertEqual(spool.read(), records[2])
+        spool.close()
+
+        # Reading resumes from the last commit, and a torn record at the end
+        # is discarded
+        with open(os.path.join(path, sorted(os.listdir(path))[-2]),
+                  'r+b') as segment:
+            data = segment.read()
+            end = data.index(records[19]) + len(records[19]) - 10
+            segment.seek(end)
+            segment.write(b'garbage')
+
+        spool = Spool(path, maxBytes=40960, segmentSize=4096)
+        self.assertEqual(spool.read(), records[2])
+        for record in records[20:]:
+            spool.append(record)
+
+        read = []
+        while True:
+            record = spool.read()
+            if record is None:
+                break
+            read.append(record)
+
+        self.assertEqual(read, records[3:19] + records[20:])
+        spool.commit()
+        self.assertEqual(spool.pending(), 0)
+        self.assertEqual(len(spool.segments), 1)
+
+        # The oldest segments are dropped to stay within maxBytes
+        for _ in range(10):
+            for record in records:
+                spool.append(record)
+        self.assertTrue(spool.diskSize() <= 40960)
+        self.assertTrue(spool.dropped > 0)
+        spool.close()
+
+    def test_output_spool(self):
+        out = Output({'spool': self.make_spool_dir(), 'spool_rate': 3},
+                     self.service)
+        out.maxsize = 4
+
+        events = [Event('ok', 'sky%s' % i, 'Sky', float(i), 60.0)
+                  for i in range(10)]
+        out.eventsReceived(events)
+        self.assertEqual(len(out.events), 4)
+        self.assertEqual(out.spooled, 6)
+
+        # The queue is full, but isn't backed up while the spool has room
+        self.assertFalse(out.pressured)
+        out.spool.maxBytes = 0
+        out.markDequeued(0)
+        self.assertTrue(out.pressured)
+        out.spool.maxBytes = 1 << 30
+        out.markDequeued(0)
+        self.assertFalse(out.pressured)
+
+        # Nothing is replayed until the queue drains
+        out.replaySpool()
+        self.assertEqual(out.replayed, 0)
+
+        # Replay stops at the low watermark
+        out.markDequeued(len(out.events.take()))
+        out.replaySpool()
+        self.assertEqual([ev.metric for ev in out.events], [4, 5])
+
+        # Queued and partly replayed events are spooled on shutdown
+        out.stopSpool()
+        spool = Spool(out.config['spool'])
+        batch = EventBatch.decode(spool.read())
+        self.assertEqual(batch.metrics, [4, 5, 6, 7, 8, 9])
+        spool.close()
+
+    def test_riemann_window(self):
+        out = riemann.RiemannTCP({'batch_bytes': 1, 'window': 4},
+                                 self.service)
+        out.factory = RiemannClientFactory('localhost')
+        out.factory.acked = out.messageAcked
+        out.factory.lost = out.messagesLost
+        proto = out.factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+
+        out.eventsReceived([Event('ok', 'sky%s' % i, 'Sky', float(i), 60.0)
+                            for i in range(10)])
+
+        # One event per message, and two messages in flight to start with
+        out.tick()
+        self.assertEqual(len(proto.inflight), 2)
+        self.assertEqual(len(out.events), 8)
+
+        # A window of acknowledgements opens the window by one
+        ack = proto_pb2.Msg(ok=True).SerializeToString()
+        proto.stringReceived(ack)
+        self.assertEqual(len(proto.inflight), 2)
+        proto.stringReceived(ack)
+        self.assertEqual(out.window, 3)
+        self.assertEqual(len(proto.inflight), 3)
+        self.assertEqual(len(out.events), 5)
+        self.assertEqual(out.timings.get('ack').count, 2)
+
+        # Unacknowledged events are queued again when the connection drops
+        class Connector(object):
+            host = 'localhost'
+            port = 5555
+
+        out.factory.stopTrying()
+        out.factory.clientConnectionLost(Connector(), None)
+        self.assertEqual(out.requeued, 3)
+        self.assertEqual(len(out.events), 8)
+        self.assertEqual(out.window, 2)
+
+    def test_riemann_shards(self):
+        out = riemann.RiemannTCP({'shard': True, 'server': ['a', 'b', 'c'],
+                                  'maxsize': 100}, self.service)
+        self.assertEqual([shard.name for shard in out.shards],
+                         ['RiemannTCP.a', 'RiemannTCP.b', 'RiemannTCP.c'])
+
+        for shard in out.shards:
+            shard.factory = RiemannClientFactory(shard.config['server'])
+            shard.factory.proto = True
+
+        def owners():
+            return dict((ev.service, shard.config['server'])
+                        for shard in out.shards for ev in shard.events)
+
+        events = [Event('ok', 'sky%s' % i, 'Sky', float(i), 60.0,
+                        hostname='localhost') for i in range(60)]
+        out.eventsReceived(events)
+        placed = owners()
+        self.assertEqual(len(placed), 60)
+        self.assertEqual(set(placed.values()), set(['a', 'b', 'c']))
+        self.assertEqual(out.queueSize(), 60)
+
+        # A series always goes to the same shard
+        out.eventsReceived(events)
+        for shard in out.shards:
+            self.assertEqual(len(set(ev.service for ev in shard.events)) * 2,
+                             len(shard.events))
+
+        # When a shard drops its events move to the others, and no other
+        # series move
+        dropped = out.shards[1]
+        dropped.factory.proto = None
+        out.updateShards()
+        self.assertEqual(len(dropped.events), 0)
+        self.assertEqual(out.queueSize(), 120)
+        moved = owners()
+        for service, server in placed.items():
+            if server != 'b':
+                self.assertEqual(moved[service], server)
+
+        # Its series return when it recovers
+        for shard in out.shards:
+            shard.markDequeued(len(shard.events.take()))
+        dropped.factory.proto = True
+        out.eventsReceived(events)
+        self.assertEqual(owners(), placed)
+
+        # Any backed up shard holds back the output
+        out.shards[0].eventsReceived(events)
+        self.assertTrue(out.pressured)
+        self.assertIn(out, self.service.pressured)
+        out.shards[0].markDequeued(len(out.shards[0].events.take()))
+        self.assertFalse(out.pressured)
+
+    def test_riemann_udp_packing(self):
+        out = riemann.RiemannUDP({'max_datagram': 200}, self.service)
+        out.protocol = RiemannUDP('127.0.0.1', 5555)
+        transport = FakeDatagramTransport()
+        out.protocol.makeConnection(transport)
+
+        events = [Event('ok', 'sky%s' % i, 'Sky', float(i), 60.0,
+                        hostname='localhost') for i in range(20)]
+        events.append(Event('ok', 'big', 'x' * 300, 1.0, 60.0))
+        out.eventsReceived(events[:10])
+        out.eventsReceived(events[10:])
+
+        # Events are buffered until the flush
+        self.assertEqual(transport.written, [])
+        self.assertTrue(out.flushCall.active())
+        out.flushCall.cancel()
+        out.flush()
+
+        self.assertTrue(len(transport.written) > 1)
+        received = []
+        for datagram in transport.written:
+            self.assertTrue(len(datagram) <= 200)
+            received.extend(proto_pb2.Msg.FromString(datagram).events)
+        self.assertEqual([ev.service for ev in received],
+                         [ev.service for ev in events[:20]])
+
+        # Packed datagrams are identical to encoding the events at once
+        self.assertEqual(b''.join(transport.written),
+                         out.protocol.encodeMessage(events[:20]))
+
+        self.assertEqual(out.datagrams, {
+            'sent': len(transport.written), 'dropped': 0, 'oversize': 1})
+        self.assertEqual(out.bytesSent, sum(map(len, transport.written)))
+
+        transport.refuse = True
+        out.eventsReceived(events[:1])
+        out.stop()
+        self.assertEqual(out.datagrams['dropped'], 1)
+
+    def test_shared_serialization(self):
+        batch = EventBatch.fromEvents([
+            Event('ok', 'sky%s' % i, 'Sky', float(i), 60.0,
+                  hostname='localhost') for i in range(4)])
+        batch.shareEncodings()
+
+        outputs = [opentsdb.OpenTSDB({}, self.service) for _ in range(2)]
+        for out in outputs:
+            out.client = OpenTSDBClient()
+            out.client._request = lambda path, data: data
+            out.eventsReceived(batch)
+
+        # Queued events are serialized by the first output only
+        first = outputs[0].sendEvents(outputs[0].events.take())
+        self.assertEqual(json.loads(first), outputs[0].transformBatch(batch))
+
+        def transformRow(batch, i):
+            raise Exception("Event serialized twice")
+
+        outputs[1].transformRow = transformRow
+        self.assertEqual(outputs[1].sendEvents(outputs[1].events.take()),
+                         first)
+        self.assertEqual(sorted(batch.encoded[0]), ['opentsdb'])
+
+        # Shared rows follow events into other batches, but new events
+        # aren't shared
+        self.assertEqual(batch[1:].select([0]).encoded, [batch.encoded[1]])
+        self.assertEqual(EventBatch.fromEvents(list(batch)).encoded,
+                         batch.encoded)
+        self.assertEqual(EventBatch.fromEvents(
+            [Event('ok', 'sky', 'Sky', 1.0, 60.0)]).encoded, None)
@@ -1,15 +1,29 @@
+import os
+import shutil
+import tempfile
+import time
+
 from twisted.trial import unittest
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet.protocol import ServerFactory
 from twisted.protocols.basic import Int32StringReceiver
 
 from duct.ihateprotobuf import proto_pb2
-from duct.objects import Event, Source, Output
+from duct.objects import Event, EventBatch, Source, Output
 from duct.protocol.riemann import RiemannClientFactory
 from duct.service import DuctService
-from duct.aggregators import Counter32, Counter64, Counter
+from duct.configuration import ConfigurationError
+from duct.triggers import Triggers, compileExpression
+from duct import workers
+from duct.governor import Governor
+from duct.monitor import ReactorMonitor
+from duct.profiler import Profiler, MemoryTracker
+from duct.stats import Histogram, Timings
+from duct.scheduler import Scheduler, TimingWheel
+from duct.aggregators import Counter32, Counter64, Counter, CounterState
+from duct.series import SeriesRegistry
 
 
 def wait(secs):
@@ -78,7 +92,19 @@ class FakeRiemannServerFactory(ServerFactory):
 
 
 class FakeSource(Source):
-    pass
+    def block(self, secs):
+        time.sleep(secs)
+
+class TickSource(object):
+    def __init__(self, service, interval, **config):
+        self.config = dict(config, service=service)
+        self.inter = interval
+        self.running = False
+        self.ticks = 0
+        self.timings = Timings()
+
+    def tick(self):
+        self.ticks += 1
 
 class FakeOutput(Output):
     def __init__(self, *a):
@@ -208,6 +234,89 @@ class TestService(unittest.TestCase):
         metric = self._aggregator_test(18446744073709551610, 5, Counter64, 4)
         self.assertEqual(metric, 2.5)
 
+    def test_aggregate_batch(self):
+        service = self.make_service({})
+
+        batch = EventBatch()
+        batch.append('ok', 'num', 'Number', 1, 4, hostname='localhost',
+                     aggregation=Counter, evtime=1)
+        batch.append('ok', 'gauge', 'Gauge', 7, 4, hostname='localhost',
+                     evtime=1)
+
+        queue = service._aggregateBatch(batch)
+        self.assertEqual(queue.services, ['gauge'])
+
+        batch = EventBatch()
+        batch.append('ok', 'num', 'Number', 3, 4, hostname='localhost',
+                     aggregation=Counter, evtime=5)
+
+        queue = service._aggregateBatch(batch)
+        self.assertEqual(queue.metrics, [0.5])
+
+    def test_counter_state_expiry(self):
+        state = CounterState(maxsize=10)
+
+        batch = EventBatch()
+        for i in range(10):
+            batch.append('ok', 'num', 'Number', i, 60, hostname='localhost',
+                         aggregation=Counter, evtime=1)
+        batch.sids = list(range(10))
+
+        self.assertEqual(state.apply(batch, 60), [])
+        self.assertEqual(len(state), 10)
+
+        # A new series evicts the oldest tenth of a full store
+        batch = EventBatch()
+        batch.append('ok', 'num', 'Number', 1, 60, hostname='localhost',
+                     aggregation=Counter, evtime=1)
+        batch.sids = [10]
+        state.apply(batch, 600)
+
+        self.assertEqual(len(state), 10)
+        self.assertEqual(state.evicted, 1)
+
+        state.expire(state.deadlines[state.slots[10]] - 1)
+        self.assertEqual(len(state), 1)
+        self.assertEqual(state.expired, 9)
+        self.assertEqual(state.get(10), (1, 1))
+
+    def test_series_registry(self):
+        service = self.make_service({})
+
+        batch = EventBatch()
+        batch.append('ok', 'a', 'A', 1, 60, hostname='host1')
+        batch.append('ok', 'b', 'B', 1, 60, hostname='host1')
+        batch.append('ok', 'a', 'A', 1, 60, hostname='host2')
+        batch.append('ok', 'a', 'A', 1, 60, hostname='host1')
+
+        sids = service.series.resolve(batch)
+
+        self.assertEqual(sids, [0, 1, 2, 0])
+        self.assertEqual(service.series.eid(2), 'host2.a')
+        self.assertEqual(service.series.lookup('host1', 'b'), 1)
+        self.assertEqual(batch.select([2, 3]).sids, [2, 0])
+
+    def test_series_registry_churn(self):
+        series = SeriesRegistry(maxsize=100)
+
+        steady = series.lookup('host0', 'steady')
+        for i in range(5000):
+            batch = EventBatch()
+            batch.append('ok', 'steady', 'S', 1, 60, hostname='host0')
+            batch.append('ok', 'a', 'A', 1, 60, hostname='host%s' % i)
+            batch.append('ok', 'b', 'B', 1, 60, hostname='host%s' % i)
+            sids = series.resolve(batch)
+
+            self.assertTrue(len(series) <= 200)
+            self.assertEqual(sids[0], steady)
+            self.assertEqual(series.eid(sids[2]), 'host%s.b' % i)
+
+        # Series which keep reporting keep their id, the rest are retired
+        self.assertTrue(series.retired > 9000)
+        self.assertEqual(series.lookup('host0', 'steady'), steady)
+        self.assertNotEqual(series.lookup('host1', 'a'), 1)
+        self.assertEqual(len(set(series.keys.values())), len(series))
+
     def test_state_match(self):
         service = self.make_service({
             'interval': 1.0, 'ttl': 60.0, 
@@ -232,6 +341,36 @@ class TestService(unittest.TestCase):
         self.assertEqual(ev2.state, 'critical')
         self.assertEqual(ev3.state, 'warning')
 
+    def test_trigger_expressions(self):
+        self.assertTrue(compileExpression('> 5')(6))
+        self.assertFalse(compileExpression('> 5')(None))
+        self.assertTrue(compileExpression('>= -1')(-1))
+
+        between = compileExpression('> 5 and service < 10')
+        self.assertTrue(between(7))
+        self.assertFalse(between(11))
+
+        self.assertRaises(ConfigurationError, compileExpression,
+                          '> __import__("os").getpid()')
+        self.assertRaises(ConfigurationError, compileExpression, '> "a"')
+        self.assertRaises(ConfigurationError, compileExpression, '>')
+
+    def test_trigger_batch(self):
+        triggers = Triggers({'cpu.*': '> 0.5'}, {'cpu$': '> 0.8'})
+
+        batch = EventBatch()
+        batch.append('ok', 'cpu', 'CPU', 0.9, 60, hostname='localhost')
+        batch.append('ok', 'cpu.core0', 'CPU', 0.9, 60, hostname='localhost')
+        batch.append('ok', 'cpu', 'CPU', 0.1, 60, hostname='localhost')
+        batch.append('unknown', 'cpu', 'CPU', 0.9, 60, hostname='localhost')
+
+        triggers.apply(batch)
+
+        self.assertEqual(batch.states,
+                         ['critical', 'warning', 'ok', 'unknown'])
+        self.assertEqual(sorted(triggers.services.keys()),
+                         ['cpu', 'cpu.core0'])
+
     @defer.inlineCallbacks
     def test_source_routing(self):
         service = self.make_service({
@@ -271,3 +410,511 @@ class TestService(unittest.TestCase):
 
         self.assertEqual(len(output1.events), 1)
         self.assertEqual(len(output2.events), 1)
+
+        # Serialized events are only shared between outputs which use the
+        # same format
+        self.assertFalse(service.buildRoute(source).shared)
+        output1.serialization = 'fake'
+        self.assertFalse(service.buildRoute(source).shared)
+        output2.serialization = 'fake'
+        self.assertTrue(service.buildRoute(source).shared)
+
+    @defer.inlineCallbacks
+    def test_source_routes_batch(self):
+        service = self.make_service({
+            'interval': 1.0, 'ttl': 60.0,
+            'sources': [{
+                'source': 'duct.sources.linux.basic.LoadAverage',
+                'interval': 2.0,
+                'service': 'load'}]
+        })
+
+        output = FakeOutput({}, service)
+        [source] = service.sources
+        service.outputs = {None: [output]}
+
+        batch = source.createBatch()
+        source.appendEvent(batch, 'ok', 'load', 1, prefix='1')
+        source.appendEvent(batch, 'ok', 'load', 2, prefix='5')
+
+        service.sendEvent(source, batch)
+
+        yield wait(0.2)
+
+        self.assertEqual(len(output.events), 2)
+        self.assertEqual([ev.service for ev in output.events],
+                         ['load.1', 'load.5'])
+
+    @defer.inlineCallbacks
+    def test_source_routing_rules(self):
+        service = self.make_service({
+            'interval': 1.0, 'ttl': 60.0,
+            'sources': [{
+                'source': 'duct.sources.linux.basic.LoadAverage',
+                'interval': 2.0,
+                'route': ['out1', {'match': 'load\\.1$', 'output': 'out2'}],
+                'service': 'load'}]
+        })
+
+        output1 = FakeOutput({}, service)
+        output2 = FakeOutput({}, service)
+        [source] = service.sources
+        service.outputs = {'out1': [output1], 'out2': [output2]}
+
+        batch = source.createBatch()
+        source.appendEvent(batch, 'ok', 'load', 1, prefix='1')
+        source.appendEvent(batch, 'ok', 'load', 2, prefix='5')
+
+        service.sendEvent(source, batch)
+        service.sendEvent(source, batch)
+
+        yield wait(0.1)
+
+        # Both batches are delivered in one call per output
+        self.assertEqual(len(output1.events), 4)
+        self.assertEqual([ev.service for ev in output2.events],
+                         ['load.1', 'load.1'])
+
+    def test_worker_encoding(self):
+        batch = EventBatch()
+        batch.append('ok', 'num', 'Number', 18446744073709551610, 60,
+                     hostname='localhost', aggregation=Counter64,
+                     attributes={'chicken': 'little'}, evtime=1)
+        batch.append('ok', 'load', 'Load', 0.5, 60, hostname='localhost',
+                     evtime=2)
+
+        index, decoded = workers.decodeBatch(workers.encodeBatch(3, batch))
+
+        self.assertEqual(index, 3)
+        self.assertEqual(decoded.metrics, batch.metrics)
+        self.assertEqual(decoded.aggregations, [Counter64, None])
+        self.assertEqual(decoded.attributes, batch.attributes)
+
+    @defer.inlineCallbacks
+    def _worker_pool_test(self, config):
+        config.update({
+            'workers': 1,
+            'sources': [{
+                'source': 'duct.sources.generator.Function',
+                'interval': 0.1,
+                'hostname': 'localhost',
+                'service': 'sine'}]
+        })
+        service = self.make_service(config)
+
+        output = FakeOutput({}, service)
+        service.outputs = {None: [output]}
+        [source] = service.sources
+
+        self.assertTrue(source in service.workers)
+
+        yield service.startService()
+
+        for _ in range(50):
+            if output.events:
+                break
+            yield wait(0.1)
+
+        self.assertEqual([ev.service for ev in output.events][:1], ['sine'])
+
+    def test_worker_pool(self):
+        return self._worker_pool_test({})
+
+    def test_worker_pool_debug(self):
+        # Debug output printed by the worker mustn't corrupt its events
+        return self._worker_pool_test({'debug': True})
+
+    @defer.inlineCallbacks
+    def test_worker_pool_limits(self):
+        service = self.make_service({
+            'workers': 1,
+            'backpressure': 'pause',
+            'concurrency': 4,
+            'concurrency_limits': {'fork': 2},
+            'sources': [{
+                'source': 'duct.sources.generator.Function',
+                'interval': 0.1,
+                'hostname': 'localhost',
+                'service': 'sine'
+            }, {
+                'source': 'duct.sources.generator.Function',
+                'interval': 0.1,
+                'hostname': 'localhost',
+                'resource': 'fork',
+                'worker': False,
+                'service': 'local'
+            }]
+        })
+
+        received = []
+        output = Output({}, service)
+        output.eventsReceived = lambda events: received.extend(
+            ev.service for ev in events)
+        service.outputs = {None: [output]}
+        [source, local] = service.sources
+
+        # The limits are shared between the parent and the worker
+        config = service.workers.workerConfig([source])
+        self.assertEqual(config['concurrency'], 2)
+        self.assertEqual(config['concurrency_limits'], {'fork': 1})
+
+        yield service.startService()
+        self.assertEqual(service.governor.limit, 2)
+        self.assertEqual(service.governor.limits, {'fork': 2})
+
+        for _ in range(50):
+            if 'sine' in received:
+                break
+            yield wait(0.1)
+        self.assertIn('sine', received)
+
+        # Pausing the source stops its ticks in the worker
+        service.pressured.add(output)
+        service.updateBackpressure(source)
+        yield wait(0.3)
+
+        del received[:]
+        yield wait(0.5)
+        self.assertNotIn('sine', received)
+        self.assertIn('local', received)
+
+        service.pressured.clear()
+        service.updateBackpressure(source)
+        for _ in range(50):
+            if 'sine' in received:
+                break
+            yield wait(0.1)
+        self.assertIn('sine', received)
+
+    def test_timing_wheel(self):
+        wheel = TimingWheel(size=4, levels=3)
+        for tick in (1, 3, 5, 17, 40, 100):
+            wheel.insert(tick, tick)
+
+        fired = []
+        for tick in range(1, 101):
+            for item in wheel.advance(tick):
+                self.assertEqual(item, tick)
+                fired.append(item)
+
+        self.assertEqual(fired, [1, 3, 5, 17, 40, 100])
+
+    def test_scheduler(self):
+        clock = task.Clock()
+        clock.advance(1000)
+        scheduler = Scheduler(clock=clock)
+
+        fast = TickSource('fast', 1.0)
+        other = TickSource('other', 1.0)
+        slow = TickSource('slow', 60.0, align=True)
+
+        for source in (fast, other, slow):
+            scheduler.add(source)
+
+        # Same interval and phase share a bucket
+        self.assertEqual(len(scheduler.buckets), 2)
+
+        for _ in range(600):
+            clock.advance(0.1)
+
+        self.assertEqual(fast.ticks, 60)
+        self.assertEqual(other.ticks, 60)
+        self.assertEqual(slow.ticks, 1)
+
+        # Overloaded sources are skipped
+        fast.running = True
+        clock.pump([0.1] * 10)
+        self.assertEqual(fast.ticks, 60)
+        self.assertEqual(scheduler.entries[fast].skipped, 1)
+        fast.running = False
+
+        # Missed ticks are dropped and reported as lag
+        clock.advance(5.05)
+        self.assertEqual(fast.ticks, 61)
+        self.assertTrue(fast.timings.get('schedule').max > 4)
+        self.assertEqual(dict(scheduler.skipped())[fast], 1)
+
+        for source in (fast, other, slow):
+            scheduler.remove(source)
+
+        self.assertFalse(scheduler.timer.running)
+
+    def test_governor(self):
+        governor = Governor(3, {'ssh': 1})
+        ssh = ('ssh', 'host1')
+
+        order = []
+        def waiter(name, key):
+            d = governor.acquire(name, key)
+            d.addCallback(lambda _: order.append(name))
+            return d
+
+        waiter('a', ssh)
+        waiter('b', ssh)
+        waiter('a', ssh)
+        waiter('c', ('ssh', 'host2'))
+        waiter('d', ('fork', None))
+
+        # One per SSH host holds back b and the second a on host1, while d
+        # takes the last of the three global slots
+        self.assertEqual(order, ['a', 'c', 'd'])
+        self.assertEqual(governor.queued, 2)
+        self.assertEqual(governor.classes(), {'ssh': 2, 'fork': 1})
+
+        # Waiting sources are served in turn
+        governor.release(ssh)
+        self.assertEqual(order, ['a', 'c', 'd', 'b'])
+        governor.release(ssh)
+        self.assertEqual(order, ['a', 'c', 'd', 'b', 'a'])
+
+        # Cancelled waiters leave the queue
+        d = governor.acquire('e', ssh)
+        d.addErrback(lambda _: None)
+        d.cancel()
+        self.assertEqual(governor.queued, 0)
+
+        for key in (ssh, ('ssh', 'host2'), ('fork', None)):
+            governor.release(key)
+        self.assertEqual(governor.inflight, 0)
+
+    def test_histogram(self):
+        hist = Histogram()
+        for i in range(1, 101):
+            hist.record(i / 1000.0)
+
+        self.assertEqual(hist.count, 100)
+        self.assertEqual(hist.max, 0.1)
+        self.assertTrue(0.05 <= hist.percentile(50) < 0.05 * 1.25)
+        self.assertTrue(0.099 <= hist.percentile(99) <= 0.1)
+
+    @defer.inlineCallbacks
+    def test_source_deadline(self):
+        service = self.make_service({})
+
+        class HungSource(Source):
+            def get(self):
+                return self.pending
+
+        cancelled = []
+        source = HungSource({
+            'service': 'hung',
+            'hostname': 'localhost',
+            'deadline': 0.05
+        }, service.sendEvent, service)
+        source.pending = defer.Deferred(cancelled.append)
+        service.sources.append(source)
+
+        output = FakeOutput({}, service)
+        service.outputs = {None: [output]}
+
+        yield source.tick()
+        yield wait(0)
+
+        self.assertEqual(len(cancelled), 1)
+        self.assertFalse(source.running)
+        self.assertEqual(source.timeouts, 1)
+        self.assertEqual(source.timings.get('tick').count, 1)
+
+        [event] = output.events
+        self.assertEqual(event.service, 'hung.timeout')
+        self.assertEqual(event.state, 'critical')
+        self.assertTrue(event.metric >= 0.05)
+
+    @defer.inlineCallbacks
+    def test_source_watchdog(self):
+        service = self.make_service({
+            'watchdog_restarts': 1,
+            'sources': [{
+                'source': 'duct.sources.generator.Function',
+                'hostname': 'localhost',
+                'interval': 1.0,
+                'watchdog': True,
+                'service': name
+            } for name in ('one', 'two', 'three')]
+        })
+        one, two, three = service.sources
+
+        service.watchSource(one, 0)
+        service.watchSource(two, 0)
+        service.watchSource(three, 0)
+
+        service.lastEvents[one] = time.time() - 60
+        service.lastEvents[two] = time.time() - 60
+        service.lastEvents[three] = time.time()
+
+        service.sourceWatchdog()
+        yield wait(0)
+
+        # Only one restart per run
+        self.assertEqual(service.restarts, 1)
+        self.assertNotIn(one, service.sources)
+        self.assertIn(two, service.sources)
+        self.assertEqual(len(service.sources), 3)
+        self.assertTrue(
+            service.restartReasons['one'].startswith('no events for 60'))
+        self.assertEqual(len(service.watchdogHeap), 3)
+
+        # Sources which are still sending are pushed back
+        self.assertTrue(service.watchdogHeap[0][0] > time.time())
+
+    def test_pipeline_timings(self):
+        service = self.make_service({
+            'sources': [{
+                'source': 'duct.sources.Duct',
+                'hostname': 'localhost',
+                'service': 'duct'
+            }]
+        })
+        [duct] = service.sources
+        source = self.make_source(service)
+
+        output = Output({'name': 'riemann'}, service)
+        service.outputs = {None: [output]}
+
+        service.sendEvent(source, Event('ok', 'test', 'Test', 1.0, 60.0,
+                                        hostname='localhost'))
+        output.eventsReceived([Event('ok', 'test', 'Test', 1.0, 60.0)])
+        output.markDequeued(1)
+        self.assertEqual(len(output.queueMarks), 0)
+
+        # Timings are only reported when asked for, and skipped ticks only
+        # for sources which skipped any
+        service.scheduler.skipped = lambda: [(source, 0), (duct, 2)]
+        events = dict((ev.service, ev.metric) for ev in duct.get())
+        self.assertEqual(events['duct.schedule.skipped.duct'], 2)
+        self.assertNotIn('duct.schedule.skipped.test', events)
+        self.assertNotIn('duct.pipeline.source.test.send.p99', events)
+        self.assertNotIn('duct.pipeline.output.riemann.queue.max', events)
+        self.assertEqual(events['duct.pipeline.output.riemann.queued'], 1)
+        self.assertEqual(source.timings.get('send').count, 1)
+
+        duct.pipeline = True
+        events = dict((ev.service, ev.metric) for ev in duct.get())
+
+        for stage in ('aggregate', 'send'):
+            self.assertIn('duct.pipeline.source.test.%s.p99' % stage, events)
+        self.assertIn('duct.pipeline.output.riemann.queue.max', events)
+        self.assertEqual(events['duct.pipeline.output.riemann.queued'], 1)
+
+        # Timings are reset after each report
+        self.assertEqual(source.timings.get('send').count, 0)
+
+    @defer.inlineCallbacks
+    def test_backpressure(self):
+        events = [Event('ok', 'test', 'Test', 1.0, 60.0)] * 8
+
+        # Sources aren't held back unless backpressure is configured
+        service = self.make_service({})
+        source = self.make_source(service)
+        output = Output({'name': 'riemann'}, service)
+        output.maxsize = 10
+        service.outputs = {None: [output]}
+
+        output.eventsReceived(events)
+        self.assertTrue(output.pressured)
+        self.assertEqual(source.backpressure, None)
+
+        service = self.make_service({'backpressure': 'pause'})
+        source = self.make_source(service)
+        source.get = lambda: None
+
+        output = Output({'name': 'riemann'}, service)
+        output.maxsize = 10
+        service.outputs = {None: [output]}
+
+        # Filling past the high watermark pauses the source
+        output.eventsReceived(events)
+        self.assertTrue(output.pressured)
+        self.assertEqual(service.pressured, set([output]))
+        self.assertEqual(source.backpressure, 'pause')
+
+        yield source.tick()
+        self.assertEqual(source.pressureSkipped, 1)
+
+        # Draining below the low watermark releases it
+        output.markDequeued(len(output.events.take(6)))
+        self.assertFalse(output.pressured)
+        self.assertEqual(source.backpressure, None)
+
+        # Sampled sources keep running but drop events
+        source.config['backpressure'] = 'sample'
+        service.backpressureSample = 0
+        output.eventsReceived(events)
+        self.assertEqual(source.backpressure, 'sample')
+
+        service.sendEvent(source, events[:5])
+        self.assertEqual(source.pressureSampled, 5)
+        self.assertEqual(service.pending, {})
+
+    @defer.inlineCallbacks
+    def test_reactor_monitor(self):
+        service = self.make_service({})
+        source = self.make_source(service)
+        output = Output({'name': 'slow'}, service)
+
+        monitor = ReactorMonitor(interval=0.02, threshold=0.02, sample=False)
+        monitor.callFinished(output, 0.5)
+        monitor.callFinished(output, 0.01)
+        self.assertEqual(monitor.worst(), [('output.slow', 0.5)])
+
+        # The sampler finds the source blocking the reactor
+        monitor = ReactorMonitor(interval=0.02, threshold=0.02, sample=True)
+        monitor.start()
+        self.addCleanup(monitor.stop)
+
+        yield wait(0.05)
+        source.block(0.2)
+        yield wait(0.05)
+
+        # Stopping waits for the sampling thread
+        thread = monitor.thread
+        monitor.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(monitor.lag.max >= 0.15)
+        self.assertEqual(monitor.stalls, 1)
+        [(name, blocked)] = monitor.worst()
+        self.assertEqual(name, 'source.test')
+        self.assertTrue(blocked > 0.1)
+
+    def test_profiler(self):
+        service = self.make_service({})
+        source = self.make_source(service)
+
+        profiler = Profiler(tempfile.mkdtemp(), interval=0.001)
+        self.addCleanup(shutil.rmtree, profiler.directory)
+
+        profiler.toggle()
+        source.block(0.1)
+        folded, memory = profiler.stop()
+
+        with open(folded) as profile:
+            stacks = profile.read().splitlines()
+
+        self.assertTrue(stacks)
+        self.assertTrue(any(
+            line.startswith('source:FakeSource;') and 'test_service.py:block'
+            in line for line in stacks))
+        self.assertTrue(os.path.exists(memory))
+
+    def test_memory_tracker(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            raise unittest.SkipTest("tracemalloc is not available")
+
+        if tracemalloc.is_tracing():
+            raise unittest.SkipTest("tracemalloc is already tracing")
+
+        # Tracing the tracker started is stopped again
+        tracker = MemoryTracker()
+        tracker.start()
+        self.assertTrue(tracemalloc.is_tracing())
+        tracker.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+
+        # Tracing which was already running is left alone
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        tracker.start()
+        tracker.stop()
+        self.assertTrue(tracemalloc.is_tracing())
@@ -10,6 +10,7 @@ from duct.sources.linux import basic, process, sensors
 from duct.sources import riak, nginx, network, apache, munin, haproxy
 from duct.sources.database import elasticsearch, postgresql, memcache
 from duct.service import DuctService
+from duct.utils import getPool
 from duct.tests import globs
 
 
@@ -592,6 +593,8 @@ class TestRiakSources(TestSources):
     def start_fake_riak_server(self, stats):
         def cb(listener):
             self.addCleanup(listener.stopListening)
+            # Persistent connections to the server are closed first
+            self.addCleanup(getPool().closeCachedConnections)
             return listener
 
         data = static.Data(json.dumps(stats).encode(), 'application/json')
@@ -1,6 +1,7 @@
 from twisted.trial import unittest
 
-from twisted.internet import defer, reactor, error
+from twisted.internet import defer, endpoints, reactor, error
+from twisted.web import server, static
 
 from duct import utils
 
@@ -28,3 +29,40 @@ class Tests(unittest.TestCase):
 
         self.assertFalse(pc.contains('bar'))
 
+    def test_fqdn_cached(self):
+        lookups = []
+
+        def gethostbyaddr(host):
+            lookups.append(host)
+            return ('test.acme.com', [], [])
+
+        self.patch(utils, '_fqdn', None)
+        self.patch(utils.socket, 'gethostbyaddr', gethostbyaddr)
+
+        self.assertEquals(utils.getFQDN(), 'test.acme.com')
+        self.assertEquals(utils.getFQDN(), 'test.acme.com')
+        self.assertEquals(len(lookups), 1)
+
+    @defer.inlineCallbacks
+    def test_connection_pool(self):
+        data = static.Data(b'hello', 'text/plain')
+        data.isLeaf = True
+        listener = yield endpoints.TCP4ServerEndpoint(reactor, 0).listen(
+            server.Site(data))
+        self.addCleanup(listener.stopListening)
+
+        pool = utils.ConnectionPool(reactor, maxPerHost=2, idleTimeout=10)
+        self.addCleanup(pool.closeCachedConnections)
+
+        url = 'http://127.0.0.1:%s/' % listener.getHost().port
+        for _ in range(3):
+            body = yield utils.HTTPRequest(pool=pool).getBody(url)
+            self.assertEqual(body, 'hello')
+
+        # One connection is opened and then reused
+        self.assertEqual((pool.misses, pool.hits), (1, 2))
+        self.assertEqual(pool.idle(), 1)
+        self.assertEqual(pool.cachedConnectionTimeout, 10)
+
+        # The shared pool is used by default
+        self.assertIs(utils.HTTPRequest().pool, utils.getPool())
@@ -0,0 +1,188 @@
+"""
+.. module:: triggers
+   :synopsis: Compiled warning and critical state triggers
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import ast
+import operator
+import re
+
+from duct.configuration import ConfigurationError
+from duct.objects import EventBatch
+
+
+_COMPARISONS = {
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+}
+
+_ALLOWED = (
+    ast.Expression, ast.Compare, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp,
+    ast.Not, ast.USub, ast.UAdd, ast.BinOp, ast.Add, ast.Sub, ast.Mult,
+    ast.Div, ast.Mod, ast.Name, ast.Load
+) + tuple(_COMPARISONS.keys())
+
+# pylint: disable=no-member
+if hasattr(ast, 'Constant'):
+    _NUMBERS = (ast.Constant,)
+else:
+    _NUMBERS = (ast.Num,)
+
+def _number(node):
+    """Return the value of a numeric literal node, or raise ValueError
+    """
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -_number(node.operand)
+
+    if isinstance(node, _NUMBERS):
+        value = getattr(node, 'value', getattr(node, 'n', None))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+
+    raise ValueError()
+
+def compileExpression(expression):
+    """Compile a trigger expression such as "> 500" into a predicate which
+    takes a metric value and returns True if the trigger fires.
+
+    Expressions are Python comparisons with the metric as the implicit left
+    hand side, and may only use numbers, arithmetic, comparisons, `and`, `or`,
+    `not` and the name `service` (the metric). Anything else raises
+    ConfigurationError. Simple comparisons with a constant are turned into a
+    single operator call.
+    """
+    source = "service %s" % expression
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError:
+        raise ConfigurationError(
+            "Invalid trigger expression %r" % expression)
+
+    for node in ast.walk(tree):
+        if isinstance(node, _NUMBERS):
+            try:
+                _number(node)
+            except ValueError:
+                raise ConfigurationError(
+                    "Invalid constant in trigger expression %r" % expression)
+        elif not isinstance(node, _ALLOWED):
+            raise ConfigurationError(
+                "Unsupported trigger expression %r" % expression)
+        elif isinstance(node, ast.Name) and (node.id != 'service'):
+            raise ConfigurationError(
+                "Unknown name %r in trigger expression %r" % (node.id,
+                                                              expression))
+
+    body = tree.body
+    if isinstance(body, ast.Compare) and (len(body.ops) == 1) and (
+            isinstance(body.left, ast.Name)):
+        try:
+            value = _number(body.comparators[0])
+        except ValueError:
+            value = None
+
+        if value is not None:
+            compare = _COMPARISONS[type(body.ops[0])]
+
+            def predicate(metric):
+                try:
+                    return compare(metric, value)
+                except TypeError:
+                    return False
+
+            return predicate
+
+    code = compile(tree, '<trigger>', 'eval')
+    scope = {'__builtins__': {}}
+
+    def evaluate(metric):
+        try:
+            return eval(code, scope, {'service': metric})
+        except (TypeError, ZeroDivisionError):
+            return False
+
+    return evaluate
+
+class Triggers(object):
+    """Warning and critical triggers for one source
+
+    Each trigger maps a regular expression on the service name to an
+    expression compiled with :func:`compileExpression`. The triggers which
+    apply to a service name are found once and cached, so later events for
+    the same series only cost a dictionary lookup.
+
+    :param warning: Dictionary of service regex to expression
+    :param critical: Dictionary of service regex to expression
+    """
+    cacheSize = 100000
+
+    def __init__(self, warning=None, critical=None):
+        self.warning = [(re.compile(key), compileExpression(val))
+                        for key, val in (warning or {}).items()]
+        self.critical = [(re.compile(key), compileExpression(val))
+                         for key, val in (critical or {}).items()]
+
+        self.services = {}
+
+    def __bool__(self):
+        return bool(self.warning or self.critical)
+
+    __nonzero__ = __bool__
+
+    def match(self, service):
+        """Return a tuple of (warning, critical) predicates for `service`
+        """
+        predicates = self.services.get(service)
+        if predicates is None:
+            if len(self.services) >= self.cacheSize:
+                self.services.clear()
+
+            predicates = (
+                [pred for key, pred in self.warning if key.match(service)],
+                [pred for key, pred in self.critical if key.match(service)]
+            )
+            self.services[service] = predicates
+
+        return predicates
+
+    def state(self, service, metric):
+        """Return the triggered state for `metric`, or None
+        """
+        warning, critical = self.match(service)
+
+        for predicate in critical:
+            if predicate(metric):
+                return 'critical'
+
+        for predicate in warning:
+            if predicate(metric):
+                return 'warning'
+
+        return None
+
+    def apply(self, events):
+        """Apply triggers to every event in `events` which is in the 'ok'
+        state. `events` may be an EventBatch or a list of events.
+        """
+        state = self.state
+
+        if isinstance(events, EventBatch):
+            states = events.states
+            for i, (evstate, service, metric) in enumerate(
+                    zip(states, events.services, events.metrics)):
+                if evstate == 'ok':
+                    newState = state(service, metric)
+                    if newState:
+                        states[i] = newState
+        else:
+            for ev in events:
+                if ev.state == 'ok':
+                    newState = state(ev.service, ev.metric)
+                    if newState:
+                        ev.state = newState
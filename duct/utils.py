@@ -8,6 +8,7 @@
 import json
 import time
 import os
+import socket
 
 try:
     from StringIO import StringIO
@@ -19,7 +20,7 @@ from zope.interface import implementer
 from twisted.internet import reactor, protocol, defer, error
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
-from twisted.web.client import Agent
+from twisted.web.client import Agent, HTTPConnectionPool
 from twisted.names import client
 from twisted.python import log
 
@@ -33,6 +34,19 @@ def wait(msecs):
     reactor.callLater(msecs/1000.0, d.callback, None)
     return d
 
+_fqdn = None
+
+def getFQDN():
+    """Returns the fully qualified domain name of this host.
+
+    The lookup blocks, so it is only done once per process and the result is
+    shared by every caller.
+    """
+    global _fqdn
+    if _fqdn is None:
+        _fqdn = socket.gethostbyaddr(socket.gethostname())[0]
+    return _fqdn
+
 class SocketyAgent(Agent):
     """HTTP agent for connecting to UNIX sockets
     """
@@ -43,6 +57,65 @@ class SocketyAgent(Agent):
     def _getEndpoint(self, *_a):
         return clientFromString(reactor, self.path)
 
+    def _requestWithEndpoint(self, key, *a):
+        # Pooled connections are keyed by URL, which says nothing about the
+        # socket they're made to
+        return Agent._requestWithEndpoint(self, (self.path,) + key, *a)
+
+class ConnectionPool(HTTPConnectionPool):
+    """Persistent HTTP connection pool which counts how often a request
+    reuses an idle connection (a hit) rather than opening a new one (a miss)
+
+    :param maxPerHost: Idle connections kept open to each host (default: 4)
+    :type maxPerHost: int.
+    :param idleTimeout: Seconds an idle connection is kept open
+                        (default: 60)
+    :type idleTimeout: float.
+    """
+    def __init__(self, react, maxPerHost=4, idleTimeout=60):
+        HTTPConnectionPool.__init__(self, react, persistent=True)
+        self.configure(maxPerHost, idleTimeout)
+        self.hits = 0
+        self.misses = 0
+        self.opened = 0
+
+    def configure(self, maxPerHost=None, idleTimeout=None):
+        """Change the idle connection limit per host or the idle timeout
+        """
+        if maxPerHost is not None:
+            self.maxPersistentPerHost = int(maxPerHost)
+        if idleTimeout is not None:
+            self.cachedConnectionTimeout = float(idleTimeout)
+
+    def getConnection(self, key, endpoint):
+        opened = self.opened
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self.opened == opened:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.opened += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def idle(self):
+        """Number of idle connections waiting to be reused
+        """
+        return sum(len(conns) for conns in self._connections.values())
+
+_pool = None
+
+def getPool():
+    """Returns the HTTP connection pool shared by every :class:`HTTPRequest`
+    in the process
+    """
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(reactor)
+    return _pool
+
 class Timeout(Exception):
     """
     Raised to notify that an operation exceeded its timeout.
@@ -166,6 +239,17 @@ class ProcessProtocol(protocol.ProcessProtocol):
 
         self.timer = reactor.callLater(self.timeout, killIfAlive)
 
+    def cancel(self, _deferred):
+        """Kill the process if its Deferred is cancelled
+        """
+        if self.timer and self.timer.active():
+            self.timer.cancel()
+
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
 def fork(executable, args=(), env={}, path=None, timeout=3600):
     """fork
     Provides a deferred wrapper function with a timeout function
@@ -179,8 +263,8 @@ def fork(executable, args=(), env={}, path=None, timeout=3600):
     :param timeout: Kill the child process if timeout is exceeded
     :type timeout: int.
     """
-    de = defer.Deferred()
-    proc = ProcessProtocol(de, timeout)
+    proc = ProcessProtocol(None, timeout)
+    de = proc.deferred = defer.Deferred(proc.cancel)
     reactor.spawnProcess(proc, executable, (executable,)+tuple(args), env,
                          path)
     return de
@@ -189,10 +273,17 @@ try:
     from twisted.internet.ssl import ClientContextFactory
 
     class WebClientContextFactory(ClientContextFactory):
-        """SSL Context factory
+        """SSL Context factory. The context is created once, so every
+        connection shares its configuration and session cache
         """
+        context = None
+
         def getContext(self, *_a):
-            return ClientContextFactory.getContext(self)
+            if self.context is None:
+                self.context = ClientContextFactory.getContext(self)
+            return self.context
+
+    contextFactory = WebClientContextFactory()
     SSL = True
 except:
     SSL = False
@@ -207,11 +298,13 @@ except:
 
 class HTTPRequest(object):
     """Helper class for creating HTTP requests.
-       Accepts a `timeout` to cancel requests which take too long
+       Accepts a `timeout` to cancel requests which take too long, and a
+       `pool` of connections to use instead of the shared one
     """
-    def __init__(self, timeout=120):
+    def __init__(self, timeout=120, pool=None):
         self.timeout = timeout
         self.timedout = None
+        self.pool = pool if pool is not None else getPool()
 
     def abort_request(self, request):
         """Called to abort request on timeout"""
@@ -227,8 +320,16 @@ class HTTPRequest(object):
         """Response received
         """
         if request.length:
-            de = defer.Deferred()
-            request.deliverBody(BodyReceiver(de))
+            receiver = BodyReceiver(None)
+
+            def cancel(_d):
+                """Drop the connection if reading the body is cancelled
+                """
+                if receiver.transport is not None:
+                    receiver.transport.stopProducing()
+
+            de = receiver.finished = defer.Deferred(cancel)
+            request.deliverBody(receiver)
             body = yield de
             body = body.read()
         else:
@@ -246,15 +347,15 @@ class HTTPRequest(object):
         self.timedout = False
 
         if socket:
-            agent = SocketyAgent(reactor, socket)
+            agent = SocketyAgent(reactor, socket, pool=self.pool)
         else:
             if url[:5] == 'https':
                 if SSL:
-                    agent = Agent(reactor, WebClientContextFactory())
+                    agent = Agent(reactor, contextFactory, pool=self.pool)
                 else:
                     raise Exception('HTTPS requested but not supported')
             else:
-                agent = Agent(reactor)
+                agent = Agent(reactor, pool=self.pool)
 
         request = agent.request(method.encode(), url.encode(),
                                 Headers(headers),
@@ -0,0 +1,428 @@
+"""
+.. module:: workers
+   :synopsis: Run sources in child processes
+
+.. moduleauthor:: Colin Alston <colin@imcol.in>
+"""
+
+import importlib
+import json
+import os
+import struct
+import sys
+import time
+
+from zope.interface import implementer
+
+from twisted.internet import reactor, protocol, defer, error, stdio
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+from duct.objects import EventBatch
+from duct.service import DuctService
+
+
+def encodeBatch(index, batch):
+    """Encode an EventBatch from source `index` for the parent process.
+    Aggregation functions are sent by their import path.
+    """
+    aggregations = [
+        ('%s.%s' % (agg.__module__, agg.__name__) if agg else None)
+        for agg in batch.aggregations
+    ]
+
+    message = {'source': index, 'aggregations': aggregations}
+    for column in EventBatch.columns:
+        if column != 'aggregations':
+            message[column] = getattr(batch, column)
+
+    return json.dumps(message).encode()
+
+_aggregators = {}
+
+def _resolveAggregation(path):
+    if path not in _aggregators:
+        module, name = path.rsplit('.', 1)
+        _aggregators[path] = getattr(importlib.import_module(module), name)
+    return _aggregators[path]
+
+def decodeBatch(data):
+    """Decode a message from a worker into (source index, EventBatch)
+    """
+    message = json.loads(data.decode())
+
+    batch = EventBatch()
+    for column in EventBatch.columns:
+        if column != 'aggregations':
+            setattr(batch, column, message[column])
+
+    batch.aggregations = [(_resolveAggregation(agg) if agg else None)
+                          for agg in message['aggregations']]
+
+    return message['source'], batch
+
+# Child file descriptor which carries event batches, so anything the child
+# prints to stdout can't corrupt their framing
+CHANNEL_FD = 3
+
+# Length prefix of messages in both directions, as used by
+# Int32StringReceiver
+PREFIX = struct.Struct('!I')
+
+def frameMessage(message):
+    """Encode `message` as JSON with a length prefix
+    """
+    data = json.dumps(message).encode()
+    return PREFIX.pack(len(data)) + data
+
+def readMessage(fd):
+    """Read one length prefixed JSON message from file descriptor `fd`,
+    blocking until it has arrived
+    """
+    def read(size):
+        data = b''
+        while len(data) < size:
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                raise EOFError('Pipe closed after %s bytes' % len(data))
+            data += chunk
+        return data
+
+    size, = PREFIX.unpack(read(PREFIX.size))
+    return json.loads(read(size).decode())
+
+def limitShare(limit, count, total):
+    """Share of a concurrency `limit` for a process which runs `count` of
+    `total` sources. Every process is allowed at least one tick
+    """
+    if (not limit) or (not total):
+        return limit
+    return max(1, limit * count // total)
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """Parent side of a worker process. Decodes event batches from the
+    child's channel descriptor and passes them to `DuctService.sendEvent`.
+    Anything the child writes to stdout or stderr is logged.
+
+    The child's configuration is the first message written to its stdin,
+    which is then kept open to send it the backpressure state of its
+    sources
+    """
+    def __init__(self, pool, number, sources):
+        self.pool = pool
+        self.number = number
+        self.sources = sources
+        self.receiver = WorkerReceiver(self.batchReceived)
+        self.ended = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.write(frameMessage(self.pool.workerConfig(
+            self.sources)))
+
+        # A restarted worker picks up where its predecessor was held back
+        for index, source in enumerate(self.sources):
+            if source.backpressure:
+                self.applyBackpressure(index, source.backpressure)
+
+    def applyBackpressure(self, index, mode):
+        """Hold back source `index` in the child with `mode`, or release
+        it if `mode` is None
+        """
+        self.transport.write(frameMessage({'source': index,
+                                           'backpressure': mode}))
+
+    def childDataReceived(self, childFD, data):
+        if childFD == CHANNEL_FD:
+            self.receiver.dataReceived(data)
+        else:
+            for line in data.decode(errors='replace').splitlines():
+                log.msg('[worker %s] %s' % (self.number, line))
+
+    def batchReceived(self, data):
+        """Called with each encoded batch from the child
+        """
+        try:
+            index, batch = decodeBatch(data)
+            source = self.sources[index]
+        except Exception as ex:
+            log.msg('[worker %s] Invalid message: %s' % (self.number, ex))
+            return
+
+        self.pool.duct.sendEvent(source, batch)
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self, reason)
+        self.ended.callback(None)
+
+class WorkerReceiver(Int32StringReceiver):
+    """Frame decoder for worker messages
+    """
+    MAX_LENGTH = 256 * 1024 * 1024
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def stringReceived(self, string):
+        self.callback(string)
+
+    def lengthLimitExceeded(self, length):
+        log.msg('Worker message of %s bytes exceeds limit' % length)
+
+class WorkerPool(object):
+    """Shards sources across `workers` child processes
+
+    Each child runs the ticks of its sources and sends the resulting event
+    batches back, while aggregation, triggers and routing stay in the parent
+    `DuctService`. Children which exit are restarted after `restartDelay`
+    seconds.
+
+    Backpressure on a source is forwarded to the child which runs it. The
+    `concurrency` and `concurrency_limits` limits are shared between the
+    parent and the children in proportion to the number of sources each
+    runs, so together they stay within the configured limits.
+
+    :param duct: The parent DuctService
+    :param workers: Number of child processes
+    """
+    restartDelay = 5
+    stopTimeout = 5
+
+    def __init__(self, duct, workers):
+        self.duct = duct
+        self.workers = workers
+        self.shards = [[] for _ in range(workers)]
+        self.members = {}
+        self.processes = {}
+        self.running = False
+
+    def __contains__(self, source):
+        return source in self.members
+
+    def add(self, source):
+        """Assign a source to the least loaded worker
+        """
+        number = min(range(self.workers), key=lambda n: len(self.shards[n]))
+        self.members[source] = (number, len(self.shards[number]))
+        self.shards[number].append(source)
+
+    def applyBackpressure(self, source, mode):
+        """Forward the backpressure `mode` of `source` to its worker
+        """
+        number, index = self.members[source]
+        proc = self.processes.get(number)
+        if proc is not None:
+            proc.applyBackpressure(index, mode)
+
+    def shareLimits(self, sources):
+        """Return the share of the `concurrency` and `concurrency_limits`
+        limits for a process which runs `sources`
+        """
+        config = self.duct.config
+        everything = self.duct.sources
+
+        limit = limitShare(int(config.get('concurrency', 0)), len(sources),
+                           len(everything))
+
+        limits = {}
+        for name, classLimit in (config.get('concurrency_limits') or
+                                 {}).items():
+            limits[name] = limitShare(
+                int(classLimit),
+                sum(1 for src in sources if src.resourceKey[0] == name),
+                sum(1 for src in everything if src.resourceKey[0] == name))
+
+        return limit, limits
+
+    def workerConfig(self, sources):
+        """Build the configuration for a worker which runs `sources`
+        """
+        config = getattr(self.duct.config, 'raw_config', self.duct.config)
+        config = dict((key, val) for key, val in config.items()
+                      if key not in ('sources', 'outputs', 'workers'))
+        config['sources'] = [source.config for source in sources]
+        config['concurrency'], config['concurrency_limits'] = (
+            self.shareLimits(sources))
+        return config
+
+    def spawn(self, number):
+        """Start worker process `number`
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+
+        proc = WorkerProcess(self, number, self.shards[number])
+        self.processes[number] = proc
+
+        reactor.spawnProcess(
+            proc, sys.executable, [sys.executable, '-m', 'duct.workers'],
+            env=env, childFDs={0: 'w', 1: 'r', 2: 'r', CHANNEL_FD: 'r'})
+
+    def start(self):
+        """Start all workers which have sources
+        """
+        self.running = True
+
+        # Ticks in the parent get the share of sources which stayed there
+        governor = self.duct.governor
+        governor.limit, governor.limits = self.shareLimits(
+            [source for source in self.duct.sources
+             if source not in self.members])
+
+        for number, shard in enumerate(self.shards):
+            if shard:
+                self.spawn(number)
+
+    def workerEnded(self, proc, reason):
+        """Called when a worker process exits
+        """
+        if self.processes.get(proc.number) is proc:
+            del self.processes[proc.number]
+
+        if self.running:
+            log.msg('Worker %s exited (%s), restarting in %ss' % (
+                proc.number, reason.value, self.restartDelay))
+            reactor.callLater(self.restartDelay, self._restart, proc.number)
+
+    def _restart(self, number):
+        if self.running and (number not in self.processes):
+            self.spawn(number)
+
+    def stop(self):
+        """Stop all workers. Returns a Deferred which fires once they have
+        exited, killing any which are still running after `stopTimeout`
+        seconds
+        """
+        self.running = False
+
+        procs = list(self.processes.values())
+        for proc in procs:
+            try:
+                proc.transport.closeStdin()
+                proc.transport.signalProcess('TERM')
+            except Exception:
+                pass
+
+        def kill():
+            for proc in procs:
+                if not proc.ended.called:
+                    try:
+                        proc.transport.signalProcess('KILL')
+                    except Exception:
+                        pass
+
+        killer = reactor.callLater(self.stopTimeout, kill)
+
+        def stopped(result):
+            if killer.active():
+                killer.cancel()
+            return result
+
+        return defer.DeferredList(
+            [proc.ended for proc in procs]).addBoth(stopped)
+
+@implementer(IHalfCloseableProtocol)
+class WorkerChannel(Int32StringReceiver):
+    """Child side of the worker pipes. Batches are written to
+    `CHANNEL_FD`, and messages from the parent are read from stdin and
+    passed to `WorkerService.messageReceived`
+    """
+    MAX_LENGTH = 256 * 1024 * 1024
+
+    duct = None
+
+    def stringReceived(self, string):
+        """Called with each message from the parent
+        """
+        try:
+            message = json.loads(string.decode())
+        except ValueError as ex:
+            log.msg('Invalid message from parent: %s' % ex)
+            return
+
+        if self.duct is not None:
+            self.duct.messageReceived(message)
+
+    def readConnectionLost(self):
+        """Stop the worker when our parent closes its stdin
+        """
+        self.writeConnectionLost()
+
+    def writeConnectionLost(self):
+        """Stop the worker when our parent has gone away
+        """
+        try:
+            reactor.stop()
+        except error.ReactorNotRunning:
+            # Already stopping, after a signal or the other pipe closing
+            pass
+
+    def connectionLost(self, reason=None):
+        """Stop the worker when the pipe is closed
+        """
+        self.writeConnectionLost()
+
+class WorkerService(DuctService):
+    """DuctService which runs sources in a worker process and sends their
+    events to the parent instead of routing them to outputs
+    """
+    def __init__(self, config, channel):
+        self.channel = channel
+        self.sourceIndex = {}
+        DuctService.__init__(self, config)
+
+        for index, source in enumerate(self.sources):
+            self.sourceIndex[source] = index
+
+    def setupOutputs(self, config):
+        pass
+
+    def setupTriggers(self, source, sobj):
+        pass
+
+    def startWatchdog(self):
+        pass
+
+    def messageReceived(self, message):
+        """Apply a message from the parent
+        """
+        try:
+            source = self.sources[message['source']]
+        except (KeyError, IndexError, TypeError):
+            log.msg('Invalid message from parent: %r' % (message,))
+            return
+
+        if 'backpressure' in message:
+            mode = message['backpressure']
+            if mode != source.backpressure:
+                source.applyBackpressure(mode)
+
+    def sendEvent(self, source, events):
+        batch = EventBatch.fromEvents(events)
+        if batch:
+            self.eventCounter += len(batch)
+            self.channel.sendString(
+                encodeBatch(self.sourceIndex[source], batch))
+
+        self.lastEvents[source] = time.time()
+
+def main():
+    """Entry point for worker processes
+    """
+    log.startLogging(sys.stderr, setStdout=False)
+
+    config = readMessage(sys.stdin.fileno())
+
+    channel = WorkerChannel()
+    stdio.StandardIO(channel, stdout=CHANNEL_FD)
+
+    duct = WorkerService(config, channel)
+    channel.duct = duct
+
+    reactor.callWhenRunning(duct.startService)
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown', lambda: defer.maybeDeferred(duct.stopService))
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,11 @@ class DuctServiceMaker(object):
     options = Options
  
     def makeService(self, options):
-        return duct.makeService(ConfigFile(options['config']))
+        service = duct.makeService(ConfigFile(options['config']))
+
+        # Toggle the profiler by signal inside the running agent
+        service.profiler.install()
+
+        return service
  
 serviceMaker = DuctServiceMaker()